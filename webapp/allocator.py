@@ -0,0 +1,145 @@
+# Seat allocation for check-in of tickets without a seat
+#
+# A policy picks a few candidate seats from the availability index of the flight (in order of preference),
+# the candidates are claimed with one statement that takes the first of them that is free and not locked
+# (FOR UPDATE SKIP LOCKED, see booking.claim_any_statement). Concurrent check-ins therefore never wait for each
+# other's seat and picking the candidates only costs a few operations on the bitset of the flight.
+#
+# Policies (config CHECKIN_SEAT_POLICY, or "seat-preference" of a check-in):
+#   front-to-back  fill the aircraft from the first row
+#   spread         start at a random free seat, so concurrent check-ins rarely compete for the same seats
+#   window, aisle  window (or aisle) seats first, then any seat
+#
+# Further policies are registered with register(policy), a policy picks the first free seats unless it overrides
+# candidates().
+#
+# A ticket checked in twice at the same time gets one seat: the claim that loses (on the unique index on the
+# ticketnumber of the seats, or because the ticket has a seat when it runs) returns the seat of the other one.
+
+import random, logging, functools
+
+from flask import current_app
+from sqlalchemy import exc
+from webapp.model import db, Seat
+from webapp import booking, availability, counters
+from webapp.seatmap import seatcode
+
+# candidate seats per claim
+CANDIDATES = 8
+# claims before giving up (when all candidates were taken in the meantime)
+CLAIM_ATTEMPTS = 5
+
+
+# a policy without preferences takes the first free seats of the seat map
+class SeatPolicy(object):
+    name = None
+
+    # indexes of up to count free seats in order of preference (leaving out the seats in the exclude mask)
+    def candidates(self, seats, count, exclude=0):
+        return seats.first_free(count, exclude)
+
+class FrontToBack(SeatPolicy):
+    name = 'front-to-back'
+
+class Spread(SeatPolicy):
+    name = 'spread'
+
+    def candidates(self, seats, count, exclude=0):
+        free = seats.free & ~exclude
+        if not free:
+            return []
+        # the free seats from a random seat on (wrapping around to the first row)
+        start = random.randrange(len(seats.seats))
+        after = availability.free_indexes(free >> start, count)
+        indexes = [start + index for index in after]
+        return indexes + availability.free_indexes(free & ((1 << start) - 1), count - len(indexes))
+
+class Preference(SeatPolicy):
+
+    def __init__(self, kind):
+        self.name = kind
+        self.kind = kind
+
+    def candidates(self, seats, count, exclude=0):
+        preferred = seats.first_free(count, exclude | ~kind_mask(seats.seats, self.kind))
+        if len(preferred) == count:
+            return preferred
+        others = seats.first_free(count - len(preferred), exclude | kind_mask(seats.seats, self.kind))
+        return preferred + others
+
+
+# bitmask of the window or aisle seats of a seat map
+@functools.lru_cache(maxsize=1024)
+def kind_mask(seats, kind):
+    mask = 0
+    for index in getattr(seats, kind):
+        mask |= 1 << index
+    return mask
+
+
+POLICIES = {}
+
+def register(policy):
+    POLICIES[policy.name] = policy
+
+for policy in (FrontToBack(), Spread(), Preference('window'), Preference('aisle')):
+    register(policy)
+
+DEFAULT_POLICY = 'spread'
+
+
+class SeatAllocator(object):
+
+    def __init__(self, policy, candidates=CANDIDATES, attempts=CLAIM_ATTEMPTS):
+        self.policy = policy
+        self.count = candidates
+        self.attempts = attempts
+
+    # claim a free seat of a flight for a valid ticket of the flight without a seat (does not commit)
+    # the caller must not have pending changes, a rejected concurrent claim rolls back the session
+    # returns (seatlabel, seatrow) or None if no seat could be claimed
+    def claim(self, flightnumber, ticketnumber, checkin=True):
+        seats = availability.for_flight(flightnumber)
+        if seats is None:
+            return None
+
+        tried = 0
+        for attempt in range(self.attempts):
+            indexes = self.policy.candidates(seats, self.count, tried)
+            if not indexes:
+                return self.claimed(ticketnumber, checkin)
+            positions = [seats.seats.positions[index] for index in indexes]
+            try:
+                row = db.session.execute(booking.claim_any_statement(flightnumber, ticketnumber, positions, checkin)).first()
+            except exc.IntegrityError:
+                # the unique index on the ticketnumber of the seats rejected the claim: a concurrent check-in
+                # of the same ticket got a seat first (this rolls back the transaction)
+                db.session.rollback()
+                logging.info('Concurrent check-in of ticket ' + str(ticketnumber))
+                return self.claimed(ticketnumber, checkin)
+            if row is not None:
+                counters.add(flightnumber, assigned=1, checkedin=1 if checkin else 0)
+                return row[1], row[2]
+
+            # all candidates were taken or locked: mark the taken ones in the index, try other seats
+            for index in indexes:
+                tried |= 1 << index
+            for seatlabel, seatrow, holder in db.session.execute(booking.seat_holders_query(flightnumber, positions)):
+                if holder is not None:
+                    seats.book(seatcode(seatlabel, seatrow))
+        return self.claimed(ticketnumber, checkin)
+
+    # the seat a concurrent claim got for the ticket (checked in like a seat booked before the check-in),
+    # None if the ticket has no seat
+    def claimed(self, ticketnumber, checkin):
+        seat = db.session.query(Seat.seatlabel, Seat.seatrow).filter_by(ticketnumber=ticketnumber).first()
+        if seat is None:
+            return None
+        if checkin:
+            booking.check_in([ticketnumber])
+        return seat.seatlabel, seat.seatrow
+
+# the allocator for a policy name or the configured policy (None if there is no such policy)
+def allocator(name=None):
+    policy = POLICIES.get(name or current_app.config.get('CHECKIN_SEAT_POLICY', DEFAULT_POLICY))
+    return SeatAllocator(policy) if policy is not None else None
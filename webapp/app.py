@@ -9,14 +9,19 @@ from flask_admin import Admin
 from flask_login import logout_user
 from webapp.model import db, User, Role, UserAdmin, RoleAdmin
 from webapp.resources.Welcome import Welcome
-from webapp.resources.Flight import FlightResource, FlightsResource
+from webapp.resources.Flight import FlightResource, FlightsResource, FlightSearchResource
 from webapp.resources.Aircraft import AircraftResource, AircraftsResource
-from webapp.resources.Ticket import TicketResource, TicketsResource
-from webapp.resources.Seat import SeatResource, SeatsResource
+from webapp.resources.Ticket import TicketResource, TicketsResource, TicketBulkResource
+from webapp.resources.Seat import SeatResource, SeatsResource, SeatBulkResource
 from webapp.resources.User import UserResource
 from webapp.resources.Checkin import CheckinResource
 from webapp.resources.Notification import NotificationResource
+from webapp.resources.Metrics import MetricsResource
 from webapp.auth import auth_blueprint
+from webapp.notifications import relay
+from webapp import cache, tokens, counters, search, conditional
+from webapp.routing import router
+from webapp.principal import principals
 
 
 def create_app():
@@ -28,6 +33,14 @@ def create_app():
         dbname=os.environ['DBNAME']
     )
 
+    # Read replicas (optional) as binds replica0, replica1, ... (see routing.py)
+    replica_uris = dict(('replica' + str(number), 'postgresql+psycopg2://{dbuser}:{dbpass}@{dbhost}/{dbname}'.format(
+        dbuser=os.environ['DBUSER'],
+        dbpass=os.environ['DBPASS'],
+        dbhost=host.strip(),
+        dbname=os.environ['DBNAME']
+    )) for number, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(','))))
+
     # Alternatively, could read from a settings file (config.py):
     # app.config.from_object("config")
 
@@ -36,9 +49,47 @@ def create_app():
     app.config.update(
         SQLALCHEMY_DATABASE_URI=database_uri,
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_BINDS=replica_uris,
+        DB_REPLICA_MAX_LAG=float(os.environ.get('DB_REPLICA_MAX_LAG', 5)),
+        DB_STICKY_SECONDS=float(os.environ.get('DB_STICKY_SECONDS', 10)),
+        # Connection pool per worker process (see pool.py)
+        SQLALCHEMY_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 5)),
+        SQLALCHEMY_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        SQLALCHEMY_POOL_TIMEOUT=int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        SQLALCHEMY_POOL_RECYCLE=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        DB_POOL_PRE_PING=os.environ.get('DB_POOL_PRE_PING', '1') not in ('0', 'false', 'False'),
+        DB_STATEMENT_TIMEOUT=int(os.environ.get('DB_STATEMENT_TIMEOUT', 0)),
+        DB_PGBOUNCER=os.environ.get('DB_PGBOUNCER', '0') not in ('0', 'false', 'False'),
+        # Read-through cache for flight and aircraft lookups (see cache.py)
+        CACHE_BACKEND=os.environ.get('CACHE_BACKEND', 'local'),
+        CACHE_SIZE=int(os.environ.get('CACHE_SIZE', 1024)),
+        CACHE_TTL=int(os.environ.get('CACHE_TTL', 60)),
+        # Cached flight search results (see search.py)
+        SEARCH_CACHE_TTL=int(os.environ.get('SEARCH_CACHE_TTL', 10)),
+        SEARCH_CACHE_SIZE=int(os.environ.get('SEARCH_CACHE_SIZE', 256)),
+        # Cache-Control of the polled reads (see conditional.py)
+        CACHE_CONTROL_FLIGHT=os.environ.get('CACHE_CONTROL_FLIGHT'),
+        CACHE_CONTROL_TICKET=os.environ.get('CACHE_CONTROL_TICKET'),
+        CACHE_CONTROL_NOTIFICATIONS=os.environ.get('CACHE_CONTROL_NOTIFICATIONS'),
+        # Cache of the logged in users and their roles (see principal.py)
+        PRINCIPAL_CACHE_SIZE=int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1024)),
+        PRINCIPAL_CACHE_TTL=int(os.environ.get('PRINCIPAL_CACHE_TTL', 5)),
+        # Bearer tokens for the API (see tokens.py)
+        JWT_KEYS=os.environ.get('JWT_KEYS'),
+        JWT_EXPIRES=int(os.environ.get('JWT_EXPIRES', 900)),
+        # Seat policy for check-in of tickets without a seat (see allocator.py)
+        CHECKIN_SEAT_POLICY=os.environ.get('CHECKIN_SEAT_POLICY', 'spread'),
     )
 
     db.init_app(app)
+    cache.init_app(app)
+    search.init_app(app)
+    conditional.init_app(app)
+    # GET requests read from the replicas
+    router.init_app(app)
+
+    # Move notifications from the outbox in the background
+    relay.init_app(app)
 
     # Initialize database migration management
     migrate = Migrate(app, db)
@@ -53,16 +104,20 @@ def create_app():
     # Routes
     api.add_resource(Welcome, '/welcome')
     api.add_resource(FlightsResource, '/flights')
+    api.add_resource(FlightSearchResource, '/flights/search')
     api.add_resource(FlightResource, '/flight/<string:flightnumber>')
     api.add_resource(AircraftsResource, '/aircrafts')
     api.add_resource(AircraftResource, '/aircraft/<string:aircraft>')
     api.add_resource(TicketsResource, '/ticket')
+    api.add_resource(TicketBulkResource, '/ticket/bulk')
     api.add_resource(TicketResource, '/ticket/<string:ticketnumber>')
     api.add_resource(SeatsResource, '/seat')
+    api.add_resource(SeatBulkResource, '/seat/bulk')
     api.add_resource(SeatResource, '/seat/<string:seatcode>')
     api.add_resource(UserResource, '/user')
     api.add_resource(CheckinResource, '/checkin')
     api.add_resource(NotificationResource, '/ticket/<string:ticketnumber>/notifications')
+    api.add_resource(MetricsResource, '/metrics')
 
     # Secret key for signing session cookies 
     app.config['SECRET_KEY'] = 'coolairlinewebservice"'
@@ -82,6 +137,9 @@ def create_app():
     # Setup Flask-Security
     user_datastore = SQLAlchemyUserDatastore(db, User, Role)
     security = Security(app, user_datastore)
+    # load users and their roles from the principal cache (or from bearer tokens)
+    principals.init_app(app)
+    tokens.init_app(app)
 
     # Executes before the first request is processed
     @app.before_first_request
@@ -120,6 +178,13 @@ def create_app():
                 app.logger.info("Exception:" + str(e))
                 return {"message": 'Exception on before_first_request (the webservice will not be usable!): ' + str(e)}, 400
 
+    # Recompute the seat counters of all flights from their seats and tickets (see counters.py):
+    #   FLASK_APP=webapp.app flask rebuild-counters
+    @app.cli.command('rebuild-counters')
+    def rebuild_counters():
+        fixed = counters.rebuild()
+        print('Rebuilt seat counters, fixed ' + str(len(fixed)) + ' flights: ' + ', '.join(fixed))
+
     # Displays the home page.
     @app.route('/')
     # Users must be authenticated to view the home page, but they don't have to have any particular role.
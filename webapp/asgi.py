@@ -0,0 +1,545 @@
+# Async (ASGI) serving mode for the hot endpoints
+#
+# Under uWSGI every worker blocks on each round trip to PostgreSQL, so a worker process serves one request at a
+# time. This ASGI app serves the hot read and booking endpoints on an event loop with asyncpg, so one worker
+# process keeps many requests (and database connections) in flight:
+#
+#   GET  /v1/flight/<flightnumber>
+#   GET  /v1/ticket/<ticketnumber>
+#   POST /v1/ticket
+#   POST /v1/seat
+#   POST /v1/checkin                            (check-in of one ticket, batches are passed on)
+#   GET  /v1/ticket/<ticketnumber>/notifications
+#
+# Paths, payloads and responses are those of the Flask resources. The statements are built from the models
+# (see asyncdb.py), the schemas, caches, seat maps and availability index are shared with the Flask app.
+# Users log in through the Flask app (/login), the endpoints here accept its session cookie and bearer tokens
+# (see tokens.py). Everything else (other endpoints, requests without a session or without an accepted role,
+# login, admin) is passed on to the Flask app, which runs in the thread pool of the event loop.
+# Reads go to the primary (no replica routing).
+#
+# Needs asyncpg and an ASGI server (in the Pipfile, not used by the uWSGI deployment):
+#   uvicorn webapp.asgi:app --workers 4 --port 8000
+#
+# Database settings as for create_app, the asyncpg pool of a worker process holds up to
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+
+import io, re, sys, json, asyncio, logging, functools
+from datetime import datetime
+
+import asyncpg
+from itsdangerous import BadSignature
+from sqlalchemy import select, bindparam, tuple_, func
+from werkzeug.http import parse_cookie
+from webapp.app import create_app
+from webapp.model import Flight, Aircraft, Ticket, Seat, Notification, NotificationOutbox, User, Role, roles_users, \
+    ticketnumbers, ticketnumber_sequence
+from webapp.asyncdb import Statement, AsyncNumbers, create_pool
+from webapp.cache import FlightRecord, AircraftRecord, MISSING
+from webapp.seatmap import seatmap, seatcode
+from webapp.notifications import relay
+from webapp.principal import principals, Principal, from_claims
+from webapp.allocator import POLICIES, DEFAULT_POLICY, CANDIDATES, CLAIM_ATTEMPTS
+from webapp.resources.Flight import flight_schema
+from webapp.resources.Ticket import ticket_schema
+from webapp.resources.Seat import seat_schema
+from webapp.resources.Notification import notifications_schema
+from webapp import cache, booking, availability, bulk, tokens, counters, conditional
+
+flask_app = create_app()
+
+# only match 7-digit ticket and passport numbers like T123456
+pattern = re.compile("^([A-Z0-9]{7})$")
+
+flights = Flight.__table__
+aircrafts = Aircraft.__table__
+tickets = Ticket.__table__
+seats = Seat.__table__
+notifications = Notification.__table__
+outbox = NotificationOutbox.__table__
+users = User.__table__
+roles = Role.__table__
+
+FLIGHT = Statement(select([flights.c[column] for column in FlightRecord._fields])
+                   .where(flights.c.flightnumber == bindparam('flight')))
+AIRCRAFT = Statement(select([aircrafts.c[column] for column in AircraftRecord._fields])
+                     .where(aircrafts.c.aircraft == bindparam('aircraft')))
+TICKET = Statement(select([tickets]).where(tickets.c.number == bindparam('ticket')))
+TICKET_VERSION = Statement(select([tickets.c.version]).where(tickets.c.number == bindparam('ticket')))
+PASSPORT_BOOKED = Statement(select([tickets.c.id]).where(
+    (tickets.c.passportnumber == bindparam('passport')) & (tickets.c.flightnumber == bindparam('flight')) &
+    (tickets.c.status != 'cancelled')).limit(1))
+RESERVE = Statement(counters.reserve_statement(bindparam('flight')))
+ADD_COUNTERS = Statement(counters.add_statement(bindparam('flight'), assigned=bindparam('assigned'), checkedin=bindparam('checkedin')))
+# Statement does not apply the defaults of the model: the version is given, the id is left to its sequence (RETURNING)
+INSERT_TICKET = Statement(tickets.insert().values(
+    number=bindparam('ticket'), flightnumber=bindparam('flight'), passengername=bindparam('name'),
+    passportnumber=bindparam('passport'), status='valid', version=1).returning(tickets.c.id))
+NOTIFY = Statement(outbox.insert().values(
+    ticketnumber=bindparam('ticket'), title=bindparam('title'), message=bindparam('message'),
+    timestamp=bindparam('timestamp')).returning(outbox.c.id))
+NOTIFICATIONS = Statement(select([notifications.c.title, notifications.c.message, notifications.c.timestamp])
+                          .where(notifications.c.ticketnumber == bindparam('ticket')).order_by(notifications.c.timestamp))
+NOTIFICATIONS_VERSION = Statement(select([func.count(), func.max(notifications.c.timestamp)])
+                                  .where(notifications.c.ticketnumber == bindparam('ticket')))
+CLAIM_SEAT = Statement(booking.claim_statement(bindparam('flight'), bindparam('ticket'), bindparam('label'), bindparam('row')))
+SEAT_REASON = Statement(booking.reason_query(bindparam('flight'), bindparam('ticket'), bindparam('label'), bindparam('row')))
+CHECKIN = Statement(booking.checkin_statement([bindparam('ticket')]))
+SEAT_OF_TICKET = Statement(select([seats.c.id]).where(seats.c.ticketnumber == bindparam('ticket')))
+FREE_SEATS = Statement(select([seats.c.seatlabel, seats.c.seatrow])
+                       .where((seats.c.flightnumber == bindparam('flight')) & (seats.c.ticketnumber == None)))
+PRINCIPAL = Statement(select([users.c.id, users.c.email, users.c.active, users.c.password, roles.c.name]).select_from(
+    users.outerjoin(roles_users, roles_users.c.user_id == users.c.id).outerjoin(roles, roles.c.id == roles_users.c.role_id))
+    .where(users.c.id == bindparam('user')))
+
+# seat positions as parameters label0, row0, label1, row1, ...
+def positions_of(count):
+    return [tuple_(bindparam('label' + str(i)), bindparam('row' + str(i))) for i in range(count)]
+
+def position_params(positions):
+    params = {}
+    for i, (seatlabel, seatrow) in enumerate(positions):
+        params['label' + str(i)] = seatlabel
+        params['row' + str(i)] = seatrow
+    return params
+
+# the statements for a number of candidate seats
+@functools.lru_cache(maxsize=None)
+def claim_any(count):
+    return Statement(booking.claim_any_statement(bindparam('flight'), bindparam('ticket'), positions_of(count), checkin=True))
+
+@functools.lru_cache(maxsize=None)
+def seat_holders(count):
+    return Statement(booking.seat_holders_query(bindparam('flight'), positions_of(count)))
+
+numbers = AsyncNumbers(ticketnumbers, ticketnumber_sequence)
+
+
+# the connection pool of the worker process (created on startup)
+pool = None
+
+async def get_pool():
+    global pool
+    if pool is None:
+        created = await create_pool(flask_app.config)
+        if pool is None:
+            pool = created
+        else:
+            await created.close()
+    return pool
+
+
+# read-through lookups in the caches shared with the Flask app (see cache.py)
+async def get_flight(connection, flightnumber):
+    flight = cache.flights.lookup(flightnumber)
+    if flight is MISSING:
+        row = await FLIGHT.fetchrow(connection, flight=flightnumber)
+        flight = FlightRecord(*row) if row else None
+        cache.flights.store(flightnumber, flight)
+    return flight
+
+async def get_seatmap(connection, aircraftname):
+    aircraft = cache.aircrafts.lookup(aircraftname)
+    if aircraft is MISSING:
+        row = await AIRCRAFT.fetchrow(connection, aircraft=aircraftname)
+        aircraft = AircraftRecord(*row) if row else None
+        cache.aircrafts.store(aircraftname, aircraft)
+    return seatmap(aircraft) if aircraft else None
+
+async def get_availability(connection, flightnumber):
+    seats = availability.loaded(flightnumber)
+    if seats is MISSING:
+        flight = await get_flight(connection, flightnumber)
+        flightseats = await get_seatmap(connection, flight.aircraft) if flight else None
+        if flightseats is None:
+            return None
+        seats = availability.build(flightseats, await FREE_SEATS.fetch(connection, flight=flightnumber))
+        availability.remember(flightnumber, seats)
+    return seats
+
+# create a notification in the current transaction, returns the id of the outbox event
+async def notify(connection, ticketnumber, title, message):
+    return await NOTIFY.fetchval(connection, ticket=ticketnumber, title=title, message=message, timestamp=datetime.utcnow())
+
+
+keys = flask_app.extensions['jwt']
+serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+
+# the user of a bearer token or logged in with the Flask session cookie (None if there is neither),
+# from the principal cache
+async def principal(connection, headers):
+    token = tokens.bearer(headers.get(b'authorization', b'').decode('latin-1'))
+    if token:
+        claims = keys.decode(token) if keys is not None else None
+        return from_claims(claims) if claims else None
+
+    cookie = parse_cookie(headers.get(b'cookie', b'')).get(flask_app.session_cookie_name)
+    if not cookie:
+        return None
+    try:
+        user_id = serializer.loads(cookie, max_age=max_age).get('user_id')
+    except BadSignature:
+        return None
+    if user_id is None:
+        return None
+    user = principals.lookup(user_id)
+    if user is MISSING:
+        rows = await PRINCIPAL.fetch(connection, user=int(user_id))
+        user = Principal(*rows[0][:4], roles=[row['name'] for row in rows if row['name']]) if rows else None
+        principals.store(user_id, user)
+    return user
+
+
+# the request is passed on to the Flask app
+FLASK = object()
+
+class BadRequest(Exception):
+    pass
+
+def json_body(body):
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise BadRequest('Failed to decode JSON object')
+
+
+# the If-None-Match header of a request
+def if_none_match(headers):
+    return headers.get(b'if-none-match', b'').decode('latin-1')
+
+# Get a flight by flightnumber (FlightResource.get)
+async def get_flight_resource(connection, body, headers, flightnumber):
+    flight = await get_flight(connection, flightnumber)
+    if flight is None:
+        return {'message': 'No flight found with number ' + str(flightnumber)}, 404
+    tag = conditional.etag(flight.flightnumber, flight.version)
+    if conditional.matches(if_none_match(headers), tag):
+        return None, 304, conditional.headers('flight', tag)
+    return flight_schema.dump(flight).data, 200, conditional.headers('flight', tag)
+
+# Get a ticket by ticketnumber (TicketResource.get, which returns the data and errors of the dump)
+async def get_ticket_resource(connection, body, headers, ticketnumber):
+    if not pattern.match(ticketnumber):
+        return {'message': 'Please enter a valid 7-digit ticketnumber (only numbers and uppercase characters) !'}, 400
+    if if_none_match(headers):
+        version = await TICKET_VERSION.fetchval(connection, ticket=ticketnumber)
+        tag = conditional.etag(ticketnumber, version)
+        if version is not None and conditional.matches(if_none_match(headers), tag):
+            return None, 304, conditional.headers('ticket', tag)
+    ticket = await TICKET.fetchrow(connection, ticket=ticketnumber)
+    if ticket is None:
+        return {'message': 'No ticket found with number ' + ticketnumber}, 400
+    return ticket_schema.dump(ticket), 200, conditional.headers('ticket', conditional.etag(ticket['number'], ticket['version']))
+
+# Book a ticket (TicketsResource.post)
+async def post_ticket(connection, body, headers):
+    json_data = json_body(body)
+    if not json_data:
+        return {'message': 'No input data provided'}, 400
+    data, errors = ticket_schema.load(json_data, partial=True)
+    if errors:
+        return {"message": "error", "data": errors}, 422
+
+    # input validation
+    if not all(k in data for k in ("flightnumber", "passengername", "passportnumber")):
+        return {'message': 'Please provide flightnumber, passengername and passportnumber !'}, 404
+    elif not pattern.match(data["passportnumber"]):
+        return {'message': 'Please provide valid passportnumber (7-digit numbers and uppercase characters) !'}, 404
+
+    try:
+        # only one ticket (that is not canceled) per passport for a flight
+        if await PASSPORT_BOOKED.fetchval(connection, passport=data['passportnumber'], flight=data['flightnumber']):
+            return {'message': 'Passport-number already booked a ticket for this flight'}, 404
+
+        flight = await get_flight(connection, data['flightnumber'])
+        if flight is None:
+            return {'message': 'Flight does not exist'}, 400
+        seats = await get_seatmap(connection, flight.aircraft)
+        if seats is None:
+            return {'message': 'Ticket containing invalid aircraft'}, 400
+
+        # seat reservation, ticket and notification in one transaction
+        async with connection.transaction():
+            # are there tickets left for flight? (conditional update of the seat counters)
+            if await RESERVE.fetchval(connection, flight=flight.flightnumber) is None:
+                return {'message': 'No more seats left for this flight'}, 404
+            ticketnumber = await numbers.allocate(connection)
+            await INSERT_TICKET.execute(connection, ticket=ticketnumber, flight=flight.flightnumber,
+                                        name=data['passengername'], passport=data['passportnumber'])
+            notificationstring = "Your ticket booking " + ticketnumber + " is successful."
+            logging.info(notificationstring)
+            event = await notify(connection, ticketnumber, "Booking Successful", notificationstring)
+        relay.enqueue([event])
+        return {"Location": '/v1/ticket/' + ticketnumber}, 200
+
+    except Exception as e:
+        logging.info("Exception:" + str(e))
+        return {'message': 'Exception on ticket creation: ' + str(e)}, 400
+
+# Book a seat for a ticket with a single conditional update (SeatsResource.post)
+async def post_seat(connection, body, headers):
+    json_data = json_body(body)
+    if not json_data:
+        return {'message': 'No input data provided'}, 400
+    data, errors = seat_schema.load(json_data)
+    if errors:
+        return errors, 422
+    if not all(k in data for k in ("ticketnumber", "flightnumber", "seatlabel", "seatrow")):
+        return {'error': 'Please provide ticketnumber, flightnumber, seatlabel and seatrow !'}, 404
+
+    flight = await get_flight(connection, data['flightnumber'])
+    if not flight:
+        return {'message': 'Flight number does not exist'}, 422
+    seats = await get_seatmap(connection, flight.aircraft)
+    if seats is None or seatcode(data['seatlabel'], data['seatrow']) not in seats:
+        return {'message': 'Seat does not exist'}, 422
+
+    params = dict(flight=flight.flightnumber, ticket=data['ticketnumber'], label=data['seatlabel'], row=int(data['seatrow']))
+    try:
+        # the seat and its notification in one transaction
+        async with connection.transaction():
+            claimed = await CLAIM_SEAT.fetchrow(connection, **params)
+            if claimed is not None:
+                await ADD_COUNTERS.execute(connection, flight=flight.flightnumber, assigned=1, checkedin=0)
+                notificationstring = "Seat " + data['seatlabel'] + data['seatrow'] + " is booked for your ticket " + data['ticketnumber'] + "."
+                logging.info(notificationstring)
+                event = await notify(connection, data['ticketnumber'], "Seat Booking", notificationstring)
+
+        if claimed is None:
+            result = booking.reason(data['ticketnumber'], *(await SEAT_REASON.fetchrow(connection, **params)))
+            if result == booking.TAKEN:
+                availability.booked(flight.flightnumber, data['seatlabel'], data['seatrow'])
+            return {'message': bulk.SEAT_MESSAGES[result]}, 422
+
+    except asyncpg.UniqueViolationError:
+        # the unique index on the ticketnumber of the seats rejected a concurrent claim of another seat
+        logging.info('Concurrent seat claim for ticket ' + data['ticketnumber'])
+        return {'message': bulk.SEAT_MESSAGES[booking.ALREADY_BOOKED]}, 422
+    except asyncpg.PostgresError as e:
+        logging.info("Exception:" + str(e))
+        return {"Error": 'Invalid seatlabel or seatrow selected! (Only A-H for seatlabel and one numeric digit for seatrow allowed)'}, 404
+
+    relay.enqueue([event])
+    availability.booked(flight.flightnumber, data['seatlabel'], data['seatrow'])
+    return {"Location": '/v1/seat/' + data['ticketnumber'] + '-' + data['seatlabel'] + data['seatrow']}, 200
+
+# Check in a ticket (CheckinResource.post), a ticket without a seat gets a free seat following the seat policy
+async def post_checkin(connection, body, headers):
+    json_data = json_body(body)
+    if not json_data or not isinstance(json_data, dict):
+        return {'message': 'No input data provided'}, 400
+    # batch check-in
+    if "tickets" in json_data or "booking-number" in json_data:
+        return FLASK
+
+    policy = POLICIES.get(json_data.get('seat-preference') or flask_app.config.get('CHECKIN_SEAT_POLICY', DEFAULT_POLICY))
+    if policy is None:
+        return {'message': 'Unknown seat-preference, please choose one of ' + ', '.join(sorted(POLICIES))}, 400
+    if not all(k in json_data for k in ("ticket-number", "flight-number")):
+        return {'message': 'Please provide ticket-number and flight-number!'}, 404
+
+    try:
+        ticket = await TICKET.fetchrow(connection, ticket=json_data['ticket-number'])
+        flight = await get_flight(connection, json_data['flight-number'])
+        if ticket is None:
+            return {'message': 'Ticket does not exist !'}, 400
+        if flight is None:
+            return {'message': 'Flight does not exist !'}, 400
+        if not ticket['status'] == "valid" or not flight.status == "valid":
+            return {'message': 'Either flight or ticket are invalid!'}, 400
+        if ticket['flightnumber'] != flight.flightnumber:
+            return {'message': 'Ticket is not booked for this flight'}, 400
+
+        # check in the seat of the ticket, or claim a free seat
+        claimed = None
+        if not await check_in_seat(connection, flight.flightnumber, ticket['number']):
+            try:
+                async with connection.transaction():
+                    claimed = await claim_free_seat(connection, policy, flight.flightnumber, ticket['number'])
+            except asyncpg.UniqueViolationError:
+                # the unique index on the ticketnumber of the seats rejected the claim: a concurrent check-in
+                # of the same ticket got a seat first
+                logging.info('Concurrent check-in of ticket ' + ticket['number'])
+            # nothing claimed: checked in concurrently (same result as SeatAllocator.claim) or no seat left
+            if claimed is None and not await check_in_seat(connection, flight.flightnumber, ticket['number']):
+                return {'message': 'No more seats available on flight!'}, 400
+        if claimed is not None:
+            availability.booked(flight.flightnumber, *claimed)
+        return {"Location": '/v1/ticket/' + ticket['number']}, 200
+
+    except Exception as e:
+        logging.info("Exception:" + str(e))
+        return {'message': 'Exception on seat creation: ' + str(e)}, 400
+
+# check in the seat of a ticket, False if the ticket has no seat
+async def check_in_seat(connection, flightnumber, ticketnumber):
+    async with connection.transaction():
+        if await CHECKIN.fetchval(connection, ticket=ticketnumber) is not None:
+            await ADD_COUNTERS.execute(connection, flight=flightnumber, assigned=0, checkedin=1)
+            return True
+        return await SEAT_OF_TICKET.fetchval(connection, ticket=ticketnumber) is not None
+
+# claim a free seat of a flight for a ticket and check it in (same as SeatAllocator.claim)
+async def claim_free_seat(connection, policy, flightnumber, ticketnumber):
+    seats = await get_availability(connection, flightnumber)
+    if seats is None:
+        return None
+
+    tried = 0
+    for attempt in range(CLAIM_ATTEMPTS):
+        indexes = policy.candidates(seats, CANDIDATES, tried)
+        if not indexes:
+            return None
+        positions = [seats.seats.positions[index] for index in indexes]
+        params = position_params(positions)
+        row = await claim_any(len(positions)).fetchrow(connection, flight=flightnumber, ticket=ticketnumber, **params)
+        if row is not None:
+            await ADD_COUNTERS.execute(connection, flight=flightnumber, assigned=1, checkedin=1)
+            return row[1], row[2]
+
+        # all candidates were taken or locked: mark the taken ones in the index, try other seats
+        for index in indexes:
+            tried |= 1 << index
+        for seatlabel, seatrow, holder in await seat_holders(len(positions)).fetch(connection, flight=flightnumber, **params):
+            if holder is not None:
+                seats.book(seatcode(seatlabel, seatrow))
+    return None
+
+# Get the notifications of a ticket (NotificationResource.get)
+async def get_notifications(connection, body, headers, ticketnumber):
+    if not pattern.match(ticketnumber):
+        return {'message': 'Please specifiy a 7-digit ticketnumber (containing only numbers and uppercase characters) !'}, 404
+    count, latest = await NOTIFICATIONS_VERSION.fetchrow(connection, ticket=ticketnumber)
+    tag = conditional.etag(count, latest.isoformat() if latest else '')
+    if count and conditional.matches(if_none_match(headers), tag):
+        return None, 304, conditional.headers('notifications', tag)
+    rows = await NOTIFICATIONS.fetch(connection, ticket=ticketnumber)
+    if rows:
+        return notifications_schema.dump(rows, many=True).data, 200, conditional.headers('notifications', tag)
+    return {'message': 'No notifications found for ticketnumber ' + ticketnumber}, 200
+
+
+# method, path, accepted roles (None: any logged in user), handler(connection, body, headers, *groups)
+ROUTES = [
+    ('GET', re.compile(r'^/v1/flight/([^/]+)$'), ('admin', 'customer'), get_flight_resource),
+    ('GET', re.compile(r'^/v1/ticket/([^/]+)/notifications$'), ('admin', 'customer'), get_notifications),
+    ('GET', re.compile(r'^/v1/ticket/([^/]+)$'), None, get_ticket_resource),
+    ('POST', re.compile(r'^/v1/ticket$'), None, post_ticket),
+    ('POST', re.compile(r'^/v1/seat$'), None, post_seat),
+    ('POST', re.compile(r'^/v1/checkin$'), ('admin', 'customer'), post_checkin),
+]
+
+# (status, headers, body) of a handler result, without a body for None (304)
+def json_response(payload, status, extra=None):
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (extra or {}).items()]
+    if payload is None:
+        return status, headers, b''
+    body = json.dumps(payload).encode('utf-8')
+    return status, [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + headers, body
+
+# serve a request with one of the routes, returns (status, headers, body) or FLASK
+async def serve(scope, body):
+    for method, path, accepted, handler in ROUTES:
+        match = path.match(scope['path'])
+        if method == scope['method'] and match:
+            break
+    else:
+        return FLASK
+
+    async with (await get_pool()).acquire() as connection:
+        headers = dict(scope['headers'])
+        user = await principal(connection, headers)
+        if user is None or (accepted and not user.rolenames.intersection(accepted)):
+            return FLASK
+        try:
+            result = await handler(connection, body, headers, *match.groups())
+        except BadRequest as e:
+            return json_response({'message': str(e)}, 400)
+        except Exception:
+            logging.exception('Exception on ' + scope['method'] + ' ' + scope['path'])
+            return json_response({'message': 'Internal Server Error'}, 500)
+    return FLASK if result is FLASK else json_response(*result)
+
+
+# run the Flask app for a request (in a thread), returns (status, headers, body)
+def call_flask(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('127.0.0.1', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    # the whole response is collected (NDJSON exports are not streamed in this mode)
+    chunks = flask_app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await get_pool()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if pool is not None:
+                await pool.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body = b''.join(chunks)
+
+    response = await serve(scope, body)
+    if response is FLASK:
+        response = await asyncio.get_event_loop().run_in_executor(None, call_flask, scope, body)
+    status, headers, body = response
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,96 @@
+# Core statements for asyncpg (used by the ASGI app, see asgi.py)
+#
+# The statements are built from the models with SQLAlchemy Core (mostly the builders of booking.py, with
+# bindparam() placeholders instead of values) and compiled once for PostgreSQL with asyncpg placeholders ($1, $2, ...).
+# Executing a statement only orders its parameters by name, so no SQL is compiled per request.
+#
+# asyncpg is imported when the pool is created, compiling statements does not need it.
+
+import os, json
+
+from sqlalchemy.dialects.postgresql.base import PGDialect, PGCompiler
+
+
+# bind parameters as $1, $2, ... (numeric paramstyle renders :1, :2, ...)
+class AsyncpgCompiler(PGCompiler):
+
+    def bindparam_string(self, name, **kw):
+        return PGCompiler.bindparam_string(self, name, **kw).replace(':[_POSITION]', '$[_POSITION]')
+
+class AsyncpgDialect(PGDialect):
+    statement_compiler = AsyncpgCompiler
+
+dialect = AsyncpgDialect(paramstyle='numeric')
+
+
+# a compiled statement: the SQL and the names of its parameters in order
+# parameters without a value (bindparam('name')) are passed by name on execution, all others keep their value
+class Statement(object):
+
+    def __init__(self, statement):
+        compiled = statement.compile(dialect=dialect)
+        self.sql = compiled.string
+        self.names = tuple(compiled.positiontup)
+        self.values = dict((name, bind.effective_value) for name, bind in compiled.binds.items())
+
+    def args(self, params):
+        return [params[name] if name in params else self.values[name] for name in self.names]
+
+    async def fetch(self, connection, **params):
+        return await connection.fetch(self.sql, *self.args(params))
+
+    async def fetchrow(self, connection, **params):
+        return await connection.fetchrow(self.sql, *self.args(params))
+
+    async def fetchval(self, connection, **params):
+        return await connection.fetchval(self.sql, *self.args(params))
+
+    async def execute(self, connection, **params):
+        return await connection.execute(self.sql, *self.args(params))
+
+
+# hands out the numbers of blocks reserved from a sequence, like numbering.NumberAllocator
+# (the event loop runs one coroutine at a time, so no lock is needed)
+class AsyncNumbers(object):
+
+    def __init__(self, allocator, sequence):
+        self.codec = allocator.codec
+        self.block = allocator.block
+        self.fetch = Statement(sequence.next_value().select())
+        self.next = 0
+        self.end = 0
+        self.pid = None
+
+    async def allocate(self, connection):
+        if self.next >= self.end or self.pid != os.getpid():
+            start = await self.fetch.fetchval(connection)
+            self.next, self.end, self.pid = start, start + self.block, os.getpid()
+        value = self.next
+        self.next += 1
+        return self.codec.encode(value)
+
+
+# json columns as Python objects (like psycopg2)
+async def init_connection(connection):
+    await connection.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+# connection pool with the database and pool settings of the Flask app (see create_app and pool.py)
+async def create_pool(config):
+    import asyncpg
+
+    options = {}
+    timeout = int(config.get('DB_STATEMENT_TIMEOUT') or 0)
+    if config.get('DB_PGBOUNCER'):
+        # PgBouncer in transaction pooling mode does not keep prepared statements
+        options['statement_cache_size'] = 0
+    elif timeout:
+        options['server_settings'] = {'statement_timeout': str(timeout)}
+
+    return await asyncpg.create_pool(
+        config['SQLALCHEMY_DATABASE_URI'].replace('postgresql+psycopg2://', 'postgresql://', 1),
+        min_size=1,
+        max_size=config.get('SQLALCHEMY_POOL_SIZE', 5) + config.get('SQLALCHEMY_MAX_OVERFLOW', 10),
+        max_inactive_connection_lifetime=config.get('SQLALCHEMY_POOL_RECYCLE', 1800),
+        init=init_connection,
+        **options
+    )
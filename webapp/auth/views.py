@@ -3,8 +3,10 @@
 from . import auth_blueprint
 
 from flask.views import MethodView
-from flask import make_response, request, jsonify
-from webapp.model import User
+from flask import make_response, request, jsonify, current_app
+from flask_security.utils import verify_and_update_password
+from webapp.model import db, User
+from webapp import tokens
 
 
 class RegistrationView(MethodView):
@@ -54,3 +56,38 @@ auth_blueprint.add_url_rule(
     '/auth/register',
     view_func=registration_view,
     methods=['POST'])
+
+
+class TokenView(MethodView):
+    """This class issues bearer tokens for the API."""
+
+    def post(self):
+        """Handle POST request for this view. Url ---> /auth/token"""
+
+        if tokens.keyset() is None:
+            return make_response(jsonify({'message': 'Bearer tokens are not enabled'})), 404
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not data.get('email') or not data.get('password'):
+            return make_response(jsonify({'message': 'Please provide email and password'})), 400
+
+        user = User.query.filter_by(email=data['email']).first()
+        if not user or not user.active or not user.password or not verify_and_update_password(data['password'], user):
+            return make_response(jsonify({'message': 'Invalid email or password'})), 401
+        # store a rehashed password
+        db.session.commit()
+
+        response = {
+            'access-token': user.generate_token(),
+            'token-type': 'Bearer',
+            'expires-in': current_app.config.get('JWT_EXPIRES', 900)
+        }
+        return make_response(jsonify(response)), 200
+
+
+token_view = TokenView.as_view('token_view')
+# Define the rule for the token url --->  /auth/token
+auth_blueprint.add_url_rule(
+    '/auth/token',
+    view_func=token_view,
+    methods=['POST'])
@@ -0,0 +1,176 @@
+# Seat availability index per flight
+#
+# The free seats of a flight are kept as a bitset over the seat map of its aircraft (bit i is set while seat i
+# of the seat map is free). The bitset is built from the database on first use and updated by every
+# booking, release and check-in of this worker process:
+#
+#   is_free(code)    O(1)
+#   left()           O(1)
+#   next_free(near)  O(words) - the free seat closest to a seat (in seat map order) or the first free seat
+#   find_group(n)    O(n * words) - n free adjacent seats (in one block of a row), shift-and-AND over the bitset
+#   first_free(n)    O(n + words) - the first n free seats (front to back)
+#
+# The index is a hint: the conditional updates of the booking engine stay the authority. Bookings of other
+# worker processes are picked up when the index of a flight is rebuilt (after REFRESH_INTERVAL) or when a claim
+# of a seat that looked free fails.
+
+import threading, functools
+
+from webapp.model import db, Seat
+from webapp.cache import LocalCache, MISSING, get_flight
+from webapp.seatmap import seatmap_for, seatcode
+
+REFRESH_INTERVAL = 30   # seconds
+MAX_FLIGHTS = 10000
+
+
+class SeatAvailability(object):
+
+    def __init__(self, seats, free):
+        self.seats = seats
+        self.free = free
+        self.count = bin(free).count('1')
+        self.lock = threading.Lock()
+
+    def index(self, code):
+        return self.seats.index(code)
+
+    def is_free(self, code):
+        index = self.seats.index(code)
+        return index is not None and bool((self.free >> index) & 1)
+
+    def left(self):
+        return self.count
+
+    # index of the free seat closest to the seat with the given index (or of the first free seat)
+    def next_free(self, near=None):
+        free = self.free
+        if not free:
+            return None
+        if near is None:
+            return (free & -free).bit_length() - 1
+
+        above = free >> near
+        below = free & ((1 << near) - 1)
+        after = near + (above & -above).bit_length() - 1 if above else None
+        before = below.bit_length() - 1 if below else None
+        if before is None or (after is not None and after - near <= near - before):
+            return after
+        return before
+
+    # indexes of the first n free seats, leaving out the seats in the exclude mask
+    def first_free(self, n, exclude=0):
+        return free_indexes(self.free & ~exclude, n)
+
+    # indexes of n free seats for a group: the first n adjacent seats in a block of a row,
+    # otherwise the n free seats with the smallest distance between the first and the last (neighbouring rows)
+    def find_group(self, n):
+        free = self.free
+        if n < 1 or n > self.count:
+            return None
+
+        # bit i of runs is set if the seats i .. i+n-1 are free and in the same block
+        runs = group_starts(self.seats, n)
+        for shift in range(n):
+            if not runs:
+                break
+            runs &= free >> shift
+        if runs:
+            start = (runs & -runs).bit_length() - 1
+            return list(range(start, start + n))
+
+        indexes = free_indexes(free)
+        first = min(range(len(indexes) - n + 1), key=lambda i: indexes[i + n - 1] - indexes[i])
+        return indexes[first:first + n]
+
+    def book(self, code):
+        self.set(code, False)
+
+    def release(self, code):
+        self.set(code, True)
+
+    def set(self, code, free):
+        index = self.seats.index(code)
+        if index is None:
+            return
+        with self.lock:
+            if bool((self.free >> index) & 1) == free:
+                return
+            self.free ^= 1 << index
+            self.count += 1 if free else -1
+
+
+# bitmask of the seats that start n adjacent seats in a block (seats of a block have consecutive indexes)
+@functools.lru_cache(maxsize=1024)
+def group_starts(seats, n):
+    mask = 0
+    for block in seats.blocks:
+        for index in block[:len(block) - n + 1]:
+            mask |= 1 << index
+    return mask
+
+# indexes of the set bits (the lowest limit ones)
+def free_indexes(free, limit=None):
+    indexes = []
+    while free and len(indexes) != limit:
+        lowest = free & -free
+        indexes.append(lowest.bit_length() - 1)
+        free ^= lowest
+    return indexes
+
+
+# build the index of a flight from its free seats in the database
+def load(flightnumber):
+    flight = get_flight(flightnumber)
+    if flight is None:
+        return None
+    seats = seatmap_for(flight.aircraft)
+    if seats is None:
+        return None
+
+    return build(seats, db.session.query(Seat.seatlabel, Seat.seatrow)
+                 .filter(Seat.flightnumber == flightnumber, Seat.ticketnumber == None))
+
+# the index of a seat map from the (seatlabel, seatrow) of the free seats
+def build(seats, positions):
+    free = 0
+    for seatlabel, seatrow in positions:
+        index = seats.index(seatcode(seatlabel, seatrow))
+        if index is not None:
+            free |= 1 << index
+    return SeatAvailability(seats, free)
+
+
+# indexes of the recently used flights, rebuilt after REFRESH_INTERVAL
+_flights = LocalCache(maxsize=MAX_FLIGHTS, ttl=REFRESH_INTERVAL)
+
+# the availability index of a flight (None if the flight does not exist)
+def for_flight(flightnumber):
+    availability = _flights.get(flightnumber)
+    if availability is MISSING:
+        availability = load(flightnumber)
+        if availability is not None:
+            _flights.set(flightnumber, availability)
+    return availability
+
+# the index of a flight if it is loaded (MISSING otherwise) and storing an index built elsewhere (see asgi.py)
+def loaded(flightnumber):
+    return _flights.get(flightnumber)
+
+def remember(flightnumber, availability):
+    _flights.set(flightnumber, availability)
+
+# update the index of a flight (if it is loaded) after a seat was booked or released
+def booked(flightnumber, seatlabel, seatrow):
+    availability = _flights.get(flightnumber)
+    if availability is not MISSING:
+        availability.book(seatcode(seatlabel, seatrow))
+
+def released(flightnumber, seatlabel, seatrow):
+    availability = _flights.get(flightnumber)
+    if availability is not MISSING:
+        availability.release(seatcode(seatlabel, seatrow))
+
+# drop the index of a flight (e.g. when the flight is cancelled)
+def forget(flightnumber):
+    _flights.delete(flightnumber)
@@ -0,0 +1,242 @@
+# Booking engine: claims seats with a single conditional UPDATE
+#
+# A seat is claimed with one statement that only updates the seat if it is still free, the ticket is valid,
+# booked for the flight of the seat and has no other seat. Concurrent claims for the same seat are serialized by the row lock of the seat
+# (the losers see the updated row and claim nothing), so a seat can never be booked twice.
+# Only when nothing was claimed a second query finds out why.
+# Claims, releases and check-ins also update the seat counters of the flight (see counters.py).
+
+import logging
+
+from sqlalchemy import and_, exists, select, exc, case, tuple_, literal_column
+from webapp.model import db, Seat, Ticket
+from webapp import counters
+
+# results of a seat claim
+BOOKED = 'booked'
+TAKEN = 'taken'
+NONEXISTENT = 'nonexistent'
+ALREADY_BOOKED = 'already booked'
+ALREADY_BOOKED_SEAT = 'already booked for requested seat'
+INVALID_TICKET = 'invalid ticket'
+OTHER_FLIGHT = 'other flight'
+
+seats = Seat.__table__
+tickets = Ticket.__table__
+
+
+# WITH claimed AS (UPDATE seats SET ticketnumber=... WHERE ... AND ticketnumber IS NULL RETURNING ...)
+# UPDATE tickets SET seat_id=claimed.id FROM claimed WHERE tickets.number = claimed.ticketnumber RETURNING claimed.id
+def claim_statement(flightnumber, ticketnumber, seatlabel, seatrow, checkin=False):
+    other = seats.alias('other')
+    values = dict(ticketnumber=ticketnumber, checkinstatus=True) if checkin else dict(ticketnumber=ticketnumber)
+    claimed = seats.update().where(and_(
+        seats.c.flightnumber == flightnumber,
+        seats.c.seatlabel == seatlabel,
+        seats.c.seatrow == seatrow,
+        seats.c.ticketnumber == None,
+        ~exists().where(other.c.ticketnumber == ticketnumber),
+        exists().where(and_(tickets.c.number == ticketnumber, tickets.c.flightnumber == flightnumber, tickets.c.status == 'valid'))
+    )).values(**values).returning(seats.c.id, seats.c.ticketnumber).cte('claimed')
+
+    return tickets.update().values(seat_id=claimed.c.id).where(
+        tickets.c.number == claimed.c.ticketnumber).returning(claimed.c.id)
+
+# claim a seat of a flight for a ticket and store the seat on the ticket (does not commit)
+# the caller must not have pending changes, a rejected concurrent claim rolls back the session
+# (checkin=True also checks in the ticket) returns (result, seat id)
+def claim_seat(flightnumber, ticketnumber, seatlabel, seatrow, checkin=False):
+    try:
+        row = db.session.execute(claim_statement(flightnumber, ticketnumber, seatlabel, seatrow, checkin)).first()
+    except exc.IntegrityError:
+        # the unique index on the ticketnumber of the seats rejected a concurrent claim
+        # of another seat for the same ticket (this rolls back the transaction)
+        db.session.rollback()
+        logging.info('Concurrent seat claim for ticket ' + str(ticketnumber))
+        return ALREADY_BOOKED, None
+
+    if row is not None:
+        counters.add(flightnumber, assigned=1, checkedin=1 if checkin else 0)
+        return BOOKED, row[0]
+    return unclaimed_reason(flightnumber, ticketnumber, seatlabel, seatrow), None
+
+# valid ticket? booked for the flight? requested seat exists? who holds it? has the ticket a seat?
+def reason_query(flightnumber, ticketnumber, seatlabel, seatrow):
+    requested = and_(seats.c.flightnumber == flightnumber, seats.c.seatlabel == seatlabel, seats.c.seatrow == seatrow)
+    return select([
+        exists().where(and_(tickets.c.number == ticketnumber, tickets.c.status == 'valid')).label('valid'),
+        exists().where(and_(tickets.c.number == ticketnumber, tickets.c.flightnumber == flightnumber)).label('onflight'),
+        exists().where(requested).label('seat'),
+        select([seats.c.ticketnumber]).where(requested).limit(1).as_scalar().label('holder'),
+        exists().where(seats.c.ticketnumber == ticketnumber).label('booked'),
+    ])
+
+# find out why a seat could not be claimed (one query)
+def unclaimed_reason(flightnumber, ticketnumber, seatlabel, seatrow):
+    valid, onflight, seat, holder, booked = db.session.execute(reason_query(flightnumber, ticketnumber, seatlabel, seatrow)).first()
+    return reason(ticketnumber, valid, onflight, seat, holder, booked)
+
+# the reason from the result of the reason query
+def reason(ticketnumber, valid, onflight, seat, holder, booked):
+    if not valid:
+        return INVALID_TICKET
+    if not onflight:
+        return OTHER_FLIGHT
+    if booked:
+        return ALREADY_BOOKED_SEAT if holder == ticketnumber else ALREADY_BOOKED
+    if not seat:
+        return NONEXISTENT
+    # taken by someone else (or released again in the meantime)
+    return TAKEN
+
+
+# release the seat of a ticket (only if it is the given seat, if any), the seat is free and not checked in afterwards
+# the seat is locked first, so the check-in status before the release can be returned:
+#   WITH released AS (SELECT id, checkinstatus FROM seats WHERE ticketnumber=... FOR UPDATE)
+#   UPDATE seats SET ticketnumber=NULL, checkinstatus=false FROM released WHERE seats.id = released.id
+#   RETURNING flightnumber, seatlabel, seatrow, released.checkinstatus
+def release_statement(ticketnumber, seatlabel=None, seatrow=None):
+    condition = seats.c.ticketnumber == ticketnumber
+    if seatlabel is not None:
+        condition = and_(condition, seats.c.seatlabel == seatlabel, seats.c.seatrow == seatrow)
+    released = select([seats.c.id, seats.c.checkinstatus]).where(condition).with_for_update().cte('released')
+    return seats.update().where(seats.c.id == released.c.id).values(ticketnumber=None, checkinstatus=False) \
+        .returning(seats.c.flightnumber, seats.c.seatlabel, seats.c.seatrow, released.c.checkinstatus)
+
+# release the seat of a ticket and update the counters of its flight (does not commit)
+# returns (flightnumber, seatlabel, seatrow) of the released seat, None if the ticket had no (such) seat
+def release_seat(ticketnumber, seatlabel=None, seatrow=None):
+    row = db.session.execute(release_statement(ticketnumber, seatlabel, seatrow)).first()
+    if row is None:
+        return None
+    counters.add(row[0], assigned=-1, checkedin=-1 if row[3] else 0)
+    return row[0], row[1], row[2]
+
+
+# claim the first free seat of a list of candidate seats (in order of preference) for a ticket
+# rows locked by concurrent claims are skipped instead of waited for, so concurrent check-ins never block
+# on the same seat:
+#   WITH candidate AS (SELECT id FROM seats WHERE ... ORDER BY <preference> LIMIT 1 FOR UPDATE SKIP LOCKED),
+#   claimed AS (UPDATE seats SET ticketnumber=... FROM candidate WHERE seats.id = candidate.id AND ... RETURNING ...)
+#   UPDATE tickets SET seat_id=claimed.id FROM claimed WHERE ... RETURNING claimed.id, claimed.seatlabel, claimed.seatrow
+def claim_any_statement(flightnumber, ticketnumber, positions, checkin=False):
+    other = seats.alias('other')
+    # the ranks are rendered inline (a bound parameter as the result of a CASE has no type for asyncpg)
+    preference = case([
+        (and_(seats.c.seatlabel == seatlabel, seats.c.seatrow == seatrow), literal_column(str(rank)))
+        for rank, (seatlabel, seatrow) in enumerate(positions)
+    ])
+    candidate = select([seats.c.id]).where(and_(
+        seats.c.flightnumber == flightnumber,
+        tuple_(seats.c.seatlabel, seats.c.seatrow).in_(positions),
+        seats.c.ticketnumber == None
+    )).order_by(preference).limit(1).with_for_update(skip_locked=True).cte('candidate')
+
+    values = dict(ticketnumber=ticketnumber, checkinstatus=True) if checkin else dict(ticketnumber=ticketnumber)
+    claimed = seats.update().where(and_(
+        seats.c.id == candidate.c.id,
+        ~exists().where(other.c.ticketnumber == ticketnumber),
+        exists().where(and_(tickets.c.number == ticketnumber, tickets.c.flightnumber == flightnumber, tickets.c.status == 'valid'))
+    )).values(**values).returning(seats.c.id, seats.c.ticketnumber, seats.c.seatlabel, seats.c.seatrow).cte('claimed')
+
+    return tickets.update().values(seat_id=claimed.c.id).where(
+        tickets.c.number == claimed.c.ticketnumber).returning(claimed.c.id, claimed.c.seatlabel, claimed.c.seatrow)
+
+# claim the seats of a group in one statement, assignments are (ticketnumber, seatlabel, seatrow)
+# same conditions as claim_statement for every seat, the ticketnumber of a seat is picked with a CASE on the seat
+# returns the ticketnumbers that got their seat
+def claim_group_statement(flightnumber, assignments, checkin=False):
+    other = seats.alias('other')
+    ticketnumber = case([
+        (and_(seats.c.seatlabel == seatlabel, seats.c.seatrow == seatrow), number)
+        for number, seatlabel, seatrow in assignments
+    ])
+    values = dict(ticketnumber=ticketnumber, checkinstatus=True) if checkin else dict(ticketnumber=ticketnumber)
+    claimed = seats.update().where(and_(
+        seats.c.flightnumber == flightnumber,
+        tuple_(seats.c.seatlabel, seats.c.seatrow).in_([(seatlabel, seatrow) for number, seatlabel, seatrow in assignments]),
+        seats.c.ticketnumber == None,
+        ~exists().where(other.c.ticketnumber == ticketnumber),
+        exists().where(and_(tickets.c.number == ticketnumber, tickets.c.flightnumber == flightnumber, tickets.c.status == 'valid'))
+    )).values(**values).returning(seats.c.id, seats.c.ticketnumber).cte('claimed')
+
+    return tickets.update().values(seat_id=claimed.c.id).where(
+        tickets.c.number == claimed.c.ticketnumber).returning(claimed.c.ticketnumber)
+
+# check in the seats of tickets that have a seat and store the seat on the tickets (one statement)
+# seats that are checked in already are left alone, so only the tickets that were checked in now are returned
+# WITH checkedin AS (UPDATE seats SET checkinstatus=true WHERE ticketnumber IN (...) AND NOT checkinstatus RETURNING ...)
+# UPDATE tickets SET seat_id=checkedin.id FROM checkedin WHERE ... RETURNING checkedin.ticketnumber, checkedin.flightnumber
+def checkin_statement(ticketnumbers):
+    checkedin = seats.update().where(and_(seats.c.ticketnumber.in_(ticketnumbers), seats.c.checkinstatus == False)) \
+        .values(checkinstatus=True).returning(seats.c.id, seats.c.ticketnumber, seats.c.flightnumber).cte('checkedin')
+
+    return tickets.update().values(seat_id=checkedin.c.id).where(
+        tickets.c.number == checkedin.c.ticketnumber).returning(checkedin.c.ticketnumber, checkedin.c.flightnumber)
+
+# check in the seats of tickets that have a seat (does not commit), returns the tickets that were checked in now
+def check_in(ticketnumbers):
+    checkedin = db.session.execute(checkin_statement(ticketnumbers)).fetchall()
+    for flightnumber in set(row[1] for row in checkedin):
+        counters.add(flightnumber, checkedin=sum(1 for row in checkedin if row[1] == flightnumber))
+    return [row[0] for row in checkedin]
+
+# claim the seats of a group, all or nothing (does not commit, rolls back the session if not all seats were claimed)
+# returns None if all seats were claimed, otherwise the result of every assignment
+def claim_group(flightnumber, assignments):
+    try:
+        claimed = set(row[0] for row in db.session.execute(claim_group_statement(flightnumber, assignments)))
+    except exc.IntegrityError:
+        # a concurrent claim of another seat for one of the tickets
+        db.session.rollback()
+        logging.info('Concurrent seat claim for a group on flight ' + str(flightnumber))
+        return [ALREADY_BOOKED] * len(assignments)
+
+    if len(claimed) == len(assignments):
+        counters.add(flightnumber, assigned=len(claimed))
+        return None
+    db.session.rollback()
+    return group_reasons(flightnumber, assignments)
+
+# state of the tickets of a group: number, flightnumber, status and their seat (if any)
+def ticket_states_query(ticketnumbers):
+    return select([tickets.c.number, tickets.c.flightnumber, tickets.c.status, seats.c.seatlabel, seats.c.seatrow]) \
+        .select_from(tickets.outerjoin(seats, seats.c.ticketnumber == tickets.c.number)) \
+        .where(tickets.c.number.in_(ticketnumbers))
+
+# holders of the requested seats of a flight
+def seat_holders_query(flightnumber, positions):
+    return select([seats.c.seatlabel, seats.c.seatrow, seats.c.ticketnumber]).where(and_(
+        seats.c.flightnumber == flightnumber, tuple_(seats.c.seatlabel, seats.c.seatrow).in_(positions)))
+
+# check the tickets of a group before claiming seats (one query), returns the result for every ticket
+# (None if the ticket can get a seat on the flight)
+def check_tickets(flightnumber, ticketnumbers):
+    states = dict((row[0], row[1:]) for row in db.session.execute(ticket_states_query(ticketnumbers)))
+    results = []
+    for ticketnumber in ticketnumbers:
+        state = states.get(ticketnumber)
+        if state is None or state[1] != 'valid':
+            results.append(INVALID_TICKET)
+        elif state[0] != flightnumber:
+            results.append(OTHER_FLIGHT)
+        elif state[2] is not None:
+            results.append(ALREADY_BOOKED)
+        else:
+            results.append(None)
+    return results
+
+# find out why the seats of a group could not be claimed (two queries), None for the seats that were free
+def group_reasons(flightnumber, assignments):
+    results = check_tickets(flightnumber, [number for number, seatlabel, seatrow in assignments])
+    holders = dict(((row[0], int(row[1])), row[2]) for row in db.session.execute(
+        seat_holders_query(flightnumber, [(seatlabel, seatrow) for number, seatlabel, seatrow in assignments])))
+
+    for position, (number, seatlabel, seatrow) in enumerate(assignments):
+        if results[position] is not None:
+            continue
+        if (seatlabel, int(seatrow)) not in holders:
+            results[position] = NONEXISTENT
+        elif holders[(seatlabel, int(seatrow))] is not None:
+            results[position] = TAKEN
+    return results
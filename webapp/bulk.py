@@ -0,0 +1,286 @@
+# Bulk operations for group bookings
+#
+# A group booking is handled with a fixed number of set-based statements instead of one request per passenger:
+#
+#   book_tickets  validates all passengers with the ticket schema, finds passports that already have a ticket and
+#                 locks the seat counters of the flights with one query each and inserts all tickets and their
+#                 notifications with one statement each
+#   assign_seats  claims the requested seats of many tickets of a flight with one statement (all or nothing)
+#   seat_group    finds n adjacent free seats for a group in the availability index of the flight and claims them
+#                 like assign_seats
+#   check_in      checks in many tickets: one query for the tickets, one claim of free seats per flight
+#                 for the tickets without a seat and one statement checking in all seats
+#
+# Every item gets its own result (in input order). A few invalid passengers do not fail a group booking,
+# while the seats of a group are only assigned if every ticket gets its seat.
+# Nothing is committed here, the caller commits the transaction.
+
+import re, logging
+
+from sqlalchemy import tuple_, exc
+from sqlalchemy.dialects.postgresql import insert
+from webapp.model import db, Ticket, BulkTicketSchema, InvalidPassport, bookingnumbers
+from webapp.serializers import compile_schema
+from webapp.cache import get_flight, get_aircraft
+from webapp.seatmap import seatcode
+from webapp import booking, availability, counters
+from webapp.allocator import POLICIES, DEFAULT_POLICY
+from webapp.notifications import notify_many
+
+# at most this many items per bulk request
+MAX_ITEMS = 500
+
+# claims of seats that looked free in the availability index before giving up
+CLAIM_ATTEMPTS = 5
+
+# messages for the results of seat claims
+SEAT_MESSAGES = {
+    booking.INVALID_TICKET: 'Ticket number does not exist',
+    booking.OTHER_FLIGHT: 'Ticket is not booked for this flight',
+    booking.ALREADY_BOOKED: 'Ticket already booked for another seat',
+    booking.ALREADY_BOOKED_SEAT: 'Ticket already booked for requested seat',
+    booking.TAKEN: 'Seat already taken for this flight!',
+    booking.NONEXISTENT: 'Seat does not exist',
+}
+
+# only match 7-digit passportnumbers like T123456
+passportpattern = re.compile("^([A-Z0-9]{7})$")
+
+tickets = Ticket.__table__
+bulk_tickets_schema = compile_schema(BulkTicketSchema(many=True, partial=True))
+
+
+def booked(index, ticketnumber):
+    return {'index': index, 'status': 'booked', 'ticket-number': ticketnumber, 'Location': '/v1/ticket/' + ticketnumber}
+
+def failed(index, message):
+    return {'index': index, 'status': 'error', 'message': message}
+
+
+# (passportnumber, flightnumber) pairs that already have a ticket (that is not cancelled)
+def booked_passports_query(pairs):
+    return db.session.query(Ticket.passportnumber, Ticket.flightnumber) \
+        .filter(tuple_(Ticket.passportnumber, Ticket.flightnumber).in_(pairs)) \
+        .filter(Ticket.status != 'cancelled')
+
+# INSERT INTO tickets ... ON CONFLICT DO NOTHING RETURNING number
+# (a concurrent booking of the same passport for a flight skips the ticket instead of failing the group)
+def insert_tickets_statement(rows):
+    return insert(tickets).values(rows).on_conflict_do_nothing(
+        index_elements=['passportnumber', 'flightnumber'], index_where=db.text("status <> 'cancelled'")
+    ).returning(tickets.c.number)
+
+
+# book tickets for a list of passengers ({"flight-number", "name", "pass-number"} like a single ticket)
+# returns the booking number shared by the booked tickets and the result of every passenger
+def book_tickets(passengers):
+    results = [None] * len(passengers)
+
+    # validate all passengers with the ticket schema
+    candidates = []
+    for index, passenger in enumerate(passengers):
+        if not isinstance(passenger, dict):
+            results[index] = failed(index, 'Please provide flightnumber, passengername and passportnumber !')
+        else:
+            candidates.append(index)
+    data, errors = bulk_tickets_schema.load([passengers[index] for index in candidates])
+
+    valid = []
+    for position, index in enumerate(candidates):
+        item = data[position]
+        if position in errors:
+            results[index] = failed(index, 'Invalid ticket: ' + str(errors[position]))
+        elif not all(k in item for k in ("flightnumber", "passengername", "passportnumber")):
+            results[index] = failed(index, 'Please provide flightnumber, passengername and passportnumber !')
+        elif not passportpattern.match(item["passportnumber"]):
+            results[index] = failed(index, 'Please provide valid passportnumber (7-digit numbers and uppercase characters) !')
+        else:
+            valid.append((index, item))
+
+    # flights that can be booked (cached lookups)
+    flightnumbers = set()
+    for flightnumber in set(item['flightnumber'] for index, item in valid):
+        flight = get_flight(flightnumber)
+        aircraft = get_aircraft(flight.aircraft) if flight and flight.status == 'valid' else None
+        if aircraft:
+            flightnumbers.add(flightnumber)
+
+    # one query for the passports that already have tickets and one locking the seat counters of the flights
+    # (concurrent bookings of these flights wait until this one is committed)
+    pairs = [(item['passportnumber'], item['flightnumber']) for index, item in valid]
+    taken = set(booked_passports_query(pairs).all()) if pairs else set()
+    left = counters.lock(list(flightnumbers)) if flightnumbers else {}
+
+    bookingnumber = bookingnumbers.allocate()
+    rows, notifications, requested = [], [], []
+    for index, item in valid:
+        flightnumber, pair = item['flightnumber'], (item['passportnumber'], item['flightnumber'])
+        if flightnumber not in flightnumbers:
+            results[index] = failed(index, 'Flight does not exist')
+        elif pair in taken:
+            results[index] = failed(index, 'Passport-number already booked a ticket for this flight')
+        elif left.get(flightnumber, 0) <= 0:
+            results[index] = failed(index, 'No more seats left for this flight')
+        else:
+            try:
+                ticket = Ticket(flightnumber, item['passengername'], item['passportnumber'], bookingnumber)
+            except InvalidPassport as e:
+                results[index] = failed(index, 'Passport number is invalid ;-) ' + str(e.message))
+                continue
+            taken.add(pair)
+            left[flightnumber] -= 1
+            requested.append((index, ticket.number))
+            rows.append(dict(number=ticket.number, flightnumber=ticket.flightnumber, passengername=ticket.passengername,
+                             passportnumber=ticket.passportnumber, status=ticket.status, bookingnumber=bookingnumber))
+
+    # insert all tickets and their notifications, count the inserted tickets as sold
+    inserted = set(row[0] for row in db.session.execute(insert_tickets_statement(rows))) if rows else set()
+    for flightnumber in flightnumbers:
+        counters.add(flightnumber, sold=sum(1 for row in rows if row['flightnumber'] == flightnumber and row['number'] in inserted))
+    for index, ticketnumber in requested:
+        if ticketnumber in inserted:
+            results[index] = booked(index, ticketnumber)
+            notifications.append((ticketnumber, "Booking Successful", "Your ticket booking " + ticketnumber + " is successful."))
+        else:
+            results[index] = failed(index, 'Passport-number already booked a ticket for this flight')
+    notify_many(notifications)
+
+    return (bookingnumber if inserted else None), results
+
+
+def seated(index, ticketnumber, seatlabel, seatrow):
+    code = seatcode(seatlabel, seatrow)
+    return {'index': index, 'status': 'seated', 'ticket-number': ticketnumber, 'seat': code,
+            'Location': '/v1/seat/' + ticketnumber + '-' + code}
+
+# results of a group whose seats were not claimed (nothing is assigned, the failed items carry the reason)
+def unseated(ticketnumbers, reasons):
+    return [failed(index, SEAT_MESSAGES[reason]) if reason else
+            {'index': index, 'status': 'not seated', 'ticket-number': ticketnumber}
+            for index, (ticketnumber, reason) in enumerate(zip(ticketnumbers, reasons))]
+
+def notify_seated(assignments):
+    notify_many([(ticketnumber, "Seat Booking", "Seat " + seatcode(seatlabel, seatrow) + " is booked for your ticket " + ticketnumber + ".")
+                 for ticketnumber, seatlabel, seatrow in assignments])
+
+
+# claim the requested seats of a flight, assignments are (ticketnumber, seatlabel, seatrow)
+# returns the claimed assignments (None if nothing was claimed) and the result of every assignment
+def assign_seats(flightnumber, assignments):
+    reasons = booking.claim_group(flightnumber, assignments)
+    if reasons is not None:
+        # another request took one of the seats first: update the availability index
+        for (ticketnumber, seatlabel, seatrow), reason in zip(assignments, reasons):
+            if reason == booking.TAKEN:
+                availability.booked(flightnumber, seatlabel, seatrow)
+        return None, unseated([assignment[0] for assignment in assignments], reasons)
+
+    notify_seated(assignments)
+    return assignments, [seated(index, *assignment) for index, assignment in enumerate(assignments)]
+
+# seat the tickets of a group next to each other (see SeatAvailability.find_group)
+# returns the claimed assignments (None if nothing was claimed) and the result of every ticket
+def seat_group(flightnumber, ticketnumbers):
+    reasons = booking.check_tickets(flightnumber, ticketnumbers)
+    if any(reasons):
+        return None, unseated(ticketnumbers, reasons)
+
+    for attempt in range(CLAIM_ATTEMPTS):
+        seats = availability.for_flight(flightnumber)
+        indexes = seats.find_group(len(ticketnumbers)) if seats is not None else None
+        if indexes is None:
+            break
+
+        assignments = [(ticketnumber,) + seats.seats.positions[index] for ticketnumber, index in zip(ticketnumbers, indexes)]
+        reasons = booking.claim_group(flightnumber, assignments)
+        if reasons is None:
+            notify_seated(assignments)
+            return assignments, [seated(index, *assignment) for index, assignment in enumerate(assignments)]
+
+        if not all(reason in (None, booking.TAKEN, booking.NONEXISTENT) for reason in reasons):
+            return None, unseated(ticketnumbers, reasons)
+        # seats taken by another worker process since the index was built: try the next free seats
+        for index, reason in zip(indexes, reasons):
+            if reason is not None:
+                seats.book(seats.seats.code(index))
+
+    return None, [failed(index, 'Not enough free seats for the group') for index in range(len(ticketnumbers))]
+
+
+def checkedin(ticketnumber, seatlabel, seatrow):
+    return {'ticket-number': ticketnumber, 'status': 'checked in', 'seat': seatcode(seatlabel, seatrow),
+            'Location': '/v1/ticket/' + ticketnumber}
+
+def not_checkedin(ticketnumber, message):
+    return {'ticket-number': ticketnumber, 'status': 'error', 'message': message}
+
+# claim free seats of a flight (picked by a seat policy) for tickets without a seat (checked in), in a savepoint
+# so a rejected claim does not roll back the other check-ins of the batch
+# returns the claimed assignments (ticketnumber, seatlabel, seatrow)
+def claim_free_seats(flightnumber, ticketnumbers, policy):
+    seats = availability.for_flight(flightnumber)
+    claimed, remaining, tried = [], list(ticketnumbers), 0
+    for attempt in range(CLAIM_ATTEMPTS):
+        indexes = policy.candidates(seats, len(remaining), tried) if seats is not None and remaining else None
+        if not indexes:
+            break
+
+        assignments = [(ticketnumber,) + seats.seats.positions[index] for ticketnumber, index in zip(remaining, indexes)]
+        try:
+            with db.session.begin_nested():
+                result = db.session.execute(booking.claim_group_statement(flightnumber, assignments, checkin=True))
+                got = set(row[0] for row in result)
+        except exc.IntegrityError:
+            # a concurrent claim for one of the tickets, the tickets of this claim are left unseated
+            logging.info('Concurrent seat claim on check-in for flight ' + str(flightnumber))
+            break
+
+        for assignment, index in zip(assignments, indexes):
+            tried |= 1 << index
+            if assignment[0] in got:
+                claimed.append(assignment)
+            else:
+                # taken by another worker process since the index was built
+                seats.book(seats.seats.code(index))
+        remaining = [ticketnumber for ticketnumber in remaining if ticketnumber not in got]
+    counters.add(flightnumber, assigned=len(claimed), checkedin=len(claimed))
+    return claimed
+
+# check in many tickets (optionally only tickets of one flight), tickets without a seat get free seats of their
+# flight picked by the seat policy (see allocator.py)
+# returns the claimed seats (flightnumber, seatlabel, seatrow) and the result of every ticket
+def check_in(ticketnumbers, flightnumber=None, policy=None):
+    policy = policy or POLICIES[DEFAULT_POLICY]
+    states = dict((row[0], row[1:]) for row in db.session.execute(booking.ticket_states_query(ticketnumbers)))
+
+    results, seated, unseated = {}, [], {}
+    for ticketnumber in ticketnumbers:
+        state = states.get(ticketnumber)
+        flight = get_flight(state[0]) if state is not None else None
+        if state is None:
+            results[ticketnumber] = not_checkedin(ticketnumber, 'Ticket does not exist !')
+        elif flightnumber is not None and state[0] != flightnumber:
+            results[ticketnumber] = not_checkedin(ticketnumber, 'Ticket is not booked for this flight')
+        elif state[1] != 'valid' or flight is None or flight.status != 'valid':
+            results[ticketnumber] = not_checkedin(ticketnumber, 'Either flight or ticket are invalid!')
+        elif state[2] is not None:
+            seated.append(ticketnumber)
+            results[ticketnumber] = checkedin(ticketnumber, state[2], state[3])
+        else:
+            unseated.setdefault(state[0], []).append(ticketnumber)
+
+    # seat the tickets without a seat, flight by flight
+    claimed = []
+    for number, waiting in unseated.items():
+        assignments = claim_free_seats(number, waiting, policy)
+        for ticketnumber, seatlabel, seatrow in assignments:
+            results[ticketnumber] = checkedin(ticketnumber, seatlabel, seatrow)
+            claimed.append((number, seatlabel, seatrow))
+        for ticketnumber in waiting:
+            results.setdefault(ticketnumber, not_checkedin(ticketnumber, 'No more seats available on flight!'))
+
+    # check in the tickets that had a seat already
+    if seated:
+        booking.check_in(seated)
+
+    return claimed, [results[ticketnumber] for ticketnumber in ticketnumbers]
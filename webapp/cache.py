@@ -0,0 +1,174 @@
+# Read-through cache for flight and aircraft lookups
+#
+# Flights and aircrafts are read on nearly every request but change rarely. get_flight/get_aircraft return
+# plain records (named tuples with the columns of the model) from the cache and only query the database on a miss.
+# Writes invalidate the cached entry (invalidate_flight/invalidate_aircraft). Misses are loaded from the primary,
+# also in GET requests that read from a replica (see routing.py). Caches whose entries are never invalidated and
+# only expire (e.g. the search results, see search.py) can load their misses from a replica (from_primary=False).
+#
+# Backends (config CACHE_BACKEND):
+#   local  bounded LRU with TTL in the worker process (default). Entries invalidated by another worker
+#          stay visible here until their TTL ends, keep CACHE_TTL short when running many workers.
+#   uwsgi  the uWSGI caching framework, shared by all workers of a uWSGI instance. Needs a cache
+#          configured in uWSGI, e.g. --cache2 name=airlinews,items=10000,purge_lru=1
+#
+# Hits and misses are counted per worker process (see /v1/metrics).
+
+import time, pickle, threading
+from collections import OrderedDict, namedtuple
+
+from webapp.model import db, Flight, Aircraft
+from webapp.routing import primary
+
+FlightRecord = namedtuple('FlightRecord', ['id', 'flightnumber', 'start', 'end', 'date', 'aircraft', 'status', 'version'])
+AircraftRecord = namedtuple('AircraftRecord', ['id', 'aircraft', 'seatcount', 'layout'])
+
+MISSING = object()
+
+
+# bounded LRU cache with TTL in the worker process
+class LocalCache(object):
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# cache shared by all workers of a uWSGI instance (only available when running under uWSGI)
+class UWSGICache(object):
+
+    def __init__(self, name='airlinews', ttl=60):
+        import uwsgi
+        self.uwsgi = uwsgi
+        self.name = name
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.uwsgi.cache_get(key, self.name)
+        return MISSING if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.uwsgi.cache_update(key, pickle.dumps(value), self.ttl, self.name)
+
+    def delete(self, key):
+        self.uwsgi.cache_del(key, self.name)
+
+    def clear(self):
+        self.uwsgi.cache_clear(self.name)
+
+
+backend = LocalCache()
+
+def init_app(app):
+    global backend
+    ttl = app.config.get('CACHE_TTL', 60)
+    if app.config.get('CACHE_BACKEND', 'local') == 'uwsgi':
+        backend = UWSGICache(app.config.get('CACHE_UWSGI_NAME', 'airlinews'), ttl)
+    else:
+        backend = LocalCache(app.config.get('CACHE_SIZE', 1024), ttl)
+
+
+# cache for one kind of lookup: loads missing entries with the loader (None is not cached)
+# (in the shared backend unless it gets a backend of its own, e.g. with a shorter TTL)
+class ReadThroughCache(object):
+
+    def __init__(self, name, loader, backend=None, from_primary=True):
+        self.name = name
+        self.loader = loader
+        self.backend = backend
+        self.from_primary = from_primary
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        value = self.lookup(key)
+        if value is MISSING:
+            if self.from_primary:
+                # a value loaded from a lagging replica would outlive an invalidation
+                with primary():
+                    value = self.loader(key)
+            else:
+                value = self.loader(key)
+            self.store(key, value)
+        return value
+
+    # the cached value (MISSING on a miss), for callers that load the value themselves (see asgi.py)
+    def lookup(self, key):
+        value = (self.backend or backend).get(self.name + ':' + key)
+        with self.lock:
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def store(self, key, value):
+        if value is not None:
+            (self.backend or backend).set(self.name + ':' + key, value)
+
+    def invalidate(self, key):
+        (self.backend or backend).delete(self.name + ':' + key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def load_flight(flightnumber):
+    row = db.session.query(*[getattr(Flight, column) for column in FlightRecord._fields]) \
+        .filter_by(flightnumber=flightnumber).first()
+    return FlightRecord(*row) if row else None
+
+def load_aircraft(aircraft):
+    row = db.session.query(*[getattr(Aircraft, column) for column in AircraftRecord._fields]) \
+        .filter_by(aircraft=aircraft).first()
+    return AircraftRecord(*row) if row else None
+
+flights = ReadThroughCache('flight', load_flight)
+aircrafts = ReadThroughCache('aircraft', load_aircraft)
+
+# the flight with a flightnumber (None if it does not exist)
+def get_flight(flightnumber):
+    return flights.get(flightnumber)
+
+# the aircraft of a type (None if it does not exist)
+def get_aircraft(aircraft):
+    return aircrafts.get(aircraft)
+
+def invalidate_flight(flightnumber):
+    flights.invalidate(flightnumber)
+
+def invalidate_aircraft(aircraft):
+    aircrafts.invalidate(aircraft)
+
+# hit/miss counters of all caches (of this worker process)
+def stats():
+    return {cache.name: cache.stats() for cache in (flights, aircrafts)}
@@ -0,0 +1,56 @@
+# Conditional requests (ETag / If-None-Match) for the polled reads
+#
+# Mobile clients poll a flight, a ticket and the notifications of a ticket every few seconds. The responses carry
+# an ETag derived from a version, a poll with a matching If-None-Match gets an empty 304 Not Modified before the
+# object is loaded and dumped:
+#
+#   GET /v1/flight/<flightnumber>                  flightnumber-version of the cached flight record (no query)
+#   GET /v1/ticket/<ticketnumber>                  ticketnumber-version, read alone (one integer column)
+#   GET /v1/ticket/<ticketnumber>/notifications    number-latest timestamp of the notifications of the ticket
+#                                                  (aggregate on the index on ticketnumber, timestamp)
+#
+# The version columns of flights and tickets count up with every UPDATE of the row (an onupdate default of the
+# column, so ORM flushes, Core statements and the statements of asgi.py all count; changes made directly in the
+# database need to set version = version + 1 themselves). Notifications are only ever added.
+#
+# Cache-Control per resource:
+#
+#   CACHE_CONTROL_FLIGHT          default "private, max-age=60" (flights rarely change)
+#   CACHE_CONTROL_TICKET          default "private, max-age=5"
+#   CACHE_CONTROL_NOTIFICATIONS   default "private, no-cache" (revalidated on every poll)
+
+from flask import request, current_app
+from werkzeug.http import parse_etags, quote_etag
+
+cache_control = {
+    'flight': 'private, max-age=60',
+    'ticket': 'private, max-age=5',
+    'notifications': 'private, no-cache',
+}
+
+def init_app(app):
+    for resource in cache_control:
+        cache_control[resource] = app.config.get('CACHE_CONTROL_' + resource.upper()) or cache_control[resource]
+
+def etag(*parts):
+    return '-'.join(str(part) for part in parts)
+
+# does an If-None-Match header match an etag? (weak comparison, "*" matches any)
+def matches(if_none_match, tag):
+    return bool(if_none_match) and parse_etags(if_none_match).contains_weak(tag)
+
+# response headers of a resource with its etag
+def headers(resource, tag):
+    return {'ETag': quote_etag(tag), 'Cache-Control': cache_control[resource]}
+
+
+# does the request revalidate (has If-None-Match)?
+def revalidating():
+    return bool(request.headers.get('If-None-Match'))
+
+# does the request already have the representation with this etag?
+def requested(tag):
+    return matches(request.headers.get('If-None-Match'), tag)
+
+def not_modified(resource, tag):
+    return current_app.response_class(status=304, headers=headers(resource, tag))
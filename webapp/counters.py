@@ -0,0 +1,109 @@
+# Seat counters per flight
+#
+# Instead of counting the tickets of a flight for every booking (a scan of all its tickets, cancelled ones included,
+# that races with concurrent bookings), the flightcounters table keeps per flight:
+#
+#   capacity   seats of the flight (created together with its seats, see precreate_seats)
+#   sold       valid tickets
+#   assigned   seats booked for a ticket
+#   checkedin  booked seats that are checked in
+#
+# A booking reserves its seat with one conditional UPDATE
+#
+#   UPDATE flightcounters SET sold = sold + 1 WHERE flightnumber = ... AND sold + 1 <= capacity RETURNING ...
+#
+# The row lock serializes concurrent bookings of a flight until they commit, so a flight can never be oversold.
+# The other counters are changed in the transaction of the seat claim, release or check-in, so a rolled back
+# change leaves them untouched.
+#
+# rebuild() recomputes the counters from the tickets and seats (reconciliation), e.g. after changes made directly
+# in the database:  FLASK_APP=webapp.app flask rebuild-counters
+
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from webapp.model import db, FlightCounter, Flight, Seat, Ticket
+
+# flights per transaction of a rebuild
+REBUILD_BATCH = 100
+
+counters = FlightCounter.__table__
+flights = Flight.__table__
+seats = Seat.__table__
+tickets = Ticket.__table__
+
+
+# UPDATE flightcounters SET sold = sold + n WHERE ... AND sold + n <= capacity RETURNING capacity - sold
+def reserve_statement(flightnumber, count=1):
+    return counters.update().where(and_(
+        counters.c.flightnumber == flightnumber,
+        counters.c.sold + count <= counters.c.capacity
+    )).values(sold=counters.c.sold + count).returning(counters.c.capacity - counters.c.sold)
+
+# reserve seats of a flight for new tickets (does not commit)
+# returns the seats left afterwards, None if not enough seats are left (or the flight has no counters)
+def reserve(flightnumber, count=1):
+    row = db.session.execute(reserve_statement(flightnumber, count)).first()
+    return row[0] if row is not None else None
+
+def add_statement(flightnumber, sold=0, assigned=0, checkedin=0):
+    return counters.update().where(counters.c.flightnumber == flightnumber).values(
+        sold=counters.c.sold + sold, assigned=counters.c.assigned + assigned, checkedin=counters.c.checkedin + checkedin)
+
+# change the counters of a flight (does not commit)
+def add(flightnumber, sold=0, assigned=0, checkedin=0):
+    if sold or assigned or checkedin:
+        db.session.execute(add_statement(flightnumber, sold, assigned, checkedin))
+
+# counters of a new flight (does not commit)
+def create(flightnumber, capacity):
+    db.session.execute(counters.insert().values(flightnumber=flightnumber, capacity=capacity, sold=0, assigned=0, checkedin=0))
+
+# SELECT flightnumber, capacity - sold FROM flightcounters WHERE flightnumber IN (...) ORDER BY flightnumber FOR UPDATE
+# (locked in order, so concurrent group bookings of the same flights do not deadlock)
+def lock_query(flightnumbers):
+    return select([counters.c.flightnumber, counters.c.capacity - counters.c.sold]) \
+        .where(counters.c.flightnumber.in_(flightnumbers)).order_by(counters.c.flightnumber).with_for_update()
+
+# lock the counters of flights for booking many tickets (does not commit), returns the seats left per flight
+# (the caller adds the sold tickets with add() before it commits)
+def lock(flightnumbers):
+    return dict(db.session.execute(lock_query(flightnumbers)).fetchall())
+
+
+def count(table, *conditions):
+    return select([func.count()]).select_from(table).where(and_(*conditions)).as_scalar()
+
+# INSERT INTO flightcounters SELECT <counts from seats and tickets> FROM flights WHERE flightnumber IN (...)
+# ON CONFLICT (flightnumber) DO UPDATE ... WHERE <a counter differs> RETURNING flightnumber
+def rebuild_statement(flightnumbers):
+    flightseats = seats.c.flightnumber == flights.c.flightnumber
+    actual = select([
+        flights.c.flightnumber,
+        count(seats, flightseats),
+        count(tickets, tickets.c.flightnumber == flights.c.flightnumber, tickets.c.status == 'valid'),
+        count(seats, flightseats, seats.c.ticketnumber != None),
+        count(seats, flightseats, seats.c.ticketnumber != None, seats.c.checkinstatus == True),
+    ]).where(flights.c.flightnumber.in_(flightnumbers))
+
+    columns = ['capacity', 'sold', 'assigned', 'checkedin']
+    statement = insert(counters).from_select(['flightnumber'] + columns, actual)
+    return statement.on_conflict_do_update(
+        index_elements=[counters.c.flightnumber],
+        set_=dict((column, statement.excluded[column]) for column in columns),
+        where=or_(*[counters.c[column] != statement.excluded[column] for column in columns])
+    ).returning(counters.c.flightnumber)
+
+# recompute the counters of all flights (or of some flights) from their seats and tickets, one batch of flights
+# per transaction. The counters of a batch are locked first: state changes in progress commit before the counts
+# are taken, and later ones wait until the batch is committed.
+# returns the flightnumbers whose counters were wrong or missing
+def rebuild(flightnumbers=None, batch=REBUILD_BATCH):
+    if flightnumbers is None:
+        flightnumbers = [row[0] for row in db.session.execute(select([flights.c.flightnumber]).order_by(flights.c.flightnumber))]
+    fixed = []
+    for start in range(0, len(flightnumbers), batch):
+        numbers = flightnumbers[start:start + batch]
+        lock(numbers)
+        fixed.extend(row[0] for row in db.session.execute(rebuild_statement(numbers)))
+        db.session.commit()
+    return fixed
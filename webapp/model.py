@@ -1,9 +1,8 @@
-import jwt, re
-import random, string, logging
+import re
+import logging
 from flask import Flask
 from marshmallow import Schema, fields, pre_load, post_load, post_dump, validate
 from flask_marshmallow import Marshmallow
-from flask_sqlalchemy import SQLAlchemy
 from flask_security import UserMixin, RoleMixin, login_required, utils
 from flask_login import current_user
 from sqlalchemy import Table, Column, PrimaryKeyConstraint, UniqueConstraint, CheckConstraint
@@ -14,31 +13,69 @@ from passlib.apps import custom_app_context as pwd_context
 from flask_admin.contrib import sqla
 from datetime import datetime
 from wtforms import PasswordField
-from datetime import datetime, timedelta
+from webapp.numbering import NumberCodec, NumberAllocator, BLOCK_SIZE
+from webapp.routing import RoutingSQLAlchemy
+from webapp import tokens
 
 
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 ma = Marshmallow()
 
+# schema renaming the json keys of a request to its fields before loading (json_keys: (json key, field) pairs,
+# a key is renamed if it has a value)
+class JsonKeysSchema(ma.Schema):
+    json_keys = ()
+
+    @pre_load
+    def rename_json_keys(self, data):
+        for key, name in self.json_keys:
+            if data.get(key):
+                data[name] = data.pop(key)
+        return data
+
+# sequences for the ticket and flight numbers (counting up in blocks, see numbering.py)
+ticketnumber_sequence = db.Sequence('ticketnumber_seq', increment=BLOCK_SIZE, metadata=db.metadata)
+flightnumber_sequence = db.Sequence('flightnumber_seq', increment=BLOCK_SIZE, metadata=db.metadata)
+bookingnumber_sequence = db.Sequence('bookingnumber_seq', increment=BLOCK_SIZE, metadata=db.metadata)
+
+# nextval of a sequence, executed on the connection of the session (Session.execute would look for the tables
+# of the clause to pick a bind, which a sequence does not have)
+def next_block(sequence):
+    return lambda: db.session.connection().execute(sequence)
+
+ticketnumbers = NumberAllocator(NumberCodec(7, offset=0x5EED7), next_block(ticketnumber_sequence))
+flightnumbers = NumberAllocator(NumberCodec(6, offset=0xF11E), next_block(flightnumber_sequence))
+bookingnumbers = NumberAllocator(NumberCodec(6, offset=0xB00C), next_block(bookingnumber_sequence))
+
 class Aircraft(db.Model):
     __tablename__ = 'aircrafts'
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     aircraft = db.Column(db.String(15), unique=True, nullable=False)
     seatcount = db.Column(db.Integer, nullable=False)
+    # optional seat layout template (cabins, rows, labels, blocked seats), see seatmap.py
+    layout = db.Column(db.JSON, nullable=True)
 
-    def __init__(self, aircraft, seatcount):
+    def __init__(self, aircraft, seatcount, layout=None):
         self.aircraft = aircraft
         self.seatcount = seatcount
+        self.layout = layout
 
 # schema for serialization / serialization of aircrafts
 class AircraftSchema(ma.Schema):
     aircraft = fields.Str()
     seatcount = fields.Integer()
+    layout = fields.Dict(allow_none=True)
 
 class Seat(db.Model):
     __tablename__ = 'seats'
+    __table_args__ = (
+        # a ticket can only be booked for one seat
+        db.Index('ix_seats_ticketnumber', 'ticketnumber', unique=True, postgresql_where=db.text('ticketnumber IS NOT NULL')),
+        # seats of a flight and a single seat of a flight
+        db.Index('ix_seats_flightnumber_seat', 'flightnumber', 'seatlabel', 'seatrow', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
@@ -48,7 +85,6 @@ class Seat(db.Model):
     flight = db.relationship("Flight", back_populates="seats")
     #flight = db.relationship('Flight', backref=db.backref('seats', lazy='dynamic' ))
 
-    # TODO: only one seat per ticket?
     ticketnumber = db.Column(db.String(15), db.ForeignKey('tickets.number'), nullable=True)
 
     # Enum constraint seats labeled from A - H
@@ -67,36 +103,28 @@ class Seat(db.Model):
         self.parent_id = parentid
 
 # schema for serialization / serialization of seats
-class SeatSchema(ma.Schema):
+class SeatSchema(JsonKeysSchema):
     number = fields.String(validate=validate.Length(10))
     ticketnumber = fields.String(required=True, validate=validate.Length(1))
     seatlabel = fields.String(required=True, validate=validate.Length(1))
     seatrow = fields.String(required=True, validate=validate.Length(1))
     flightnumber = fields.String(required=True, validate=validate.Length(1))
 
-    @pre_load
-    def formatJsonKeys(self, data):
-       
-        ticketnumber = data.get('ticket-number')
-        if ticketnumber:
-            data['ticketnumber'] = data.pop('ticket-number')
-
-        seatlabel = data.get('Seat-label')
-        if seatlabel:
-            data['seatlabel'] = data.pop('Seat-label')
-
-        seatrow = data.get('Seat-row')
-        if seatrow:
-            data['seatrow'] = data.pop('Seat-row')
-
-        flightnumber = data.get('Flight-number')
-        if flightnumber:
-            data['flightnumber'] = data.pop('Flight-number')
-            
-        return data
+    # json keys of the requests -> fields
+    json_keys = (('ticket-number', 'ticketnumber'), ('Seat-label', 'seatlabel'), ('Seat-row', 'seatrow'),
+                 ('Flight-number', 'flightnumber'))
 
 class Ticket(db.Model):
     __tablename__ = 'tickets'
+    __table_args__ = (
+        # tickets of a flight (capacity checks, flight cancellation)
+        db.Index('ix_tickets_flightnumber', 'flightnumber'),
+        # only one ticket (that is not cancelled) per passport for a flight
+        db.Index('ix_tickets_passportnumber_flightnumber', 'passportnumber', 'flightnumber', unique=True,
+                 postgresql_where=db.text("status <> 'cancelled'")),
+        # tickets of a group booking
+        db.Index('ix_tickets_bookingnumber', 'bookingnumber'),
+    )
     
     # only match 7-digit ticketnumbers like T123456
     passportpattern = re.compile("^([A-Z0-9]{7})$")
@@ -108,9 +136,10 @@ class Ticket(db.Model):
     passportnumber = db.Column(db.String(10),nullable=False)
     status = db.Column(db.Enum('valid','cancelled',name="ticketstatusenum", create_type=True), nullable=False)
     seat_id = db.Column(db.Integer, db.ForeignKey('seats.id'))
-
-    def idgenerator(self, size=7, chars=string.ascii_uppercase + string.digits):
-        return ''.join(random.choice(chars) for _ in range(size))
+    # booking reference shared by the tickets of a group booking (None for single tickets)
+    bookingnumber = db.Column(db.String(10), nullable=True)
+    # counts up with every update of the row (ETag of the ticket, see conditional.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=db.text('version + 1'))
 
     def validate_passportnumber(self, passportnumber):
         #TODO: validating here
@@ -118,8 +147,9 @@ class Ticket(db.Model):
             raise InvalidPassport('Thepassportnumber ' + str(passportnumber) + 'is invalid', status_code=410)
         return passportnumber
 
-    def __init__(self, flightnumber, passengername, passportnumber):
-        self.number = self.idgenerator(7, string.ascii_uppercase + string.digits)
+    def __init__(self, flightnumber, passengername, passportnumber, bookingnumber=None):
+        self.number = ticketnumbers.allocate()
+        self.bookingnumber = bookingnumber
         self.flightnumber = flightnumber
         self.passengername = passengername
         self.passportnumber = self.validate_passportnumber(passportnumber)
@@ -128,7 +158,7 @@ class Ticket(db.Model):
     # TODO:  Add a column-property for returning the "full" ticketnumber <number>-<seatlabelseatrow> when seat is booked?
 
 # schema for serialization / serialization of tickets
-class TicketSchema(ma.Schema):
+class TicketSchema(JsonKeysSchema):
     
     id = fields.Integer()
     number = fields.String(required=False)
@@ -137,39 +167,30 @@ class TicketSchema(ma.Schema):
     passportnumber = fields.String(required=True, validate=validate.Length(1))
     status = fields.String()
     seat_id = fields.String() # default to "None" if no seatnumber is given?
+    bookingnumber = fields.String(dump_only=True)
    
-    @pre_load
-    def formatKeys(self, data):
-        number = data.get('ticket-number')
-        if number:
-            data['number'] = data.pop('ticket-number')
-
-        flightnumber = data.get('flight-number')
-        if flightnumber:
-                data['flightnumber'] = data.pop('flight-number')
-
-        passengername = data.get('name')
-        if passengername:
-                data['passengername'] = data.pop('name')
-
-        passportnumber = data.get('pass-number')
-        if passportnumber:
-            data['passportnumber'] = data.pop('pass-number')
-        
-        seatnumber = data.get('seat_number')
-        if seatnumber:
-            data['seatnumber'] = data.pop('seat_number')
-
-        return data
+    # json keys of the requests -> fields
+    json_keys = (('ticket-number', 'number'), ('flight-number', 'flightnumber'), ('name', 'passengername'),
+                 ('pass-number', 'passportnumber'), ('seat_number', 'seatnumber'))
 
     # raise a custom exception when (de)serialization fails
     def handle_error(self, exc, data):
         logging.error("ERROR when serializing ticket: " + exc.messages)
         raise AppError('An error occurred with input: {0}'.format(data))
 
+# schema for the tickets of a bulk booking: keeps the errors per ticket instead of raising
+class BulkTicketSchema(TicketSchema):
+
+    def handle_error(self, exc, data):
+        pass
+
 # table storing all notifications for transactions
 class Notification(db.Model):
     __tablename__ = 'notifications'
+    __table_args__ = (
+        # notifications of a ticket ordered by their timestamp
+        db.Index('ix_notifications_ticketnumber_timestamp', 'ticketnumber', 'timestamp'),
+    )
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     ticketnumber = db.Column(db.String(10), nullable=False)
@@ -183,6 +204,17 @@ class Notification(db.Model):
         self.message = message
         self.ticketnumber = ticketnumber
 
+# transactional outbox for notifications: written in the same transaction as the booking and
+# moved into the notifications table in batches by the notification relay (see notifications.py)
+class NotificationOutbox(db.Model):
+    __tablename__ = 'notificationoutbox'
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    ticketnumber = db.Column(db.String(10), nullable=False)
+    title = db.Column(db.String(250), nullable=False)
+    message = db.Column(db.String(250), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 # schema forserialization / serialization of flights
 class NotificationSchema(ma.Schema):
     class Meta:
@@ -194,6 +226,10 @@ class NotificationSchema(ma.Schema):
     
 class Flight(db.Model):
     __tablename__ = 'flights'
+    __table_args__ = (
+        # flights of a route by departure (flight search)
+        db.Index('ix_flights_start_end_date', 'start', 'end', 'date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     
@@ -208,18 +244,28 @@ class Flight(db.Model):
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     aircraft  = db.Column(db.String(15), db.ForeignKey('aircrafts.aircraft'), nullable=False)
     status = db.Column(db.Enum('valid','cancelled',name="ticketstatusenum", create_type=True), nullable=False)
+    # counts up with every update of the row (ETag of the flight, see conditional.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=db.text('version + 1'))
     
-    def idgenerator(self, size=6, chars=string.ascii_uppercase + string.digits):
-            return ''.join(random.choice(chars) for _ in range(size))
-
     def __init__(self, start, end, date, aircraft):
-        self.flightnumber = self.idgenerator(6, string.ascii_uppercase + string.digits)
+        self.flightnumber = flightnumbers.allocate()
         self.start = start
         self.end = end
         self.date = date
         self.aircraft = aircraft
         self.status = "valid"
 
+# seat counters of a flight, changed with every booking, seat claim and check-in (see counters.py)
+# (deleted together with the flight)
+class FlightCounter(db.Model):
+    __tablename__ = 'flightcounters'
+
+    flightnumber = db.Column(db.String(10), db.ForeignKey('flights.flightnumber', ondelete='CASCADE'), primary_key=True)
+    capacity = db.Column(db.Integer, nullable=False)
+    sold = db.Column(db.Integer, nullable=False, default=0)
+    assigned = db.Column(db.Integer, nullable=False, default=0)
+    checkedin = db.Column(db.Integer, nullable=False, default=0)
+
 # schema for serialization / serialization of a single flight
 # (flightnumber not mandatory on creation of new flight)
 class FlightSchema(ma.Schema):
@@ -248,6 +294,10 @@ class FlightsSchema(ma.Schema):
     #departure = fields.DateTime('%Y-%m-%dT%H:%M:%SZ')
     #departure.dateformat("ISO8601")
 
+# schema for serialization of the flights found by a search, with their seats left
+class FlightSearchSchema(FlightsSchema):
+    seatsleft = fields.Integer(dump_to='seats-left')
+
 # Create an association table to support a many-to-many relationship between Users and Roles
 roles_users = db.Table(
     'roles_users',
@@ -295,41 +345,18 @@ class User(db.Model, UserMixin):
     def verify_password(self, password):
         return pwd_context.verify(password, self.password_hash)
 
-    def generate_token(self, user_id):
-        # Generates an access token
-
-        try:
-            # set up a payload with an expiration time
-            payload = {
-                'exp': datetime.utcnow() + timedelta(minutes=5),
-                'iat': datetime.utcnow(),
-                'sub': user_id
-            }
-            # create the byte string token using the payload and the SECRET key
-            jwt_string = jwt.encode(
-                payload,
-                current_app.config.get('SECRET'),
-                algorithm='HS256'
-            )
-            return jwt_string
-
-        except Exception as e:
-            # return an error in string format if an exception occurs
-            return str(e)
+    def generate_token(self):
+        # Generates a bearer token for the API with the roles of the user (see tokens.py)
+        return tokens.issue(self)
 
     @staticmethod
     def decode_token(token):
-        # Decodes an access token from the Authorization header
-        try:
-            # try to decode the token using our SECRET variable
-            payload = jwt.decode(token, current_app.config.get('SECRET'))
-            return payload['sub']
-        except jwt.ExpiredSignatureError:
-            # the token is expired, return an error string
-            return "Expired token. Please login to get a new token"
-        except jwt.InvalidTokenError:
-            # the token is invalid, return an error string
-            return "Invalid token. Please register or login"
+        # Decodes a bearer token, returns the user id
+        claims = tokens.decode(token)
+        if claims is None:
+            # the token is invalid or expired, return an error string
+            return "Invalid or expired token. Please request a new token"
+        return claims['sub']
 
 # schema for serialization / serialization of users
 class UserSchema(ma.Schema):
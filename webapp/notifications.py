@@ -0,0 +1,186 @@
+# Notification pipeline: transactional outbox and a background relay
+#
+# Producers (bookings, seat bookings, flight cancellations) only write an outbox event in the transaction
+# they commit anyway, so a notification is never lost and never costs an extra commit. After the commit
+# the ids of the events are queued in-process and a background thread moves them into the notifications
+# table in batches: one statement per batch deletes the events from the outbox and inserts them
+#
+#   WITH moved AS (DELETE FROM notificationoutbox WHERE id IN (...) RETURNING ...)
+#   INSERT INTO notifications (...) SELECT ... FROM moved
+#
+# A batch is flushed when it is full (BATCH_SIZE) or FLUSH_INTERVAL after its first event.
+# The queue is bounded: if it stays full the producer stops waiting after ENQUEUE_TIMEOUT and leaves the events
+# to the sweep, which regularly moves events that are older than SWEEP_AGE (e.g. left behind by a crashed
+# worker). Because an event is deleted from the outbox when it is moved, every event is moved exactly once,
+# even with many uWSGI workers.
+
+import os, time, queue, atexit, logging, threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, select, literal
+from flask_sqlalchemy import SignallingSession
+from webapp.model import db, Notification, NotificationOutbox, Ticket
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.2    # seconds
+QUEUE_SIZE = 10000
+ENQUEUE_TIMEOUT = 0.05  # seconds
+SWEEP_INTERVAL = 30     # seconds
+SWEEP_AGE = 10          # seconds
+
+outbox = NotificationOutbox.__table__
+notifications = Notification.__table__
+tickets = Ticket.__table__
+columns = ['ticketnumber', 'title', 'message', 'timestamp']
+
+
+# ids of the outbox events written in the current transaction of a session
+def pending(session):
+    return session.info.setdefault('notifications', [])
+
+# create a notification for a ticket (delivered after the current transaction commits)
+def notify(ticketnumber, title, message):
+    statement = outbox.insert().values(
+        ticketnumber=ticketnumber, title=title, message=message, timestamp=datetime.utcnow()
+    ).returning(outbox.c.id)
+    pending(db.session()).append(db.session.execute(statement).scalar())
+
+# create the same notification for all tickets matching a condition (one statement)
+def notify_tickets(condition, title, message):
+    statement = outbox.insert().from_select(columns, select([
+        tickets.c.number, literal(title), literal(message), literal(datetime.utcnow())
+    ]).where(condition)).returning(outbox.c.id)
+    pending(db.session()).extend(row[0] for row in db.session.execute(statement))
+
+# create notifications for many tickets (one statement), items are (ticketnumber, title, message)
+def notify_many(items):
+    if not items:
+        return
+    timestamp = datetime.utcnow()
+    statement = outbox.insert().values([
+        dict(ticketnumber=ticketnumber, title=title, message=message, timestamp=timestamp)
+        for ticketnumber, title, message in items
+    ]).returning(outbox.c.id)
+    pending(db.session()).extend(row[0] for row in db.session.execute(statement))
+
+@event.listens_for(SignallingSession, 'after_commit')
+def after_commit(session):
+    ids = session.info.pop('notifications', None)
+    if ids:
+        relay.enqueue(ids)
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('notifications', None)
+
+
+# move the outbox events matching a condition into the notifications table
+def move(condition):
+    moved = outbox.delete().where(condition).returning(
+        outbox.c.ticketnumber, outbox.c.title, outbox.c.message, outbox.c.timestamp).cte('moved')
+    result = db.session.execute(notifications.insert().from_select(columns, select([
+        moved.c.ticketnumber, moved.c.title, moved.c.message, moved.c.timestamp])))
+    return result.rowcount
+
+# move a batch of old outbox events (that were never queued or left behind)
+def sweep():
+    cutoff = datetime.utcnow() - timedelta(seconds=SWEEP_AGE)
+    return move(outbox.c.id.in_(
+        select([outbox.c.id]).where(outbox.c.timestamp < cutoff).order_by(outbox.c.id)
+            .limit(BATCH_SIZE).with_for_update(skip_locked=True)))
+
+
+# background thread moving the queued outbox events in batches (one per worker process)
+class NotificationRelay(object):
+
+    def __init__(self):
+        self.app = None
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        # start in the worker process (uWSGI forks the workers after loading the app)
+        app.before_first_request(self.start)
+        atexit.register(self.stop)
+
+    # start the thread (again after the worker process was forked)
+    def start(self):
+        if self.app is None or (self.pid == os.getpid() and self.thread.is_alive()):
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.queue = queue.Queue(QUEUE_SIZE)
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='notification-relay')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def enqueue(self, ids):
+        self.start()
+        if self.queue is None:
+            return
+        for index, id in enumerate(ids):
+            try:
+                self.queue.put(id, timeout=ENQUEUE_TIMEOUT)
+            except queue.Full:
+                # backpressure: the remaining events stay in the outbox until the next sweep
+                logging.warning('Notification queue full, ' + str(len(ids) - index) + ' notifications left for the sweep')
+                return
+
+    # wait for the first event, then collect until the batch is full or the flush interval is over
+    def collect(self):
+        try:
+            ids = [self.queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + FLUSH_INTERVAL
+        while len(ids) < BATCH_SIZE:
+            try:
+                ids.append(self.queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return ids
+
+    def run(self):
+        lastsweep = 0
+        while True:
+            ids = self.collect()
+            if None in ids:
+                ids.remove(None)
+                self.flush(ids, sweep_outbox=False)
+                return
+            sweep_outbox = time.time() - lastsweep > SWEEP_INTERVAL
+            if sweep_outbox:
+                lastsweep = time.time()
+            self.flush(ids, sweep_outbox)
+
+    def flush(self, ids, sweep_outbox):
+        if not ids and not sweep_outbox:
+            return
+        with self.app.app_context():
+            try:
+                count = move(outbox.c.id.in_(ids)) if ids else 0
+                if sweep_outbox:
+                    count += sweep()
+                db.session.commit()
+                if count:
+                    logging.info('Moved ' + str(count) + ' notifications from the outbox')
+            except Exception as e:
+                # the events stay in the outbox and are moved by a later sweep
+                db.session.rollback()
+                logging.error('Exception on moving notifications: ' + str(e))
+
+    # flush the queued events when the process exits
+    def stop(self):
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                return
+            self.thread.join(timeout=5)
+
+
+relay = NotificationRelay()
@@ -0,0 +1,87 @@
+# Ticket and flight number allocation
+#
+# Numbers are drawn from database sequences instead of being picked at random, so they never collide and an
+# insert never has to be retried. Every sequence counts up in blocks of BLOCK_SIZE (INCREMENT BY BLOCK_SIZE):
+# a worker process reserves a whole block with one nextval() and hands out the numbers of the block
+# from memory, so only one booking in BLOCK_SIZE costs a round trip to the sequence.
+#
+# The sequence values are mapped into the existing format ([A-Z0-9] with 7 characters for tickets, 6 for flights)
+# by a bijective affine map modulo 36^length, followed by a base 36 encoding. Different values always give
+# different numbers, and consecutive values give numbers that do not look consecutive.
+# Numbers that were generated at random before can still collide with an allocated one (a few in billions),
+# the unique constraints keep rejecting those.
+
+import os, threading
+
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+BLOCK_SIZE = 100
+
+
+class NumberSpaceExhausted(Exception):
+    pass
+
+
+# modular inverse of a modulo m (a and m coprime)
+def inverse(a, m):
+    previous, current, x0, x1 = a % m, m, 1, 0
+    while current:
+        quotient = previous // current
+        previous, current = current, previous - quotient * current
+        x0, x1 = x1, x0 - quotient * x1
+    return x0 % m
+
+
+# bijective mapping between the integers [0, 36^length) and the strings [0-9A-Z]{length}
+class NumberCodec(object):
+
+    def __init__(self, length, offset=0):
+        self.length = length
+        self.modulus = len(ALPHABET) ** length
+        # multiplier close to the golden ratio of the modulus, coprime to 36 so the map is a bijection
+        multiplier = int(self.modulus * 0.6180339887) | 1
+        while multiplier % 3 == 0:
+            multiplier += 2
+        self.multiplier = multiplier
+        self.offset = offset % self.modulus
+        self.inverse = inverse(multiplier, self.modulus)
+
+    def encode(self, value):
+        if not 0 <= value < self.modulus:
+            raise NumberSpaceExhausted('No more numbers with ' + str(self.length) + ' characters')
+        value = (value * self.multiplier + self.offset) % self.modulus
+        chars = []
+        for _ in range(self.length):
+            value, digit = divmod(value, len(ALPHABET))
+            chars.append(ALPHABET[digit])
+        return ''.join(reversed(chars))
+
+    def decode(self, number):
+        value = 0
+        for char in number:
+            value = value * len(ALPHABET) + ALPHABET.index(char)
+        return (value - self.offset) * self.inverse % self.modulus
+
+
+# hands out the numbers of a block reserved from a sequence (one block per worker process and sequence)
+# fetch() returns the first value of the next free block (nextval of a sequence with INCREMENT BY block)
+class NumberAllocator(object):
+
+    def __init__(self, codec, fetch, block=BLOCK_SIZE):
+        self.codec = codec
+        self.fetch = fetch
+        self.block = block
+        self.next = 0
+        self.end = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            # a forked worker process must not share the block of its parent
+            if self.next >= self.end or self.pid != os.getpid():
+                self.next = self.fetch()
+                self.end = self.next + self.block
+                self.pid = os.getpid()
+            value = self.next
+            self.next += 1
+        return self.codec.encode(value)
@@ -0,0 +1,66 @@
+# Keyset (seek) pagination for the collection resources
+#
+# Collections are ordered by their primary key and every page continues after the last key of the previous page
+# ("WHERE id > :last ORDER BY id LIMIT :limit"), so fetching a page costs the same no matter how deep it is.
+# The response body stays a plain list, the opaque cursor of the next page is returned in the Link and
+# X-Next-Cursor headers:
+#
+#   GET /v1/seat?limit=500
+#   Link: <https://.../v1/seat?cursor=WzUwMF0&limit=500>; rel="next"
+
+import json, base64, binascii
+
+from flask import request, jsonify
+from werkzeug.urls import url_encode
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class CursorError(Exception):
+    pass
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps([value]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (ValueError, TypeError, binascii.Error):
+        raise CursorError('Invalid cursor')
+    if not isinstance(value, list) or len(value) != 1:
+        raise CursorError('Invalid cursor')
+    return value[0]
+
+# requested page size, capped at MAX_LIMIT
+def page_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+# fetch the page of a query that follows the cursor of the request, ordered by the key column
+# returns the rows of the page and the cursor of the next page (None on the last page)
+def paginate(query, key):
+    limit = page_limit()
+    cursor = request.args.get('cursor')
+    if cursor:
+        last = decode_cursor(cursor)
+        if not isinstance(last, key.type.python_type) or isinstance(last, bool):
+            raise CursorError('Invalid cursor')
+        query = query.filter(key > last)
+
+    rows = query.order_by(key).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(getattr(rows[-1], key.key))
+
+# json response for a page with the link to the next page
+def page_response(result, next_cursor):
+    response = jsonify(result)
+    response.status_code = 200
+    if next_cursor:
+        link = request.base_url + '?' + url_encode({'cursor': next_cursor, 'limit': page_limit()})
+        response.headers['Link'] = '<' + link + '>; rel="next"'
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
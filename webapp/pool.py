@@ -0,0 +1,123 @@
+# Connection pool of the PostgreSQL engine
+#
+# Every uWSGI worker process has its own pool, so the number of connections to the server is up to
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW). Settings (environment, see create_app):
+#
+#   DB_POOL_SIZE          connections kept open per worker (default 5)
+#   DB_MAX_OVERFLOW       extra connections opened under load and closed again (default 10)
+#   DB_POOL_TIMEOUT       seconds to wait for a free connection before failing the request (default 30)
+#   DB_POOL_RECYCLE       seconds after which a connection is reopened (default 1800, below the Azure idle timeout)
+#   DB_POOL_PRE_PING      test connections on checkout and reconnect dropped ones (default on)
+#   DB_STATEMENT_TIMEOUT  statement timeout in milliseconds (default 0 = none)
+#   DB_PGBOUNCER          connect through PgBouncer in transaction pooling mode: no pool in the worker (NullPool),
+#                         PgBouncer keeps the connections, the statement timeout is set per transaction (SET LOCAL)
+#                         because PgBouncer does not pass on startup options
+#
+# The pool counts checkouts, the time spent waiting for a connection, overflow connections and timeouts
+# per worker process (see /v1/metrics).
+
+import time, threading
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool, NullPool
+
+
+# QueuePool that measures the checkouts
+class MeteredQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.overflows = 0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            with self.metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self.metrics_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                # waiting for a free connection (or for a new one to be opened) rather than taking an idle one
+                if waited > 0.001:
+                    self.waits += 1
+
+    # a connection opened beyond the pool size
+    def _inc_overflow(self):
+        opened = QueuePool._inc_overflow(self)
+        if opened and self._overflow > 0:
+            with self.metrics_lock:
+                self.overflows += 1
+        return opened
+
+    def stats(self):
+        with self.metrics_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'overflow_events': self.overflows,
+                'timeouts': self.timeouts,
+            }
+
+
+# Flask-SQLAlchemy with the pool settings it does not support itself (pre-ping, statement timeout, PgBouncer)
+class PooledSQLAlchemy(SQLAlchemy):
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if not info.drivername.startswith('postgresql'):
+            return
+
+        timeout = int(app.config.get('DB_STATEMENT_TIMEOUT') or 0)
+        if app.config.get('DB_PGBOUNCER'):
+            options['poolclass'] = NullPool
+            for option in ('pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow'):
+                options.pop(option, None)
+            self.local_timeout = timeout
+        else:
+            options['poolclass'] = MeteredQueuePool
+            options['pool_pre_ping'] = bool(app.config.get('DB_POOL_PRE_PING', True))
+            if timeout:
+                options.setdefault('connect_args', {})['options'] = '-c statement_timeout=' + str(timeout)
+            self.local_timeout = 0
+
+    def get_engine(self, app=None, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if getattr(self, 'local_timeout', 0) and getattr(engine, 'local_timeout', None) is None:
+            engine.local_timeout = LocalStatementTimeout(self.local_timeout)
+            event.listen(engine, 'begin', engine.local_timeout)
+        return engine
+
+
+# sets the statement timeout at the begin of every transaction (through PgBouncer)
+class LocalStatementTimeout(object):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def __call__(self, connection):
+        connection.execute('SET LOCAL statement_timeout = ' + str(self.timeout))
+
+
+# metrics of the pool of an engine (only the pool status without a metered pool, e.g. with PgBouncer)
+def stats(engine):
+    if isinstance(engine.pool, MeteredQueuePool):
+        return engine.pool.stats()
+    return {'pool': engine.pool.status()}
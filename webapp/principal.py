@@ -0,0 +1,173 @@
+# Cached principal for authentication and role checks
+#
+# Flask-Security loads the User for every request (session or token) and Flask-Principal then walks its roles
+# (roles_users), so even a trivial GET costs several queries. Here the user id, email, active flag, password hash
+# and role names are loaded with one query and kept in a bounded TTL cache of the worker process. The cached
+# principal stands in for the User as current_user, so @login_required, @roles_required, @roles_accepted and
+# has_role() run without queries. A verified auth token is remembered as well (verifying its hash is slow).
+# Bearer tokens (see tokens.py) carry the principal themselves and are not cached.
+#
+# Committed changes of users and roles (e.g. through UserAdmin / RoleAdmin) invalidate the cached principals.
+# With CACHE_BACKEND=uwsgi the principals are kept in the uWSGI cache shared by all workers (see cache.py), so an
+# invalidation reaches every worker at once (a changed role clears the whole shared cache). With the local backend
+# only the worker that made the change drops its principals, the other workers keep serving the old principal
+# (e.g. a revoked admin role) for up to PRINCIPAL_CACHE_TTL seconds. Principals are loaded from the primary, also
+# in requests that read from a replica, so a reload after an invalidation sees the change.
+#
+#   PRINCIPAL_CACHE_SIZE  principals per worker process (default 1024, local backend)
+#   PRINCIPAL_CACHE_TTL   seconds (default 5)
+
+import threading
+from collections import namedtuple
+
+from flask import current_app
+from flask_security import UserMixin
+from flask_security.utils import verify_hash
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from webapp.model import db, User, Role
+from webapp.cache import LocalCache, UWSGICache, MISSING
+from webapp.routing import primary
+from webapp import tokens
+
+RoleName = namedtuple('RoleName', ['name'])
+
+
+# the User as far as authentication and role checks need it
+class Principal(UserMixin):
+
+    def __init__(self, id, email, active, password, roles):
+        self.id = id
+        self.email = email
+        self.active = active
+        self.password = password
+        self.roles = tuple(RoleName(name) for name in roles)
+        self.rolenames = frozenset(roles)
+
+    # a role name or Role
+    def has_role(self, role):
+        return getattr(role, 'name', role) in self.rolenames
+
+
+class PrincipalCache(object):
+
+    def __init__(self):
+        self.principals = LocalCache()
+        self.tokens = LocalCache()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        size, ttl = app.config.get('PRINCIPAL_CACHE_SIZE', 1024), app.config.get('PRINCIPAL_CACHE_TTL', 5)
+        if app.config.get('CACHE_BACKEND', 'local') == 'uwsgi':
+            self.principals = UWSGICache(app.config.get('CACHE_UWSGI_NAME', 'airlinews'), ttl)
+        else:
+            self.principals = LocalCache(size, ttl)
+        # verified auth tokens stay in the worker (a changed password changes the principal, see from_request)
+        self.tokens = LocalCache(size, ttl)
+        # replace the loaders of Flask-Security
+        app.login_manager.user_loader(self.get)
+        app.login_manager.request_loader(self.from_request)
+
+    # the principal of a user id (None if there is no such user)
+    def get(self, user_id):
+        principal = self.lookup(user_id)
+        if principal is MISSING:
+            principal = load(user_id)
+            self.store(user_id, principal)
+        return principal
+
+    # the cached principal (MISSING on a miss), for callers that load the principal themselves (see asgi.py)
+    def lookup(self, user_id):
+        principal = self.principals.get('principal:' + str(user_id))
+        with self.lock:
+            if principal is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return principal
+
+    def store(self, user_id, principal):
+        if principal is not None:
+            self.principals.set('principal:' + str(user_id), principal)
+
+    # the principal of the bearer token (calls to /v1) or of the auth token of a request (same lookup as Flask-Security)
+    def from_request(self, request):
+        security = current_app.extensions['security']
+        token = tokens.bearer(request.headers.get('Authorization'))
+        if token and request.blueprint == 'api':
+            claims = tokens.decode(token)
+            return from_claims(claims) if claims else security.login_manager.anonymous_user()
+
+        token = request.args.get(security.token_authentication_key,
+                                 request.headers.get(security.token_authentication_header))
+        if request.is_json:
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                token = data.get(security.token_authentication_key, token)
+
+        if token:
+            try:
+                user_id, digest = security.remember_token_serializer.loads(token, max_age=security.token_max_age)
+                principal = self.get(user_id)
+                # verify the token again when the password has changed
+                if principal is not None and (self.tokens.get(token) == principal.password or verify_hash(digest, principal.password)):
+                    self.tokens.set(token, principal.password)
+                    return principal
+            except Exception:
+                pass
+        return security.login_manager.anonymous_user()
+
+    def invalidate(self, user_id):
+        self.principals.delete('principal:' + str(user_id))
+
+    def clear(self):
+        self.principals.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+# the principal of the claims of a bearer token (no query)
+def from_claims(claims):
+    return Principal(int(claims['sub']), claims.get('email'), True, None, claims.get('roles', []))
+
+# load a principal (one query, on the primary)
+def load(user_id):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    with primary():
+        rows = db.session.query(User.id, User.email, User.active, User.password, Role.name) \
+            .outerjoin(User.roles).filter(User.id == user_id).all()
+    if not rows:
+        return None
+    id, email, active, password = rows[0][:4]
+    return Principal(id, email, active, password, [row[4] for row in rows if row[4] is not None])
+
+
+principals = PrincipalCache()
+
+# users and roles changed in the current transaction of a session (invalidated after the commit)
+@event.listens_for(SignallingSession, 'after_flush')
+def after_flush(session, flush_context):
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, User):
+            session.info.setdefault('principals', set()).add(instance.id)
+        elif isinstance(instance, Role):
+            # a renamed or deleted role changes the principals of all its users
+            session.info['principals_all'] = True
+
+@event.listens_for(SignallingSession, 'after_commit')
+def after_commit(session):
+    if session.info.pop('principals_all', False):
+        principals.clear()
+    for user_id in session.info.pop('principals', ()):
+        principals.invalidate(user_id)
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('principals_all', None)
+    session.info.pop('principals', None)
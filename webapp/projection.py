@@ -0,0 +1,27 @@
+# Column-projected reads for the read endpoints
+#
+# The read endpoints only dump the columns behind the fields of their output schema. Loading full ORM entities for
+# that pays for the identity map, the instance state and the attribute instrumentation of every row (and keeps
+# them all in the session until the request ends). query() selects just those columns instead, the rows are
+# lightweight named tuples (the KeyedTuple rows of a column query) with the columns as attributes, so the schema
+# dumps them exactly like the entities:
+#
+#   projection.query(Ticket, tickets_schema, Ticket.id)    columns of TicketSchema (+ the key for pagination)
+#
+# Fields without a column (e.g. SeatSchema.number) are not selected and stay missing in the output, as they are
+# for the entities. Handlers that change the rows they read keep loading entities.
+
+from sqlalchemy import inspect
+from webapp.model import db
+
+
+# the columns of a model behind the dumped fields of a schema, plus extra columns (e.g. the pagination key)
+def columns(model, schema, *extra):
+    mapped = inspect(model).column_attrs
+    names = [field.attribute or name for name, field in schema.fields.items() if not field.load_only]
+    selected = [getattr(model, name) for name in names if name in mapped]
+    return selected + [column for column in extra if column.key not in names]
+
+# query returning the rows of a model for dumping with a schema
+def query(model, schema, *extra):
+    return db.session.query(*columns(model, schema, *extra))
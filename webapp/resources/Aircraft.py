@@ -1,9 +1,14 @@
-from flask import request, json,jsonify
+from flask import request, json
 from flask_restful import Resource
 from flask_security import login_required
 from webapp.model import db, Aircraft, AircraftSchema, Flight, FlightSchema, Ticket, TicketSchema, Seat, SeatSchema
+from webapp.seatmap import compile_layout, invalidate, LayoutError
+from webapp.pagination import paginate, page_response, CursorError
+from webapp.streaming import wants_ndjson, ndjson_response
+from webapp import projection
+from webapp.cache import get_aircraft, invalidate_aircraft
 from marshmallow import ValidationError
-import sys
+import sys, logging
 
 # schemas can also be used as a Serializer
 aircrafts_schema = AircraftSchema(many=True)
@@ -12,15 +17,20 @@ aircraft_schema = AircraftSchema()
 
 class AircraftsResource(Resource):
 
-    # dump all aircrafts
+    # dump all aircrafts (one page at a time)
     @login_required
     def get(self):
-        aircrafts = Aircraft.query.all()
+        # stream all aircrafts for an NDJSON export
+        if wants_ndjson():
+            return ndjson_response(projection.query(Aircraft, aircraft_schema, Aircraft.id), Aircraft.id, aircraft_schema)
+
+        try:
+            aircrafts, cursor = paginate(projection.query(Aircraft, aircraft_schema, Aircraft.id), Aircraft.id)
+        except CursorError as e:
+            return {'message': str(e)}, 400
         # return aircraft_schema.dump(aircrafts, many=True).data
         result = aircraft_schema.dump(aircrafts, many=True).data
-        response = jsonify(result)
-        response.status_code = 200
-        return response
+        return page_response(result, cursor)
 
      # Create an aircraft
     @login_required
@@ -42,15 +52,27 @@ class AircraftsResource(Resource):
         aircraft = Aircraft.query.filter_by(aircraft=data['aircraft']).first()
         if aircraft:
             return {'message': 'Aircraft already exists'}, 400
+
+        # the optional seat layout template must compile and match the seatcount
+        if data.get('layout'):
+            try:
+                seats = compile_layout(data['layout'])
+            except LayoutError as e:
+                return {'message': 'Invalid seat layout: ' + str(e)}, 422
+            if len(seats) != data['seatcount']:
+                return {'message': 'Seat layout has ' + str(len(seats)) + ' seats but seatcount is ' + str(data['seatcount'])}, 422
          
         # TODO: creating an object could be done via the pre_load method in the schema
         aircraft = Aircraft(
             aircraft=data['aircraft'],
-            seatcount=data['seatcount']
+            seatcount=data['seatcount'],
+            layout=data.get('layout')
             )
 
         db.session.add(aircraft)
         db.session.commit()
+        invalidate_aircraft(aircraft.aircraft)
+        invalidate(aircraft.aircraft)
         result = aircraft_schema.dump(aircraft).data
         # return 200 OK, 201 would be 'created'
         return {'message': "success", 'data': result}, 200
@@ -75,7 +97,7 @@ class AircraftResource(Resource):
         #       return {'message': 'No input data provided'}, 400
 
         if aircraft:
-            aircraft = Aircraft.query.filter_by(aircraft=aircraft).first()
+            aircraft = get_aircraft(aircraft)
             result = aircraft_schema.dump(aircraft).data
             # return 200 OK, 201 would be 'created'
             return {'message': "success", 'data': result}, 200
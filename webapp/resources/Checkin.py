@@ -1,4 +1,5 @@
 import sys, string, logging, traceback
+from collections import OrderedDict
 
 from flask import request, json,jsonify, session
 from flask_restful import Resource
@@ -6,7 +7,10 @@ from flask_security import login_required, roles_required, roles_accepted
 from flask_login import current_user
 from sqlalchemy import exc
 from marshmallow import fields, pprint, Schema
-from webapp.model import db, Aircraft, Flight, Seat, Ticket, AircraftSchema, FlightSchema, SeatSchema, TicketSchema
+from webapp.model import db, Aircraft, Seat, Ticket, AircraftSchema, FlightSchema, SeatSchema, TicketSchema
+from webapp.cache import get_flight
+from webapp import availability, booking, bulk
+from webapp.allocator import allocator, POLICIES
 
 flights_schema = FlightSchema(many=True)
 flight_schema = FlightSchema()
@@ -26,9 +30,18 @@ class CheckinResource(Resource):
     def post(self):
         
         json_data = request.get_json(force=True)
-        if not json_data:
+        if not json_data or not isinstance(json_data, dict):
             return {'message': 'No input data provided'}, 400
         
+        # batch check-in of a list of tickets or of all tickets of a booking
+        if "tickets" in json_data or "booking-number" in json_data:
+            return self.post_batch(json_data)
+
+        # seat policy for a ticket without a seat
+        seatallocator = allocator(json_data.get('seat-preference'))
+        if seatallocator is None:
+            return {'message': 'Unknown seat-preference, please choose one of ' + ', '.join(sorted(POLICIES))}, 400
+
         # with flight and ticket, try to do the checkin
 
         ticket = None
@@ -43,7 +56,7 @@ class CheckinResource(Resource):
             if "ticket-number" in json_data and "flight-number" in json_data:
 
                 ticket = Ticket.query.filter_by(number=json_data['ticket-number']).first()
-                flight = Flight.query.filter_by(flightnumber=json_data['flight-number']).first()
+                flight = get_flight(json_data['flight-number'])
 
                 if not ticket is None and not flight is None:
                    logging.info("Retrieved flight [" + flight.flightnumber + "] and ticket [" + ticket.number  + "]")
@@ -62,28 +75,26 @@ class CheckinResource(Resource):
             if not ticket.status == "valid" or not flight.status == "valid":
                 return {'message': 'Either flight or ticket are invalid!'}, 400
 
+            # the ticket must be booked for the flight
+            if ticket.flightnumber != flight.flightnumber:
+                return {'message': 'Ticket is not booked for this flight'}, 400
+
             # a valid seat has to be assigned to ticket
             # is seat preassigned / "reserved" to ticket ? mark checked in
             
             seat = Seat.query.filter_by(ticketnumber=ticket.number).first()
+            claimed = None
             
             if seat:
-                seat.checkinstatus=True
-                db.session.add(seat)
-                ticket.seat_id=seat.id
-                db.session.add(ticket)
-            else: # choose random seat and mark checked in 
-                seat = Seat.query.filter_by(flightnumber=flight.flightnumber).first()
-                if seat:
-                    seat.ticketnumber=ticket.number
-                    seat.checkinstatus=True
-                    db.session.add(seat)
-                    ticket.seat_id=seat.id
-                    db.session.add(ticket)
-                else:
+                booking.check_in([ticket.number])
+            else: # choose a free seat (following the seat policy) and mark checked in 
+                claimed = seatallocator.claim(flight.flightnumber, ticket.number)
+                if claimed is None:
                     return {'message': 'No more seats available on flight!'}, 400
             # return booked seat
             db.session.commit()
+            if claimed is not None:
+                availability.booked(flight.flightnumber, *claimed)
 
             return {"Location": '/v1/ticket/'+ticket.number}, 200
 
@@ -102,4 +113,43 @@ class CheckinResource(Resource):
 
     @login_required
     def delete(self):
-        return {}, 204
\ No newline at end of file
+        return {}, 204
+
+    # check in many tickets in one transaction
+    # {"tickets": [...]} or {"booking-number": ...}, optionally limited to the tickets of a "flight-number"
+    # returns the outcome for every ticket
+    def post_batch(self, json_data):
+        if not json_data or not isinstance(json_data, dict):
+            return {'message': 'No input data provided'}, 400
+        if "booking-number" in json_data:
+            ticketnumbers = [row[0] for row in db.session.query(Ticket.number)
+                             .filter_by(bookingnumber=json_data['booking-number']).order_by(Ticket.id)]
+            if not ticketnumbers:
+                return {'message': 'Booking does not exist !'}, 400
+        else:
+            ticketnumbers = json_data['tickets']
+            if not isinstance(ticketnumbers, list) or not ticketnumbers or not all(isinstance(t, str) for t in ticketnumbers):
+                return {'message': 'Please provide a list of ticket-numbers!'}, 400
+            # every ticket only once (in request order)
+            ticketnumbers = list(OrderedDict.fromkeys(ticketnumbers))
+        if len(ticketnumbers) > bulk.MAX_ITEMS:
+            return {'message': 'Please provide at most ' + str(bulk.MAX_ITEMS) + ' tickets per request'}, 413
+
+        seatallocator = allocator(json_data.get('seat-preference'))
+        if seatallocator is None:
+            return {'message': 'Unknown seat-preference, please choose one of ' + ', '.join(sorted(POLICIES))}, 400
+
+        try:
+            claimed, results = bulk.check_in(ticketnumbers, json_data.get('flight-number'), seatallocator.policy)
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            logging.info("Exception:" + str(e))
+            return {'message' : 'Exception on check-in: ' + str(e)}, 400
+
+        for flightnumber, seatlabel, seatrow in claimed:
+            availability.booked(flightnumber, seatlabel, seatrow)
+        checkedin = sum(1 for result in results if result['status'] == 'checked in')
+        logging.info("Checked in " + str(checkedin) + " of " + str(len(results)) + " tickets")
+        return {'checked-in': checkedin, 'failed': len(results) - checkedin, 'tickets': results}, 200
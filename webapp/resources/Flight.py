@@ -6,25 +6,52 @@ from flask_security import login_required, roles_required, roles_accepted
 from flask_login import current_user
 from sqlalchemy import exc
 from marshmallow import fields, pprint
-from webapp.model import db, Aircraft, Flight, AircraftSchema, FlightSchema, FlightsSchema, Ticket, TicketSchema, Seat, SeatSchema, Notification, NotificationSchema
-
-flights_schema = FlightSchema(many=True)
-flight_schema = FlightSchema()
+from webapp.model import db, Flight, AircraftSchema, FlightSchema, FlightsSchema, Ticket, TicketSchema, Seat, SeatSchema, NotificationSchema
+from webapp.seatmap import seatmap
+from webapp.pagination import paginate, page_response, CursorError
+from webapp.streaming import wants_ndjson, ndjson_response
+from webapp.notifications import notify_tickets
+from webapp.cache import get_flight, get_aircraft, invalidate_flight
+from webapp import availability, counters, search, projection, conditional
+from webapp.serializers import compile_schema
+
+flights_schema = compile_schema(FlightSchema(many=True))
+flight_schema = compile_schema(FlightSchema())
+flight_schema_ex = compile_schema(FlightsSchema())
+
+
+# insert all seats of a flight with a single multi-row INSERT and create its seat counters
+# (does not commit, the caller commits flight and seats together)
+def precreate_seats(flight, seats):
+    rows = [
+        dict(ticketnumber=None, flightnumber=flight.flightnumber, seatlabel=label, seatrow=row,
+             checkinstatus=False, parent_id=flight.id)
+        for label, row in seats
+    ]
+    if rows:
+        db.session.execute(Seat.__table__.insert().values(rows))
+    counters.create(flight.flightnumber, len(rows))
+    return len(rows)
 
 
 class FlightsResource(Resource):
 
 
-    # Dump all flights
+    # Dump all flights (one page at a time)
     @login_required
     @roles_required('admin')
     def get(self):
         
-        flights = Flight.query.all()
+        # stream all flights for an NDJSON export
+        if wants_ndjson():
+            return ndjson_response(projection.query(Flight, flight_schema_ex, Flight.id), Flight.id, flight_schema_ex)
+
+        try:
+            flights, cursor = paginate(projection.query(Flight, flight_schema_ex, Flight.id), Flight.id)
+        except CursorError as e:
+            return {'message': str(e)}, 400
         
-        # dump all using schema
-        flight_schema_ex = FlightsSchema()
-        return flight_schema_ex.dump(flights, many=True).data
+        return page_response(flight_schema_ex.dump(flights, many=True).data, cursor)
         
 
     # Create new flight
@@ -36,7 +63,6 @@ class FlightsResource(Resource):
         if not json_data:
             return {'message': 'No input data provided'}, 400
         # Validate & deserialize input
-        flight_schema = FlightSchema()
         data, errors = flight_schema.load(json_data)
         if errors:
             return errors, 422
@@ -55,7 +81,7 @@ class FlightsResource(Resource):
                 #if flight:
                 #    return {'message': 'Flightnumber already exists'}, 400
 
-                aircraft = Aircraft.query.filter_by(aircraft=data['aircraft']).first()
+                aircraft = get_aircraft(data['aircraft'])
                 if not aircraft:
                     return {'message': 'Aircraft does not exist'}, 400
 
@@ -67,28 +93,16 @@ class FlightsResource(Resource):
                     aircraft=json_data['aircraft']
                     )
 
-                # commit flights now or else seats wont have flight-id's                
+                # flush (not commit) the flight so the seats get the flight-id,
+                # flight and seats are committed together in one transaction
                 db.session.add(flight)
-                db.session.commit()
+                db.session.flush()
 
-                # precreate all seats for the flight (limited by aircraft seatcount)
-                # expand all combinations of [A-H][0-9] and insert them into seats.seatlabel seats.seatrow
-                count = 0
+                # precreate all seats of the (cached) seat map of the aircraft
                 logging.info('Aircraft seatcount is: ' + str(aircraft.seatcount))
-                #while count <= aircraft.seatcount:
-                for label in range(ord('A'), ord('H')): 
-
-                    for row in range(1,20): 
-                        if count == aircraft.seatcount:
-                            logging.info('Created number of seats: '+ str(count))
-                            break
-                                                
-                        seat = Seat(None,flight.flightnumber,chr(label),row, flight.id)
-                    
-                        logging.info('Pre-creating seat no. '+ str(count) +' [' + chr(label)+ str(row)+'] for flight '+flight.flightnumber)
-                        db.session.add(seat)
-                        count+=1
-                        
+                count = precreate_seats(flight, seatmap(aircraft))
+                logging.info('Created number of seats: '+ str(count) + ' for flight ' + flight.flightnumber)
+
                 db.session.commit()
             except (exc.IntegrityError, exc.InvalidRequestError):
                 logging.error("ERROR for creating new flight")
@@ -109,9 +123,22 @@ class FlightsResource(Resource):
     def delete(self):
         return {"message": 'Not implemented'}, 204
 
+class FlightSearchResource(Resource):
+
+    # Search the flights of a route departing in a date window, with their seats left (see search.py)
+    # ?start=STR&end=FRA&date=2018-10-10&days=3
+    @login_required
+    @roles_accepted('admin','customer')
+    def get(self):
+        try:
+            start, end, date, days = search.parse_args(request.args)
+        except search.SearchError as e:
+            return {'message': str(e)}, 400
+        return search.search(start, end, date, days), 200
+
 class FlightResource(Resource):
     
-    # Get a flight by flightnumber
+    # Get a flight by flightnumber (304 if the client has the current version, see conditional.py)
     @login_required
     @roles_accepted('admin','customer')
     def get(self, flightnumber):
@@ -119,13 +146,17 @@ class FlightResource(Resource):
         
         if flightnumber:
             #flights = Flight.query.all()
-            flight = Flight.query.filter_by(flightnumber=flightnumber).first()
+            flight = get_flight(flightnumber)
             if flight is None:
                 return {'message': 'No flight found with number ' + str(flightnumber)}, 404
             else:
+                tag = conditional.etag(flight.flightnumber, flight.version)
+                if conditional.requested(tag):
+                    return conditional.not_modified('flight', tag)
                 result = flight_schema.dump(flight).data
                 response = jsonify(result)
                 response.status_code = 200
+                response.headers.extend(conditional.headers('flight', tag))
                 return response
                 #return {json.dumps(result)}, 200
         else:
@@ -143,45 +174,30 @@ class FlightResource(Resource):
                 if not flight:
                     return {'message': 'Flightnumber does not exist'}, 400
                 else:
-                    # flight deletion must: 
+                    # flight deletion must (with a fixed number of set-based statements in one transaction):
+                    tickets = Ticket.__table__
                     
                     # a) update existing tickets: 
                     #       - set status cancelled
                     #       - remove seat bookings 
                     #         (do not unset flightnumber - 
                     #          or booking new flight with same passportnumber will fail)
-                    tickets = Ticket.query.filter_by(flightnumber=flightnumber).all()
-                    for ticket in tickets:
-                        ticket.status="cancelled"
-                        #ticket.flightnumber=None
-                        ticket.seat_id=None
-                        db.session.add(ticket)
-
-                        # create notification for each cancelled ticket 
-                        notificationstring = "The flight " + flightnumber + " was canceled"
-                        logging.info(notificationstring)
-                        notification = Notification(
-                            title="Flight canceled",
-                            message = notificationstring,
-                            ticketnumber = ticket.number 
-                        )
-                        db.session.add(notification)
+                    db.session.execute(tickets.update().where(tickets.c.flightnumber == flightnumber).values(
+                        status="cancelled", seat_id=None))
 
-                    db.session.commit()
-                    
-                    # b) update existing seats:
-                    #       - remove ticket assignments
-                    seats = Seat.query.filter_by(flightnumber=flightnumber).all()
-                    for seat in seats:
-                        seat.ticketnumber=None
-                        db.session.add(seat)
-                    db.session.commit()
+                    # create notification for each cancelled ticket 
+                    notificationstring = "The flight " + flightnumber + " was canceled"
+                    logging.info(notificationstring)
+                    notify_tickets(tickets.c.flightnumber == flightnumber, "Flight canceled", notificationstring)
                     
-                    # c) delete all seats for the flight
-                    Seat.query.filter_by(flightnumber=flightnumber).delete()
-                    #db.session.delete(seats)
-                    db.session.delete(flight)
+                    # b) delete all seats for the flight (including their ticket assignments)
+                    db.session.execute(Seat.__table__.delete().where(Seat.__table__.c.flightnumber == flightnumber))
+
+                    # c) delete the flight (and its seat counters)
+                    db.session.execute(Flight.__table__.delete().where(Flight.__table__.c.flightnumber == flightnumber))
                     db.session.commit()
+                    invalidate_flight(flightnumber)
+                    availability.forget(flightnumber)
 
                     return {"message": "Successfully cancelled flight and all seats"}, 200
         except Exception as e:
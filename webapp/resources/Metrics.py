@@ -0,0 +1,17 @@
+import os
+
+from flask_restful import Resource
+from flask_security import login_required, roles_required
+from webapp import cache, pool, search
+from webapp.routing import router
+from webapp.principal import principals
+from webapp.model import db
+
+class MetricsResource(Resource):
+
+    # Get the metrics of the worker process that handles the request
+    @login_required
+    @roles_required('admin')
+    def get(self):
+        return {'pid': os.getpid(), 'cache': cache.stats(), 'search': search.results.stats(), 'pool': pool.stats(db.engine),
+                'routing': router.stats(), 'principals': principals.stats()}, 200
@@ -4,12 +4,14 @@ from flask import request, json,jsonify, session
 from flask_restful import Resource
 from flask_security import login_required, roles_required, roles_accepted
 from flask_login import current_user
-from sqlalchemy import exc
+from sqlalchemy import exc, func
 from marshmallow import fields, pprint
 from webapp.model import db, Ticket, TicketSchema, Notification, NotificationSchema
+from webapp.serializers import compile_schema
+from webapp import projection, conditional
 
-notifications_schema = NotificationSchema(many=True)
-notification_schema = NotificationSchema()
+notifications_schema = compile_schema(NotificationSchema(many=True))
+notification_schema = compile_schema(NotificationSchema())
 
 class NotificationResource(Resource):
 
@@ -27,12 +29,20 @@ class NotificationResource(Resource):
 
             if pattern.match(ticketnumber):
 
+                # number and latest timestamp of the notifications (etag, see conditional.py)
+                count, latest = db.session.query(func.count(), func.max(Notification.timestamp)) \
+                    .filter(Notification.ticketnumber == ticketnumber).one()
+                tag = conditional.etag(count, latest.isoformat() if latest else '')
+                if count and conditional.requested(tag):
+                    return conditional.not_modified('notifications', tag)
+
                 # get all notifications for ticketnumber ordered by their timestamp
-                notifications = Notification.query.filter_by(ticketnumber=ticketnumber).order_by("timestamp").all()
+                notifications = projection.query(Notification, notifications_schema) \
+                    .filter_by(ticketnumber=ticketnumber).order_by(Notification.timestamp).all()
 
                 if notifications:
                     #dump notifications for a specific ticket    
-                    return notifications_schema.dump(notifications, many=True).data
+                    return notifications_schema.dump(notifications, many=True).data, 200, conditional.headers('notifications', tag)
                 else:
                     return {'message': 'No notifications found for ticketnumber ' + ticketnumber}, 200
             else:
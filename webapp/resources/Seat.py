@@ -1,25 +1,38 @@
 import sys, re, logging, sqlalchemy
 
-from flask import request, jsonify
+from flask import request
 from flask_restful import Resource
 from flask_security import login_required
 from flask_login import current_user
-from webapp.model import db, Aircraft, Flight, AircraftSchema, FlightSchema, Ticket, TicketSchema, Seat, SeatSchema, Notification, NotificationSchema
-
-seat_schema = SeatSchema(many=True)
-seat_schema = SeatSchema()
+from webapp.model import db, Aircraft, AircraftSchema, FlightSchema, Ticket, TicketSchema, Seat, SeatSchema, NotificationSchema
+from webapp.seatmap import seatmap_for, seatcode
+from webapp import booking
+from webapp.notifications import notify
+from webapp.cache import get_flight
+from webapp import availability, bulk, projection
+from webapp.pagination import paginate, page_response, CursorError
+from webapp.streaming import wants_ndjson, ndjson_response
+from webapp.serializers import compile_schema
+
+seats_schema = compile_schema(SeatSchema(many=True))
+seat_schema = compile_schema(SeatSchema())
 ticket_schema = TicketSchema()
 
 class SeatsResource(Resource):
     
-    # Return all seats
+    # Return all seats (one page at a time)
     @login_required
     def get(self):
-        seats = Seat.query.all()
-        result = seat_schema.dump(seats)
-        response = jsonify(result)
-        response.status_code = 200
-        return response
+        # stream all seats for an NDJSON export
+        if wants_ndjson():
+            return ndjson_response(projection.query(Seat, seat_schema, Seat.id), Seat.id, seat_schema)
+
+        try:
+            seats, cursor = paginate(projection.query(Seat, seats_schema, Seat.id), Seat.id)
+        except CursorError as e:
+            return {'message': str(e)}, 400
+        result = seats_schema.dump(seats).data
+        return page_response(result, cursor)
 
     # Create new seat
     @login_required
@@ -37,65 +50,51 @@ class SeatsResource(Resource):
             return {'error': 'Please provide ticketnumber, flightnumber, seatlabel and seatrow !'}, 404
 
         # is this a valid flight?
-        flight = Flight.query.filter_by(flightnumber=seat_postdata['flightnumber']).first()
+        flight = get_flight(seat_postdata['flightnumber'])
         if not flight:
             return {'message': 'Flight number does not exist'}, 422
 
-        # is this a valid ticket?
-        ticket = Ticket.query.filter_by(number=seat_postdata['ticketnumber']).first()
-        if not ticket or ticket.status!="valid":
-            return {'message': 'Ticket number does not exist'}, 422
-        
+        # is this a valid seat for this flight? (checked against the cached seat map of the aircraft)
+        seats = seatmap_for(flight.aircraft)
+        if seats is None or seatcode(seat_postdata['seatlabel'], seat_postdata['seatrow']) not in seats:
+            return {'message': 'Seat does not exist'}, 422
+
         try:
-            
-             # is this ticketnumber already booked for a another seat?
-            seat = Seat.query.filter_by(flightnumber=seat_postdata["flightnumber"]).filter_by(ticketnumber=seat_postdata['ticketnumber']).first()
-            if seat:
-                return {'message': 'Ticket already booked for another seat'}, 422
 
-            # is this requested ticketnumber already stored for a seat?
-            seat = Seat.query.filter_by(flightnumber=seat_postdata["flightnumber"]).filter_by(seatlabel=seat_postdata['seatlabel'], seatrow=seat_postdata['seatrow']).filter_by(ticketnumber=seat_postdata['ticketnumber']).first()
-            if seat:
-                return {'message': 'Ticket already booked for requested seat'}, 422
+            # claim the seat with a single conditional update (only succeeds if the seat is still free,
+            # the ticket is valid, booked for the flight and has no other seat yet)
+            result, seat_id = booking.claim_seat(seat_postdata['flightnumber'], seat_postdata['ticketnumber'],
+                                                 seat_postdata['seatlabel'], seat_postdata['seatrow'])
 
-            # is the requested seat already booked by someone else?
-            seat = Seat.query.filter_by(flightnumber=seat_postdata["flightnumber"]).filter_by(seatlabel=seat_postdata['seatlabel'], seatrow=seat_postdata['seatrow']).filter(Seat.ticketnumber != None).first()
-            if seat:
-                return {'message': 'Seat already taken for this flight!'}, 422    
-                
-            # is this a valid seat for this flight? 
-            seat = Seat.query.filter_by(flightnumber=seat_postdata["flightnumber"]).filter_by(seatlabel=seat_postdata['seatlabel'], seatrow=seat_postdata['seatrow']).first()
-            if not seat:
+            if result == booking.INVALID_TICKET:
+                return {'message': 'Ticket number does not exist'}, 422
+            elif result == booking.OTHER_FLIGHT:
+                return {'message': 'Ticket is not booked for this flight'}, 422
+            elif result == booking.ALREADY_BOOKED:
+                return {'message': 'Ticket already booked for another seat'}, 422
+            elif result == booking.ALREADY_BOOKED_SEAT:
+                return {'message': 'Ticket already booked for requested seat'}, 422
+            elif result == booking.TAKEN:
+                availability.booked(seat_postdata['flightnumber'], seat_postdata['seatlabel'], seat_postdata['seatrow'])
+                return {'message': 'Seat already taken for this flight!'}, 422
+            elif result == booking.NONEXISTENT:
                 return {'message': 'Seat does not exist'}, 422
-            else:
-
-                # seat exists and is not taken yet
-
-                seat.ticketnumber=seat_postdata['ticketnumber']
-                seatcode = seat.ticketnumber+'-'+seat_postdata['seatlabel']+seat_postdata['seatrow']
 
-                # TODO: How can I also enter the seat.id into ticket.seat_id ??
-                ticket.seat_it=seat.id  
-                db.session.add(ticket)
+            # the seat is booked for the ticket
+            bookedseat = seat_postdata['ticketnumber']+'-'+seat_postdata['seatlabel']+seat_postdata['seatrow']
 
-                db.session.commit()
-                    
-                # create a notification for seat booking
-                notificationstring = "Seat " + seat.seatlabel + str(seat.seatrow) + " is booked for your ticket " + seat.ticketnumber + "."
-                logging.info(notificationstring)
-                notification = Notification(
-                    title="Seat Booking",
-                    message = notificationstring,
-                    ticketnumber = seat.ticketnumber
-                )
-
-                db.session.add(notification)
-                db.session.commit()
+            # create a notification for seat booking (committed together with the booking)
+            notificationstring = "Seat " + seat_postdata['seatlabel'] + seat_postdata['seatrow'] + " is booked for your ticket " + seat_postdata['ticketnumber'] + "."
+            logging.info(notificationstring)
+            notify(seat_postdata['ticketnumber'], "Seat Booking", notificationstring)
+            db.session.commit()
+            availability.booked(seat_postdata['flightnumber'], seat_postdata['seatlabel'], seat_postdata['seatrow'])
 
             # return 200 OK, 201 would be created 
-            return {"Location": '/v1/seat/'+seatcode}, 200
+            return {"Location": '/v1/seat/'+bookedseat}, 200
 
         except (sqlalchemy.exc.SQLAlchemyError, sqlalchemy.exc.DBAPIError) as dex:
+            db.session.rollback()
             logging.info("Exception:" + str(dex))
             return {"Error": 'Invalid seatlabel or seatrow selected! (Only A-H for seatlabel and one numeric digit for seatrow allowed)'}, 404
 
@@ -113,6 +112,79 @@ class SeatsResource(Resource):
     def delete(self):
         return {}, 204
 
+class SeatBulkResource(Resource):
+
+    # Assign seats to many tickets of a flight in one transaction (all or nothing)
+    # {"flight-number": ..., "seats": [{"ticket-number": ..., "seat": "B8"}, ...]} assigns the requested seats,
+    # {"flight-number": ..., "tickets": [...]} seats the tickets of a group next to each other
+    @login_required
+    def post(self):
+        json_data = request.get_json(force=True)
+        if not json_data or not isinstance(json_data, dict):
+            return {'message': 'No input data provided'}, 400
+
+        # is this a valid flight?
+        flightnumber = json_data.get('flight-number')
+        flight = get_flight(flightnumber) if isinstance(flightnumber, str) else None
+        if not flight:
+            return {'message': 'Flight number does not exist'}, 422
+        seats = seatmap_for(flight.aircraft)
+        if seats is None:
+            return {'message': 'Flight containing invalid aircraft'}, 422
+
+        items = json_data.get('seats', json_data.get('tickets'))
+        if not isinstance(items, list) or not items:
+            return {'message': 'Please provide a list of seats or tickets'}, 400
+        if len(items) > bulk.MAX_ITEMS:
+            return {'message': 'Please provide at most ' + str(bulk.MAX_ITEMS) + ' items per request'}, 413
+
+        # input validation: every ticket and every seat only once, seats checked against the seat map
+        errors, ticketnumbers, codes, assignments = {}, set(), set(), []
+        for index, item in enumerate(items):
+            if 'seats' in json_data:
+                ticketnumber = item.get('ticket-number') if isinstance(item, dict) else None
+                code = item.get('seat') if isinstance(item, dict) else None
+                if not isinstance(ticketnumber, str) or not isinstance(code, str):
+                    errors[index] = 'Please provide ticket-number and seat !'
+                elif code not in seats:
+                    errors[index] = 'Seat does not exist'
+                elif code in codes:
+                    errors[index] = 'Seat requested more than once'
+                else:
+                    codes.add(code)
+                    assignments.append((ticketnumber,) + seats.positions[seats.index(code)])
+            else:
+                ticketnumber = item
+                if not isinstance(ticketnumber, str):
+                    errors[index] = 'Please provide ticket-numbers !'
+            if index not in errors:
+                if ticketnumber in ticketnumbers:
+                    errors[index] = 'Ticket requested more than once'
+                ticketnumbers.add(ticketnumber)
+        if errors:
+            return {'message': 'Invalid seat assignments', 'errors': errors}, 422
+
+        try:
+            if 'seats' in json_data:
+                assignments, results = bulk.assign_seats(flight.flightnumber, assignments)
+            else:
+                assignments, results = bulk.seat_group(flight.flightnumber, items)
+
+            if assignments is None:
+                db.session.rollback()
+                return {'flight-number': flight.flightnumber, 'seated': 0, 'tickets': results}, 409
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            logging.info("Exception:" + str(e))
+            return {"Error": 'Exception on seat assignment: ' + str(e)}, 400
+
+        for ticketnumber, seatlabel, seatrow in assignments:
+            availability.booked(flight.flightnumber, seatlabel, seatrow)
+        logging.info("Seated " + str(len(assignments)) + " tickets on flight " + flight.flightnumber)
+        return {'flight-number': flight.flightnumber, 'seated': len(assignments), 'tickets': results}, 200
+
 class SeatResource(Resource):
     @login_required
     def delete(self, seatcode):
@@ -130,18 +202,18 @@ class SeatResource(Resource):
                 seatlabel = parts[2][-2]
                 seatrow = parts[2][-1]
                 
-                seat = Seat.query.filter_by(ticketnumber=ticketnumber).first()
-                if not seat:
-                    return {'message': 'No seat booked for ticketnumber ' + str(ticketnumber)}, 422
+                # release the seat with one statement on the locked seat (also updates the counters of the flight
+                # with the check-in status of the seat at the release)
+                released = booking.release_seat(ticketnumber, seatlabel, seatrow)
 
-                seat = Seat.query.filter_by(ticketnumber=ticketnumber).filter_by(seatlabel=seatlabel).filter_by(seatrow=seatrow).first()
-                
-                if not seat:
+                if released is None:
+                    if db.session.query(Seat.id).filter_by(ticketnumber=ticketnumber).first() is None:
+                        return {'message': 'No seat booked for ticketnumber ' + str(ticketnumber)}, 422
                     return {'message': 'Seat ' + str(seatlabel) + str(seatrow) + ' not booked for ticket ' + str(ticketnumber)}, 422
                 else:
-                    #update the seats for the flight by removing the ticketnumber from the entries
-                    seat.ticketnumber = None
+                    Ticket.query.filter_by(number=ticketnumber).update({'seat_id': None}, synchronize_session=False)
                     db.session.commit()
+                    availability.released(*released)
                     return {"message": "Successfully cancelled booking of seat"}, 200
             else:
                 return {"Error": 'Ticketnumber has wrong format. Expecting <Ticketnumber>-<Leatlabel><Seatrow>'}, 404
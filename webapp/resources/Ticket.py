@@ -1,27 +1,38 @@
-import sys, re, logging
+import re, logging
 
 from flask import request, jsonify
 from flask_restful import Resource
 from flask_security import login_required, roles_required, roles_accepted
 from flask_login import current_user
-from webapp.model import db, Aircraft, Flight, AircraftSchema, FlightSchema, Ticket, TicketSchema, Seat, SeatSchema, Notification, NotificationSchema, InvalidPassport
+from webapp.model import db, AircraftSchema, FlightSchema, Ticket, TicketSchema, Seat, SeatSchema, NotificationSchema, InvalidPassport
+from webapp.pagination import paginate, page_response, CursorError
+from webapp.streaming import wants_ndjson, ndjson_response
+from webapp.notifications import notify
+from webapp.cache import get_flight, get_aircraft
+from webapp import availability, booking, bulk, counters, projection, conditional
+from webapp.serializers import compile_schema
 import webapp
 
-tickets_schema = TicketSchema(many=True)
-ticket_schema = TicketSchema(partial=True)
+tickets_schema = compile_schema(TicketSchema(many=True))
+ticket_schema = compile_schema(TicketSchema(partial=True))
 
 class TicketsResource(Resource):
     
-    # Get all tickets
+    # Get all tickets (one page at a time)
     @login_required
     def get(self):
 
-        tickets = Ticket.query.all()
-        result = ticket_schema.dump(tickets)
+        # stream all tickets for an NDJSON export
+        if wants_ndjson():
+            return ndjson_response(projection.query(Ticket, ticket_schema, Ticket.id), Ticket.id, ticket_schema)
+
+        try:
+            tickets, cursor = paginate(projection.query(Ticket, tickets_schema, Ticket.id), Ticket.id)
+        except CursorError as e:
+            return {'message': str(e)}, 400
+        result = tickets_schema.dump(tickets).data
         if result is not None:
-            response = jsonify(result)
-            response.status_code = 200
-            return response
+            return page_response(result, cursor)
         else:
             return '', 204
 
@@ -69,25 +80,19 @@ class TicketsResource(Resource):
                 if ticket:
                     return {'message': 'Seatnumber already booked'}, 404
             
-            # get seatcount from aircraft specified in ticket 
+            # flight and aircraft specified in ticket must exist
             if "flightnumber" in data:
-                flight = Flight.query.filter_by(flightnumber=data["flightnumber"]).first()
+                flight = get_flight(data["flightnumber"])
                 if flight:
-                    aircraft = Aircraft.query.filter_by(aircraft=flight.aircraft).first()
+                    aircraft = get_aircraft(flight.aircraft)
                     if not aircraft:
                         return {'message': 'Ticket containing invalid aircraft'}, 400
-                    else: 
-                        seatcount = aircraft.seatcount
                 else:
                     return {'message': 'Flight does not exist'}, 400
 
-            #try
-
-            # are there tickets left for flight? sum tickets for same flight must be smaller seatcount
-            tickets  = Ticket.query.filter_by(flightnumber=data["flightnumber"])
-            ticketsnumber = tickets.count()
-
-            if ticketsnumber >= seatcount:
+            # are there tickets left for flight? reserve a seat with a conditional update of the seat counters
+            # (concurrent bookings of the flight wait until this one is committed, see counters.py)
+            if counters.reserve(data["flightnumber"]) is None:
                 return {'message': 'No more seats left for this flight'}, 404
 
             # TODO: creating an object could be done via the pre_load method in the schema
@@ -98,24 +103,15 @@ class TicketsResource(Resource):
             )
 
             db.session.add(ticket)
-            db.session.commit()
 
             # Create a notification for ticket booking using the ticketnumber for the just created ticket
-            ticket = Ticket.query.filter_by(passportnumber=data["passportnumber"]).filter_by(flightnumber=data["flightnumber"]).filter(Ticket.status != "cancelled").first()
-            
+            # (committed together with the ticket)
             notificationstring = "Your ticket booking " + ticket.number+ " is successful."
             logging.info(notificationstring)
-            notification = Notification(
-                title = "Booking Successful",
-                message = notificationstring,
-                ticketnumber = ticket.number
-            )
-
-            db.session.add(notification)
+            notify(ticket.number, "Booking Successful", notificationstring)
+            # the ticketnumber is allocated on creation of the ticket, no need to read the ticket again
             db.session.commit()
 
-            result = ticket_schema.dump(ticket).data
-
             # return 200 OK, 201 would be created 
             # return { "status": 'success', 'data': result }, 200
             # After the flight is created the URL to the GET request of this flight is given as a response
@@ -140,6 +136,35 @@ class TicketsResource(Resource):
     def  delete(self):
         return {'message': "Not implemented"}, 204 # 204 = No content
 
+class TicketBulkResource(Resource):
+
+    # Book tickets for a group of passengers (for one or more flights) in one transaction
+    # {"tickets": [{"flight-number": ..., "name": ..., "pass-number": ...}, ...]}
+    # returns the booking number of the group and a result for every passenger (in input order)
+    @login_required
+    def post(self):
+        json_data = request.get_json(force=True)
+        if not json_data:
+            return {'message': 'No input data provided'}, 400
+
+        passengers = json_data.get('tickets') if isinstance(json_data, dict) else json_data
+        if not isinstance(passengers, list) or not passengers:
+            return {'message': 'Please provide a list of tickets'}, 400
+        if len(passengers) > bulk.MAX_ITEMS:
+            return {'message': 'Please provide at most ' + str(bulk.MAX_ITEMS) + ' tickets per request'}, 413
+
+        try:
+            bookingnumber, results = bulk.book_tickets(passengers)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.info("Exception:" + str(e))
+            return {'message' : 'Exception on bulk ticket creation: ' + str(e)}, 400
+
+        bookedcount = sum(1 for result in results if result['status'] == 'booked')
+        logging.info("Booked " + str(bookedcount) + " of " + str(len(results)) + " tickets for booking " + str(bookingnumber))
+        return {'booking-number': bookingnumber, 'booked': bookedcount, 'failed': len(results) - bookedcount, 'tickets': results}, 200
+
 class TicketResource(Resource):
 
     @login_required
@@ -150,13 +175,21 @@ class TicketResource(Resource):
             # only match 7-digit ticketnumbers like T123456
             pattern = re.compile("^([A-Z0-9]{7})$")
             if pattern.match(ticketnumber):
-                
-                ticket = Ticket.query.filter_by(number=ticketnumber).first()
+
+                # a poll of an unchanged ticket only reads its version
+                if conditional.revalidating():
+                    version = db.session.query(Ticket.version).filter_by(number=ticketnumber).scalar()
+                    tag = conditional.etag(ticketnumber, version)
+                    if version is not None and conditional.requested(tag):
+                        return conditional.not_modified('ticket', tag)
+
+                ticket = projection.query(Ticket, ticket_schema, Ticket.version).filter_by(number=ticketnumber).first()
                 if ticket is not None:
                 
                     result = ticket_schema.dump(ticket)
                     response = jsonify(result)
                     response.status_code = 200
+                    response.headers.extend(conditional.headers('ticket', conditional.etag(ticket.number, ticket.version)))
                     return response
                     #return {json.dumps(result)}, 200
                 else:
@@ -177,12 +210,21 @@ class TicketResource(Resource):
     @login_required
     @roles_accepted('user','admin')
     def  delete(self, ticketnumber):
-        logging.info('Current user is: '+ current_user.email, file=sys.stdout)
+        logging.info('Current user is: '+ current_user.email)
         
         try:
             if ticketnumber:
-                Ticket.query.filter_by(number=ticketnumber).delete()
+                # the seat of the ticket is free again (released before the ticket it refers to is deleted)
+                released = booking.release_seat(ticketnumber)
+                tickets = Ticket.__table__
+                deleted = db.session.execute(tickets.delete().where(tickets.c.number == ticketnumber)
+                                             .returning(tickets.c.flightnumber, tickets.c.status)).first()
+                # a valid ticket gives its seat back to the flight
+                if deleted is not None and deleted.status == 'valid':
+                    counters.add(deleted.flightnumber, sold=-1)
                 db.session.commit()
+                if released is not None:
+                    availability.released(*released)
                 return {"status": "Successfully deleted ticket with number "+ticketnumber}, 200
             else:
                 return{"status": "No ticket found with ticketnumber: " + ticketnumber}, 400
@@ -2,21 +2,29 @@ from flask import request, jsonify, url_for, abort, make_response
 from flask_restful import Resource
 from flask_security import login_required
 from webapp.model import db, User, UserSchema
+from webapp.pagination import paginate, page_response, CursorError
+from webapp.streaming import wants_ndjson, ndjson_response
 import sys
 
-users_schema = UserSchema(many=True)
-user_schema = UserSchema()
+# never dump the password hashes
+users_schema = UserSchema(many=True, exclude=('password',))
+user_schema = UserSchema(exclude=('password',))
 
 class UserResource(Resource):
    
-   # Get all users
+   # Get all users (one page at a time)
     @login_required
     def get(self):
-        users = User.query.all()
-        result = user_schema.dump(users)
-        response = jsonify(result)
-        response.status_code = 200
-        return response
+        # stream all users for an NDJSON export
+        if wants_ndjson():
+            return ndjson_response(User.query, User.id, user_schema)
+
+        try:
+            users, cursor = paginate(User.query, User.id)
+        except CursorError as e:
+            return {'message': str(e)}, 400
+        result = users_schema.dump(users).data
+        return page_response(result, cursor)
 
     def post(self):
         #username = request.json.get('username')
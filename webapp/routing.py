@@ -0,0 +1,171 @@
+# Read replica routing
+#
+# GET requests read from a PostgreSQL replica, everything else (and every session outside of a request, e.g.
+# the notification relay) uses the primary. The resources do not change: the session picks its engine
+# in get_bind for the whole request.
+#
+#   DB_REPLICA_HOSTS     comma separated replica hosts (same user, password and database as the primary)
+#   DB_REPLICA_MAX_LAG   seconds a replica may lag behind before reads fall back to the primary (default 5)
+#   DB_STICKY_SECONDS    seconds a client keeps reading from the primary after a write of its own (default 10),
+#                        so a client reads its own bookings (read-your-writes)
+#
+# A client with a session keeps the time of its last write in the session cookie. Bearer clients (calls to /v1
+# with a token, see tokens.py) are stateless and send no cookie back: their writes are kept per token subject in
+# the worker process for DB_STICKY_SECONDS (at most STICKY_SUBJECTS subjects), so a GET of the Location of a new
+# ticket reads from the primary when the same worker serves it. Bearer requests never write to the session.
+#
+# The replicas take turns (round robin). Their lag is checked at most every LAG_CHECK_INTERVAL seconds per
+# worker process: a replica that lags behind, or fails the check, gets no reads until its next check.
+#
+# Reads that are kept beyond the lag of a replica (the invalidated read-through caches, see cache.py, and the
+# principals) read from the primary inside a primary() block, so an invalidated entry is never loaded again from
+# a replica that has not replayed the change yet.
+
+import time, logging, itertools, threading
+from contextlib import contextmanager
+
+from flask import g, request, session, has_request_context, current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, orm
+from webapp.pool import PooledSQLAlchemy
+from webapp import tokens
+
+LAG_CHECK_INTERVAL = 2  # seconds
+STICKY_SUBJECTS = 10000
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# replication lag in seconds (0 if the replica replayed everything it received)
+LAG_QUERY = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+# session that reads from the replica chosen for the request
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None and not self._flushing:
+                return self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+# read from the primary inside the block (for the rest of a request that reads from a replica)
+@contextmanager
+def primary():
+    replica = g.pop('db_replica', None) if has_request_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+
+
+class RoutingSQLAlchemy(PooledSQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# after a write the client reads from the primary for a while
+@event.listens_for(SignallingSession, 'after_commit')
+def after_commit(db_session):
+    if has_request_context() and request.method not in READ_METHODS:
+        g.db_wrote = True
+
+
+class ReplicaRouter(object):
+
+    def __init__(self):
+        self.replicas = []
+        self.lags = {}
+        self.checked = {}
+        self.reads = {}
+        self.fallbacks = 0
+        self.turns = itertools.count()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.replicas = sorted(bind for bind in (app.config.get('SQLALCHEMY_BINDS') or {}) if bind.startswith('replica'))
+        self.max_lag = app.config.get('DB_REPLICA_MAX_LAG', 5)
+        self.sticky = app.config.get('DB_STICKY_SECONDS', 10)
+        # (imported here, cache.py reads from the primary with primary() of this module)
+        from webapp.cache import LocalCache
+        self.writers = LocalCache(STICKY_SUBJECTS, self.sticky)
+        if self.replicas:
+            app.before_request(self.before_request)
+            app.after_request(self.after_request)
+
+    def before_request(self):
+        g.db_replica = None
+        g.db_bearer = bearer_subject()
+        if request.method in READ_METHODS and not self.wrote():
+            g.db_replica = self.choose()
+
+    def after_request(self, response):
+        if g.get('db_wrote'):
+            bearer = g.get('db_bearer')
+            if bearer is None:
+                session['db_primary_until'] = time.time() + self.sticky
+            elif bearer:
+                self.writers.set(bearer, True)
+        return response
+
+    # whether the client wrote within the last DB_STICKY_SECONDS
+    def wrote(self):
+        bearer = g.get('db_bearer')
+        if bearer is None:
+            return session.get('db_primary_until', 0) >= time.time()
+        return bool(bearer) and self.writers.get(bearer) is True
+
+    # the next replica that does not lag behind (None: read from the primary)
+    def choose(self):
+        turn = next(self.turns)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(turn + offset) % len(self.replicas)]
+            if self.lag(replica) <= self.max_lag:
+                with self.lock:
+                    self.reads[replica] = self.reads.get(replica, 0) + 1
+                return replica
+        with self.lock:
+            self.fallbacks += 1
+        return None
+
+    # replication lag of a replica, checked at most every LAG_CHECK_INTERVAL seconds
+    def lag(self, replica):
+        now = time.monotonic()
+        if now - self.checked.get(replica, -LAG_CHECK_INTERVAL) < LAG_CHECK_INTERVAL:
+            return self.lags.get(replica, float('inf'))
+        self.checked[replica] = now
+        try:
+            engine = current_app.extensions['sqlalchemy'].db.get_engine(current_app, bind=replica)
+            with engine.connect() as connection:
+                lag = float(connection.execute(LAG_QUERY).scalar() or 0)
+        except Exception as e:
+            logging.error('Lag check of ' + replica + ' failed: ' + str(e))
+            lag = float('inf')
+        self.lags[replica] = lag
+        return lag
+
+    def stats(self):
+        with self.lock:
+            return {
+                'replicas': dict((replica, {'reads': self.reads.get(replica, 0), 'lag': self.lags.get(replica)})
+                                 for replica in self.replicas if self.lags.get(replica) != float('inf')),
+                'unavailable': [replica for replica in self.replicas if self.lags.get(replica) == float('inf')],
+                'primary_fallbacks': self.fallbacks,
+            }
+
+
+# the subject of the bearer token of a call to /v1 ('' for an invalid token, None without a bearer token)
+def bearer_subject():
+    token = tokens.bearer(request.headers.get('Authorization'))
+    if not token or request.blueprint != 'api':
+        return None
+    claims = tokens.decode(token)
+    return str(claims['sub']) if claims else ''
+
+
+router = ReplicaRouter()
@@ -0,0 +1,879 @@
+# Small benchmark harness for the airline webservice.
+#
+# The benchmarks run against the database configured with DBUSER, DBPASS, DBHOST and DBNAME
+# (same as create_app). Use a local scratch database: benchmarks create and delete their own data!
+#
+# Usage (from the repository root):
+#   python -m webapp.scripts.benchmark <benchmark> [--repeat N]
+#   python -m webapp.scripts.benchmark flight-creation
+#   python -m webapp.scripts.benchmark pool --concurrency 64
+#   python -m webapp.scripts.benchmark serialization --repeat 20
+#   python -m webapp.scripts.benchmark serving --sync-url http://localhost:5000 --async-url http://localhost:8000
+
+import os, re, sys, json, time, argparse, logging, threading, tracemalloc
+import http.client
+from urllib.parse import urlsplit
+from sqlalchemy import func
+
+from webapp.app import create_app
+from datetime import datetime, timedelta
+from webapp.model import db, Aircraft, Flight, FlightCounter, Seat, Ticket, Notification, NotificationOutbox, FlightSchema, FlightsSchema, TicketSchema, SeatSchema, NotificationSchema
+from webapp.seatmap import seatmap
+from webapp.resources.Flight import precreate_seats
+from webapp import availability, booking, pool, counters, model, search, projection
+from webapp.principal import principals
+from webapp.serializers import compile_schema
+
+
+# log in as the admin user that is created on the first request
+def login(app):
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    result = client.post('/login', json={'email': 'admin@airlinews.com', 'password': 'p@ssw0rd'})
+    if result.status_code != 200:
+        sys.exit('Login failed with status ' + str(result.status_code))
+    return client
+
+# median, p95 and max of a list of timings in ms
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'median': timings[len(timings) // 2],
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'max': timings[-1],
+    }
+
+# p99 of a list of timings in ms
+def p99(timings):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+def report(label, timings):
+    stats = summarize(timings)
+    print('{0:<30} median {1:8.2f} ms   p95 {2:8.2f} ms   max {3:8.2f} ms'.format(
+        label, stats['median'], stats['p95'], stats['max']))
+
+
+# latency of POST /v1/flights as the aircraft seatcount grows
+def bench_flight_creation(app, client, args):
+    for seatcount in (10, 50, 100, 133):
+        name = 'BENCH-' + str(seatcount)
+        db.session.add(Aircraft(aircraft=name, seatcount=seatcount))
+        db.session.commit()
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = client.post('/v1/flights', json={
+                'start': 'STR', 'end': 'FRA', 'departure': '2018-10-10T10:00:00Z', 'aircraft': name})
+            timings.append((time.perf_counter() - start) * 1000)
+            if result.status_code != 200:
+                sys.exit('Flight creation failed: ' + result.get_data(as_text=True))
+
+        report('seatcount ' + str(seatcount), timings)
+
+        # remove the benchmark data again
+        flightnumbers = db.session.query(Flight.flightnumber).filter_by(aircraft=name)
+        Seat.query.filter(Seat.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+        Flight.query.filter_by(aircraft=name).delete(synchronize_session=False)
+        Aircraft.query.filter_by(aircraft=name).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# latency of DELETE /v1/flight/<flightnumber> (flight cancellation) for flights with 50 to 5000 tickets
+def bench_flight_cancellation(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-CANCEL').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-CANCEL', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    for ticketcount in (50, 500, 5000):
+        timings = []
+        for _ in range(min(args.repeat, 10)):
+            flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+            db.session.add(flight)
+            db.session.flush()
+            precreate_seats(flight, seatmap(aircraft))
+            tickets = [Ticket(flight.flightnumber, 'Passenger', 'P' + str(i).zfill(6)) for i in range(ticketcount)]
+            db.session.add_all(tickets)
+            db.session.commit()
+
+            start = time.perf_counter()
+            result = client.delete('/v1/flight/' + flight.flightnumber)
+            timings.append((time.perf_counter() - start) * 1000)
+            if result.status_code != 200:
+                sys.exit('Flight cancellation failed: ' + result.get_data(as_text=True))
+
+            # remove the benchmark data again
+            ticketnumbers = [ticket.number for ticket in tickets]
+            db.session.expunge_all()
+            Notification.query.filter(Notification.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+            Ticket.query.filter(Ticket.number.in_(ticketnumbers)).delete(synchronize_session=False)
+            db.session.commit()
+
+        report(str(ticketcount) + ' tickets', timings)
+
+
+# concurrent seat claims (booking.claim_seat): every client claims the seats of a flight in the same order until
+# it got one, so most claims lose against another client; claims/s and seats booked more than once
+def bench_seat_claims(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-CLAIMS').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-CLAIMS', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+    clients = min(args.concurrency, aircraft.seatcount)
+
+    flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+    db.session.add(flight)
+    db.session.flush()
+    precreate_seats(flight, seatmap(aircraft))
+    tickets = [Ticket(flight.flightnumber, 'Passenger', 'P' + str(i).zfill(6)) for i in range(clients)]
+    db.session.add_all(tickets)
+    db.session.commit()
+    flightnumber, ticketnumbers, seats = flight.flightnumber, [ticket.number for ticket in tickets], list(seatmap(aircraft))
+
+    timings, lock = [], threading.Lock()
+    barrier = threading.Barrier(clients)
+
+    def run(ticketnumber):
+        with app.app_context():
+            barrier.wait()
+            for seatlabel, seatrow in seats:
+                start = time.perf_counter()
+                result, seat_id = booking.claim_seat(flightnumber, ticketnumber, seatlabel, seatrow)
+                db.session.commit()
+                with lock:
+                    timings.append((time.perf_counter() - start) * 1000)
+                if result == booking.BOOKED:
+                    break
+
+    threads = [threading.Thread(target=run, args=(number,)) for number in ticketnumbers]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    double = db.session.query(Seat.ticketnumber).filter(Seat.flightnumber == flightnumber, Seat.ticketnumber != None) \
+        .group_by(Seat.ticketnumber).having(func.count() > 1).count()
+    report('claim', timings)
+    print('{0} clients, {1} claims in {2:.2f}s: {3:.0f} claims/s, {4} double bookings'.format(
+        clients, len(timings), elapsed, len(timings) / elapsed, double))
+
+    # remove the benchmark data again
+    db.session.expunge_all()
+    Ticket.query.filter_by(flightnumber=flightnumber).update({'seat_id': None}, synchronize_session=False)
+    Seat.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    Ticket.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    Flight.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# seat availability lookups on a half-booked flight: SQL queries against the availability index
+def bench_availability(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-AVAIL').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-AVAIL', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+    db.session.add(flight)
+    db.session.flush()
+    precreate_seats(flight, seatmap(aircraft))
+    # book every other seat
+    booked = Seat.query.filter_by(flightnumber=flight.flightnumber).filter(Seat.id % 2 == 0).all()
+    tickets = [Ticket(flight.flightnumber, 'Passenger', 'P' + str(i).zfill(6)) for i in range(len(booked))]
+    db.session.add_all(tickets)
+    db.session.flush()
+    for seat, ticket in zip(booked, tickets):
+        seat.ticketnumber = ticket.number
+    db.session.commit()
+    flightnumber = flight.flightnumber
+
+    def measure(label, lookup):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            lookup()
+            timings.append((time.perf_counter() - start) * 1000)
+        report(label, timings)
+
+    free = Seat.query.filter_by(flightnumber=flightnumber, ticketnumber=None)
+    measure('sql is free', lambda: free.filter_by(seatlabel='C', seatrow=10).count())
+    measure('sql seats left', lambda: free.count())
+    measure('sql first free seat', lambda: free.order_by(Seat.seatrow, Seat.seatlabel).first())
+
+    availability.forget(flightnumber)
+    measure('index load', lambda: availability.load(flightnumber))
+    seats = availability.for_flight(flightnumber)
+    measure('index is free', lambda: seats.is_free('C10'))
+    measure('index seats left', lambda: seats.left())
+    measure('index first free seat', lambda: seats.next_free())
+    measure('index nearest free seat', lambda: seats.next_free(near=len(seats.seats) // 2))
+
+    # remove the benchmark data again
+    availability.forget(flightnumber)
+    db.session.expunge_all()
+    Seat.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    Ticket.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    Flight.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# booking a group of passengers ticket by ticket against one POST /v1/ticket/bulk
+def bench_bulk_booking(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-GROUP').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-GROUP', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    for groupsize in (20, 100, 300):
+        for mode in ('single', 'bulk'):
+            timings = []
+            for _ in range(min(args.repeat, 5)):
+                # 300 passengers do not fit into one aircraft, spread them over three flights
+                flights = [Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft) for _ in range(3)]
+                db.session.add_all(flights)
+                db.session.flush()
+                for flight in flights:
+                    precreate_seats(flight, seatmap(aircraft))
+                db.session.commit()
+                passengers = [{'flight-number': flights[i % 3].flightnumber, 'name': 'Passenger', 'pass-number': 'P' + str(i).zfill(6)}
+                              for i in range(groupsize)]
+
+                start = time.perf_counter()
+                if mode == 'single':
+                    for passenger in passengers:
+                        result = client.post('/v1/ticket', json=passenger)
+                        if result.status_code != 200:
+                            sys.exit('Ticket booking failed: ' + result.get_data(as_text=True))
+                else:
+                    result = client.post('/v1/ticket/bulk', json={'tickets': passengers})
+                    if result.status_code != 200 or result.get_json()['failed']:
+                        sys.exit('Bulk booking failed: ' + result.get_data(as_text=True))
+                # time per passenger
+                timings.append((time.perf_counter() - start) * 1000 / groupsize)
+
+                # remove the benchmark data again
+                flightnumbers = [flight.flightnumber for flight in flights]
+                db.session.expunge_all()
+                ticketnumbers = db.session.query(Ticket.number).filter(Ticket.flightnumber.in_(flightnumbers))
+                Notification.query.filter(Notification.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+                Ticket.query.filter(Ticket.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+                Seat.query.filter(Seat.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+                Flight.query.filter(Flight.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+                db.session.commit()
+
+            report(mode + ' ' + str(groupsize) + ' (per ticket)', timings)
+
+
+# capacity check of a booking on flights with 100 to 10000 tickets (most of them cancelled): counting the tickets
+# of the flight against the conditional update of its seat counters, then more concurrent bookings than seats
+def bench_capacity(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-CAPACITY').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-CAPACITY', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    flightnumbers = []
+    for ticketcount in (100, 1000, 10000):
+        flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+        db.session.add(flight)
+        db.session.flush()
+        precreate_seats(flight, seatmap(aircraft))
+        db.session.execute(Ticket.__table__.insert().values([
+            dict(number=model.ticketnumbers.allocate(), flightnumber=flight.flightnumber, passengername='Passenger',
+                 passportnumber='P' + str(i).zfill(6), status='cancelled')
+            for i in range(ticketcount)]))
+        db.session.commit()
+        flightnumber = flight.flightnumber
+        flightnumbers.append(flightnumber)
+
+        checks = (
+            ('count', lambda: Ticket.query.filter_by(flightnumber=flightnumber).count()),
+            ('counter', lambda: counters.reserve(flightnumber)),
+        )
+        for label, check in checks:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                check()
+                db.session.rollback()
+                timings.append((time.perf_counter() - start) * 1000)
+            report(label + ' ' + str(ticketcount) + ' tickets', timings)
+
+    # concurrent bookings of the last flight: every seat is sold exactly once
+    seatcount = len(seatmap(aircraft))
+    clients = [login(app) for _ in range(args.concurrency)]
+    barrier = threading.Barrier(args.concurrency)
+    statuses, lock = [], threading.Lock()
+
+    def run(worker, client):
+        barrier.wait()
+        for i in range(seatcount // args.concurrency + 2):
+            result = client.post('/v1/ticket', json={'flight-number': flightnumber, 'name': 'Passenger',
+                                                     'pass-number': 'C' + str(worker).zfill(3) + str(i).zfill(3)})
+            with lock:
+                statuses.append(result.status_code)
+
+    threads = [threading.Thread(target=run, args=(worker, client)) for worker, client in enumerate(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    sold = Ticket.query.filter_by(flightnumber=flightnumber, status='valid').count()
+    print('{0:<30} {1} bookings in {2:.2f}s   {3} sold of {4} seats   {5} refused'.format(
+        'concurrent bookings', len(statuses), elapsed, sold, seatcount, statuses.count(404)))
+
+    # remove the benchmark data again
+    db.session.expunge_all()
+    ticketnumbers = db.session.query(Ticket.number).filter(Ticket.flightnumber.in_(flightnumbers))
+    Notification.query.filter(Notification.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+    Ticket.query.filter(Ticket.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    Seat.query.filter(Seat.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    Flight.query.filter(Flight.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# flight search on 3000 flights (10 routes, 300 days): the search query alone, the endpoint with an empty result
+# cache (every search queries) and the endpoint answering from the result cache
+def bench_search(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-SEARCH').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-SEARCH', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    routes = [('STR', 'FR' + str(i)) for i in range(10)]
+    first = datetime(2030, 1, 1)
+    flights = [Flight(start, end, first + timedelta(days=day, hours=hour), aircraft.aircraft)
+               for start, end in routes for day in range(300) for hour in (7, 19)][:3000]
+    db.session.add_all(flights)
+    db.session.flush()
+    db.session.execute(FlightCounter.__table__.insert().values([
+        dict(flightnumber=flight.flightnumber, capacity=133, sold=0, assigned=0, checkedin=0) for flight in flights]))
+    db.session.commit()
+    db.session.execute('ANALYZE flights')
+    db.session.commit()
+    flightnumbers = [flight.flightnumber for flight in flights]
+
+    def searches():
+        for i in range(args.repeat):
+            start, end = routes[i % len(routes)]
+            yield start, end, first + timedelta(days=i % 290)
+
+    modes = (
+        ('query', lambda start, end, date: search.search_query(start, end, date, date + timedelta(days=3)).all()),
+        ('endpoint (no cache)', lambda start, end, date: search.results.backend.clear() or
+            client.get('/v1/flights/search?start={0}&end={1}&date={2:%Y-%m-%d}&days=3'.format(start, end, date))),
+        ('endpoint (cached)', lambda start, end, date:
+            client.get('/v1/flights/search?start={0}&end={1}&date={2:%Y-%m-%d}&days=3'.format(start, end, first))),
+    )
+    for label, request in modes:
+        timings = []
+        for start, end, date in searches():
+            begin = time.perf_counter()
+            result = request(start, end, date)
+            timings.append((time.perf_counter() - begin) * 1000)
+            if getattr(result, 'status_code', 200) != 200:
+                sys.exit('Search failed: ' + result.get_data(as_text=True))
+        report(label, timings)
+
+    # remove the benchmark data again (the counters are deleted with the flights)
+    db.session.expunge_all()
+    Flight.query.filter(Flight.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# seating a group seat by seat (POST /v1/seat) against one POST /v1/seat/bulk with automatic group seating
+def bench_group_seating(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-GROUP').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-GROUP', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    for groupsize in (4, 20, 100):
+        for mode in ('single', 'bulk'):
+            timings = []
+            for _ in range(min(args.repeat, 5)):
+                flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+                db.session.add(flight)
+                db.session.flush()
+                seats = seatmap(aircraft)
+                precreate_seats(flight, seats)
+                tickets = [Ticket(flight.flightnumber, 'Passenger', 'P' + str(i).zfill(6)) for i in range(groupsize)]
+                db.session.add_all(tickets)
+                db.session.commit()
+                flightnumber, ticketnumbers = flight.flightnumber, [ticket.number for ticket in tickets]
+
+                start = time.perf_counter()
+                if mode == 'single':
+                    for ticketnumber, (seatlabel, seatrow) in zip(ticketnumbers, seats):
+                        result = client.post('/v1/seat', json={
+                            'ticket-number': ticketnumber, 'Flight-number': flightnumber, 'Seat-label': seatlabel, 'Seat-row': str(seatrow)})
+                        if result.status_code != 200:
+                            sys.exit('Seat booking failed: ' + result.get_data(as_text=True))
+                else:
+                    result = client.post('/v1/seat/bulk', json={'flight-number': flightnumber, 'tickets': ticketnumbers})
+                    if result.status_code != 200:
+                        sys.exit('Group seating failed: ' + result.get_data(as_text=True))
+                timings.append((time.perf_counter() - start) * 1000)
+
+                # remove the benchmark data again
+                availability.forget(flightnumber)
+                db.session.expunge_all()
+                Notification.query.filter(Notification.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+                Ticket.query.filter_by(flightnumber=flightnumber).update({'seat_id': None}, synchronize_session=False)
+                Seat.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+                Ticket.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+                Flight.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+                db.session.commit()
+
+            report(mode + ' group of ' + str(groupsize), timings)
+
+
+# checking in a group ticket by ticket (POST /v1/checkin) against one batch check-in of the booking
+def bench_bulk_checkin(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-GROUP').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-GROUP', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    for groupsize in (20, 100):
+        for mode in ('single', 'batch'):
+            timings = []
+            for _ in range(min(args.repeat, 5)):
+                flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+                db.session.add(flight)
+                db.session.flush()
+                precreate_seats(flight, seatmap(aircraft))
+                tickets = [Ticket(flight.flightnumber, 'Passenger', 'P' + str(i).zfill(6), 'BENCH') for i in range(groupsize)]
+                db.session.add_all(tickets)
+                db.session.commit()
+                flightnumber, ticketnumbers = flight.flightnumber, [ticket.number for ticket in tickets]
+
+                start = time.perf_counter()
+                if mode == 'single':
+                    for ticketnumber in ticketnumbers:
+                        result = client.post('/v1/checkin', json={'ticket-number': ticketnumber, 'flight-number': flightnumber})
+                        if result.status_code != 200:
+                            sys.exit('Check-in failed: ' + result.get_data(as_text=True))
+                else:
+                    result = client.post('/v1/checkin', json={'booking-number': 'BENCH', 'flight-number': flightnumber})
+                    if result.status_code != 200 or result.get_json()['failed']:
+                        sys.exit('Batch check-in failed: ' + result.get_data(as_text=True))
+                timings.append((time.perf_counter() - start) * 1000)
+
+                # remove the benchmark data again
+                availability.forget(flightnumber)
+                db.session.expunge_all()
+                Ticket.query.filter_by(flightnumber=flightnumber).update({'seat_id': None}, synchronize_session=False)
+                Seat.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+                Ticket.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+                Flight.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+                db.session.commit()
+
+            report(mode + ' check-in of ' + str(groupsize), timings)
+
+
+# latency of concurrent requests (threads of one worker process) with different connection pool sizes
+# every pool size gets its own app (pool settings are read from the environment by create_app)
+def bench_pool(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-POOL').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-POOL', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+    flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+    db.session.add(flight)
+    db.session.flush()
+    precreate_seats(flight, seatmap(aircraft))
+    db.session.commit()
+    flightnumber = flight.flightnumber
+
+    for poolsize in (1, 2, 5, 10, 20):
+        os.environ['DB_POOL_SIZE'] = str(poolsize)
+        os.environ['DB_MAX_OVERFLOW'] = '0'
+        poolapp = create_app()
+        clients = [login(poolapp) for _ in range(args.concurrency)]
+        timings, lock = [], threading.Lock()
+        barrier = threading.Barrier(args.concurrency)
+
+        def run(client):
+            barrier.wait()
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                # one page of the seats of a flight (a query on every request)
+                result = client.get('/v1/seat?limit=100')
+                elapsed = (time.perf_counter() - start) * 1000
+                if result.status_code != 200:
+                    sys.exit('Request failed: ' + result.get_data(as_text=True))
+                with lock:
+                    timings.append(elapsed)
+
+        threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        report('pool size ' + str(poolsize), timings)
+        with poolapp.app_context():
+            stats = pool.stats(db.engine)
+            db.get_engine(poolapp).dispose()
+        print('{0:<30} p99 {1:8.2f} ms   {2:8.0f} req/s   waits {3}   wait avg {4} ms   timeouts {5}'.format(
+            '', p99(timings), len(timings) / elapsed, stats.get('waits'), stats.get('wait_avg_ms'), stats.get('timeouts')))
+
+    # remove the benchmark data again
+    Seat.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    Flight.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# requests/second of the uWSGI (Flask) and the ASGI (asyncpg) deployment serving the same requests
+# Start both servers against the benchmark database with about the same memory (e.g. uWSGI with 8 processes and
+#   uvicorn webapp.asgi:app --port 8000 --workers 2), then compare requests/second and the memory (RSS)
+# of their processes:
+#   python -m webapp.scripts.benchmark serialization --repeat 20
+#   python -m webapp.scripts.benchmark serving --sync-url http://localhost:5000 --sync-pid <pid of uwsgi> \
+#       --async-url http://localhost:8000 --async-pid <pid of uvicorn> --concurrency 64
+# Of every SERVING_MIX requests three book: a ticket (POST /v1/ticket), a seat (POST /v1/seat) and a check-in
+# (POST /v1/checkin), the others read a flight, a ticket or its notifications.
+SERVING_MIX = 10
+# bookings of each kind per flight of the serving benchmark (three kinds of 40 fit into the 133 seats)
+SERVING_BOOKINGS = 40
+
+# flights with tickets for the bookings of the serving benchmark and the requests (method, path, body) in order
+def serving_requests(aircraft, count):
+    bookings = count // SERVING_MIX + 1
+    flights = [Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft) for _ in range((bookings - 1) // SERVING_BOOKINGS + 1)]
+    db.session.add_all(flights)
+    db.session.flush()
+    # tickets for the seat bookings (seats from the back) and for the check-ins (seats from the front)
+    codes = seatmap(aircraft).codes
+    seated, checkedin = [], []
+    for flight in flights:
+        precreate_seats(flight, seatmap(aircraft))
+        for i in range(SERVING_BOOKINGS):
+            seated.append((Ticket(flight.flightnumber, 'Passenger', 'S' + str(i).zfill(6)), codes[-1 - i]))
+            checkedin.append(Ticket(flight.flightnumber, 'Passenger', 'C' + str(i).zfill(6)))
+    db.session.add_all([ticket for ticket, code in seated] + checkedin)
+    db.session.commit()
+
+    reads = ['/v1/flight/' + flights[0].flightnumber] + \
+            ['/v1/ticket/' + ticket.number for ticket in checkedin[:100]] + \
+            ['/v1/ticket/' + ticket.number + '/notifications' for ticket in checkedin[:100]]
+    requests = []
+    for i in range(count):
+        kind, booking = i % SERVING_MIX, i // SERVING_MIX
+        flightnumber = flights[booking // SERVING_BOOKINGS].flightnumber
+        if kind == 0:
+            requests.append(('POST', '/v1/ticket', {'flight-number': flightnumber, 'name': 'Passenger',
+                                                    'pass-number': 'B' + str(booking % SERVING_BOOKINGS).zfill(6)}))
+        elif kind == 1:
+            ticket, code = seated[booking]
+            requests.append(('POST', '/v1/seat', {'ticket-number': ticket.number, 'Flight-number': flightnumber,
+                                                  'Seat-label': code[0], 'Seat-row': code[1:]}))
+        elif kind == 2:
+            requests.append(('POST', '/v1/checkin', {'ticket-number': checkedin[booking].number, 'flight-number': flightnumber,
+                                                     'seat-preference': 'front-to-back'}))
+        else:
+            requests.append(('GET', reads[(i - 3 * booking) % len(reads)], None))
+    return [flight.flightnumber for flight in flights], requests
+
+def bench_serving(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-SERVING').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-SERVING', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+
+    for name, url, pid in (('uwsgi', args.sync_url, args.sync_pid), ('asgi', args.async_url, args.async_pid)):
+        if not url:
+            continue
+        # fresh flights and tickets for the bookings of each server
+        flightnumbers, requests = serving_requests(aircraft, args.concurrency * args.repeat)
+        address = urlsplit(url)
+        cookie = http_login(address)
+        timings, lock = {'GET': [], 'POST': []}, threading.Lock()
+        barrier = threading.Barrier(args.concurrency)
+
+        def run(worker):
+            connection = http.client.HTTPConnection(address.hostname, address.port)
+            barrier.wait()
+            for i in range(args.repeat):
+                method, path, payload = requests[worker * args.repeat + i]
+                headers = {'Cookie': cookie}
+                if payload is not None:
+                    headers['Content-Type'] = 'application/json'
+                start = time.perf_counter()
+                connection.request(method, path, body=json.dumps(payload) if payload is not None else None, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                elapsed = (time.perf_counter() - start) * 1000
+                if response.status != 200:
+                    sys.exit('Request ' + method + ' ' + path + ' failed with status ' + str(response.status))
+                with lock:
+                    timings[method].append(elapsed)
+            connection.close()
+
+        threads = [threading.Thread(target=run, args=(worker,)) for worker in range(args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        report(name + ' reads', timings['GET'])
+        report(name + ' bookings', timings['POST'])
+        count = len(timings['GET']) + len(timings['POST'])
+        memory = rss(pid) / 1024 / 1024 if pid else None
+        print('{0:<30} p99 {1:8.2f} ms   {2:8.0f} req/s   RSS {3}   {4} req/s per GB'.format(
+            '', p99(timings['GET'] + timings['POST']), count / elapsed,
+            '{0:.0f} MB'.format(memory) if memory else '-',
+            '{0:.0f}'.format(count / elapsed / memory * 1024) if memory else '-'))
+
+        # remove the benchmark data again
+        db.session.expunge_all()
+        ticketnumbers = db.session.query(Ticket.number).filter(Ticket.flightnumber.in_(flightnumbers))
+        NotificationOutbox.query.filter(NotificationOutbox.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+        Notification.query.filter(Notification.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+        Ticket.query.filter(Ticket.flightnumber.in_(flightnumbers)).update({'seat_id': None}, synchronize_session=False)
+        Seat.query.filter(Seat.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+        Ticket.query.filter(Ticket.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+        Flight.query.filter(Flight.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+        db.session.commit()
+
+# log in to a running server (with the CSRF token of the login form), returns the session cookie
+def http_login(address):
+    connection = http.client.HTTPConnection(address.hostname, address.port)
+    connection.request('GET', '/login')
+    response = connection.getresponse()
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', response.read().decode('utf-8')).group(1)
+    cookie = response.getheader('Set-Cookie').split(';')[0]
+    connection.request('POST', '/login', body=json.dumps({
+        'email': 'admin@airlinews.com', 'password': 'p@ssw0rd', 'csrf_token': token}),
+        headers={'Content-Type': 'application/json', 'Cookie': cookie})
+    response = connection.getresponse()
+    response.read()
+    if response.status != 200:
+        sys.exit('Login failed with status ' + str(response.status))
+    connection.close()
+    return response.getheader('Set-Cookie').split(';')[0]
+
+# resident memory of a process and all its descendants in bytes (Linux)
+def rss(pid):
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/' + entry + '/stat') as stat:
+                    parents[int(entry)] = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, IndexError):
+                continue
+    processes, total = [pid], 0
+    while processes:
+        process = processes.pop()
+        processes.extend(child for child, parent in parents.items() if parent == process)
+        try:
+            with open('/proc/' + str(process) + '/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except IOError:
+            continue
+    return total
+
+
+# reading a page of tickets as ORM entities and as column-projected rows (projection.py): latency and peak memory
+# (tracemalloc) of query and dump for 100, 1000 and 10000 tickets, then GET /v1/ticket?limit=1000
+def bench_projection(app, client, args):
+    aircraft = Aircraft.query.filter_by(aircraft='BENCH-PROJECTION').first()
+    if not aircraft:
+        aircraft = Aircraft(aircraft='BENCH-PROJECTION', seatcount=133)
+        db.session.add(aircraft)
+        db.session.commit()
+    flight = Flight('STR', 'FRA', datetime.utcnow(), aircraft.aircraft)
+    db.session.add(flight)
+    db.session.commit()
+    flightnumber = flight.flightnumber
+    db.session.execute(Ticket.__table__.insert().values([
+        dict(number=model.ticketnumbers.allocate(), flightnumber=flightnumber, passengername='Passenger',
+             passportnumber='P' + str(i).zfill(6), status='cancelled')
+        for i in range(10000)]))
+    db.session.commit()
+    schema = compile_schema(TicketSchema(many=True))
+
+    for count in (100, 1000, 10000):
+        reads = (
+            ('entities', lambda: schema.dump(Ticket.query.filter_by(flightnumber=flightnumber)
+                                             .order_by(Ticket.id).limit(count).all())),
+            ('projected', lambda: schema.dump(projection.query(Ticket, schema, Ticket.id)
+                                              .filter_by(flightnumber=flightnumber).order_by(Ticket.id).limit(count).all())),
+        )
+        for label, read in reads:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                read()
+                timings.append((time.perf_counter() - start) * 1000)
+                db.session.expunge_all()
+            report('{0} {1} tickets'.format(label, count), timings)
+            tracemalloc.start()
+            read()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            db.session.expunge_all()
+            print('{0:<30} peak {1:8.0f} KiB'.format('', peak / 1024))
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = client.get('/v1/ticket?limit=1000')
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.status_code != 200:
+            sys.exit('GET /v1/ticket failed with status ' + str(result.status_code))
+    report('GET /v1/ticket?limit=1000', timings)
+
+    # remove the benchmark data again
+    db.session.expunge_all()
+    Ticket.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    Flight.query.filter_by(flightnumber=flightnumber).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# per-request overhead of authentication on a trivial endpoint (GET /v1/welcome):
+# session cookie with the principal cache, session cookie loading the user on every request (the cache is cleared
+# before each request) and bearer token, plus the verification of a bearer token alone (needs JWT_KEYS)
+def bench_auth(app, client, args):
+    result = client.post('/auth/token', json={'email': 'admin@airlinews.com', 'password': 'p@ssw0rd'})
+    if result.status_code != 200:
+        sys.exit('Token request failed: ' + result.get_data(as_text=True))
+    token = result.get_json()['access-token']
+    bearer = app.test_client()
+
+    modes = (
+        ('session (cached principal)', lambda: client.get('/v1/welcome')),
+        ('session (user query)', lambda: principals.clear() or client.get('/v1/welcome')),
+        ('bearer token', lambda: bearer.get('/v1/welcome', headers={'Authorization': 'Bearer ' + token})),
+    )
+    for label, request in modes:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = request()
+            timings.append((time.perf_counter() - start) * 1000)
+            if result.status_code != 200:
+                sys.exit(label + ' request failed with status ' + str(result.status_code))
+        report(label, timings)
+
+    keys = app.extensions['jwt']
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        keys.decode(token)
+        timings.append((time.perf_counter() - start) * 1000)
+    report('bearer verification only', timings)
+
+
+# dump and load with the marshmallow schemas and with the compiled schemas (serializers.py) for 1, 100 and 100k
+# objects (transient objects, nothing is written to the database)
+def bench_serialization(app, client, args):
+    departure = datetime(2018, 10, 10, 8, 30)
+    flight = Flight('STR', 'FRA', departure, 'A320')
+    ticket = Ticket(flight.flightnumber, 'Jane Doe', 'P123456')
+    ticket.id = 1
+    seat = Seat(ticket.number, flight.flightnumber, 'A', '12', None)
+    notification = Notification('Booking', 'Ticket booked', ticket.number)
+    notification.timestamp = departure
+    dumps = (
+        (FlightSchema, flight),
+        (FlightsSchema, flight),
+        (TicketSchema, ticket),
+        (SeatSchema, seat),
+        (NotificationSchema, notification),
+    )
+    loads = (
+        (FlightSchema, {'start': 'STR', 'end': 'FRA', 'departure': '2018-10-10T08:30:00', 'aircraft': 'A320'}),
+        (TicketSchema, {'flight-number': flight.flightnumber, 'name': 'Jane Doe', 'pass-number': 'P123456'}),
+        (SeatSchema, {'ticket-number': ticket.number, 'Flight-number': flight.flightnumber, 'Seat-label': 'A', 'Seat-row': '12'}),
+    )
+
+    def measure(label, call, count):
+        timings = []
+        for _ in range(args.repeat if count < 100000 else max(1, args.repeat // 10)):
+            start = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - start) * 1000)
+        report(label, timings)
+
+    for count in (1, 100, 100000):
+        for schema_class, obj in dumps:
+            schema = schema_class(many=count > 1, partial=True)
+            compiled = compile_schema(schema)
+            objs = obj if count == 1 else [obj] * count
+            if json.dumps(schema.dump(objs).data) != json.dumps(compiled.dump(objs).data):
+                sys.exit(schema_class.__name__ + ' dumps differ')
+            measure('{0} dump {1}'.format(schema_class.__name__, count), lambda: schema.dump(objs), count)
+            measure('  compiled', lambda: compiled.dump(objs), count)
+        for schema_class, data in loads:
+            schema = schema_class(many=count > 1, partial=True)
+            compiled = compile_schema(schema)
+            items = data if count == 1 else [dict(data) for _ in range(count)]
+            # the marshmallow hooks rename the keys in place, so each run loads fresh copies
+            copies = lambda: dict(items) if count == 1 else [dict(item) for item in items]
+            measure('{0} load {1}'.format(schema_class.__name__, count), lambda: schema.load(copies()), count)
+            measure('  compiled', lambda: compiled.load(copies()), count)
+
+
+BENCHMARKS = {
+    'flight-creation': bench_flight_creation,
+    'flight-cancellation': bench_flight_cancellation,
+    'seat-claims': bench_seat_claims,
+    'availability': bench_availability,
+    'bulk-booking': bench_bulk_booking,
+    'capacity': bench_capacity,
+    'search': bench_search,
+    'group-seating': bench_group_seating,
+    'bulk-checkin': bench_bulk_checkin,
+    'pool': bench_pool,
+    'serving': bench_serving,
+    'auth': bench_auth,
+    'serialization': bench_serialization,
+    'projection': bench_projection,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the airline webservice')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients (pool, serving, capacity and seat-claims benchmarks)')
+    parser.add_argument('--sync-url', help='base URL of the uWSGI server (serving benchmark)')
+    parser.add_argument('--sync-pid', type=int, help='pid of the uWSGI master process (serving benchmark)')
+    parser.add_argument('--async-url', help='base URL of the ASGI server (serving benchmark)')
+    parser.add_argument('--async-pid', type=int, help='pid of the ASGI server process (serving benchmark)')
+    args = parser.parse_args()
+
+    app = create_app()
+    # keep the per-request logging out of the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    client = login(app)
+
+    with app.app_context():
+        BENCHMARKS[args.benchmark](app, client, args)
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,10 @@ DROP TABLE IF EXISTS public.aircrafts CASCADE;
 DROP TABLE IF EXISTS public.alembic_version CASCADE; 
 DROP TABLE IF EXISTS public.role CASCADE;
 DROP TABLE IF EXISTS public.user CASCADE;
-DROP TABLE IF EXISTS public.roles_users CASCADE;
\ No newline at end of file
+DROP TABLE IF EXISTS public.roles_users CASCADE;
+DROP TABLE IF EXISTS public.notifications CASCADE;
+DROP TABLE IF EXISTS public.notificationoutbox CASCADE;
+DROP TABLE IF EXISTS public.flightcounters CASCADE;
+DROP SEQUENCE IF EXISTS ticketnumber_seq;
+DROP SEQUENCE IF EXISTS flightnumber_seq;
+DROP SEQUENCE IF EXISTS bookingnumber_seq;
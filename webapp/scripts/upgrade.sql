@@ -0,0 +1,46 @@
+-- Upgrade an existing database to the current model
+-- (new tables are created by db.create_all() on the first request)
+
+ALTER TABLE public.aircrafts ADD COLUMN IF NOT EXISTS layout JSON;
+
+-- a ticket can only be booked for one seat (fails if a ticket is booked for several seats already)
+CREATE UNIQUE INDEX IF NOT EXISTS ix_seats_ticketnumber ON public.seats (ticketnumber) WHERE ticketnumber IS NOT NULL;
+
+-- indexes for the hot lookups (fail if the data violates the unique ones)
+CREATE UNIQUE INDEX IF NOT EXISTS ix_seats_flightnumber_seat ON public.seats (flightnumber, seatlabel, seatrow);
+CREATE INDEX IF NOT EXISTS ix_tickets_flightnumber ON public.tickets (flightnumber);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_tickets_passportnumber_flightnumber ON public.tickets (passportnumber, flightnumber) WHERE status <> 'cancelled';
+CREATE INDEX IF NOT EXISTS ix_notifications_ticketnumber_timestamp ON public.notifications (ticketnumber, "timestamp");
+
+-- ticket and flight numbers are allocated from sequences in blocks of 100 (see numbering.py)
+CREATE SEQUENCE IF NOT EXISTS ticketnumber_seq INCREMENT BY 100;
+CREATE SEQUENCE IF NOT EXISTS flightnumber_seq INCREMENT BY 100;
+
+-- booking reference of the tickets of a group booking
+ALTER TABLE public.tickets ADD COLUMN IF NOT EXISTS bookingnumber VARCHAR(10);
+CREATE INDEX IF NOT EXISTS ix_tickets_bookingnumber ON public.tickets (bookingnumber);
+CREATE SEQUENCE IF NOT EXISTS bookingnumber_seq INCREMENT BY 100;
+
+-- seat counters per flight (see counters.py), rebuilt from the seats and tickets of the existing flights
+CREATE TABLE IF NOT EXISTS public.flightcounters (
+    flightnumber VARCHAR(10) PRIMARY KEY REFERENCES public.flights (flightnumber) ON DELETE CASCADE,
+    capacity INTEGER NOT NULL,
+    sold INTEGER NOT NULL,
+    assigned INTEGER NOT NULL,
+    checkedin INTEGER NOT NULL
+);
+INSERT INTO public.flightcounters (flightnumber, capacity, sold, assigned, checkedin)
+SELECT f.flightnumber,
+       (SELECT count(*) FROM public.seats s WHERE s.flightnumber = f.flightnumber),
+       (SELECT count(*) FROM public.tickets t WHERE t.flightnumber = f.flightnumber AND t.status = 'valid'),
+       (SELECT count(*) FROM public.seats s WHERE s.flightnumber = f.flightnumber AND s.ticketnumber IS NOT NULL),
+       (SELECT count(*) FROM public.seats s WHERE s.flightnumber = f.flightnumber AND s.ticketnumber IS NOT NULL AND s.checkinstatus)
+FROM public.flights f
+ON CONFLICT (flightnumber) DO NOTHING;
+
+-- flights of a route by departure (flight search)
+CREATE INDEX IF NOT EXISTS ix_flights_start_end_date ON public.flights (start, "end", date);
+
+-- row versions of flights and tickets, counted up by every update (ETags, see conditional.py)
+ALTER TABLE public.flights ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE public.tickets ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,80 @@
+# Flight search
+#
+#   GET /v1/flights/search?start=STR&end=FRA&date=2018-10-10&days=3
+#
+# returns the valid flights of a route departing in a date window (from 00:00 UTC of date for days days, at most
+# MAX_DAYS) ordered by departure, at most MAX_RESULTS flights, each with the seats left for booking (from the
+# seat counters, see counters.py). The search is one range scan of the index on (start, end, date) of the
+# flights, joined to the counters by their primary key.
+#
+# Results are cached for a short time (per worker process, or per uWSGI instance with CACHE_BACKEND=uwsgi), so the
+# searches for popular routes reach the database at most once per SEARCH_CACHE_TTL. The seats left of a cached
+# result can be that old, a booking checks the seats left itself. Results are never invalidated, so searches
+# read from a replica in GET requests (see routing.py) and the cache adds no lag beyond the replica's own.
+#
+#   SEARCH_CACHE_TTL   seconds (default 10)
+#   SEARCH_CACHE_SIZE  cached results per worker process (default 256)
+
+import re
+from datetime import datetime, timedelta
+
+from webapp.model import db, Flight, FlightCounter, FlightSearchSchema
+from webapp.cache import ReadThroughCache, LocalCache, UWSGICache
+from webapp.serializers import compile_schema
+
+MAX_DAYS = 14
+MAX_RESULTS = 100
+
+# airport codes like STR
+airportpattern = re.compile("^([A-Z0-9]{3})$")
+
+search_schema = compile_schema(FlightSearchSchema(many=True))
+
+
+class SearchError(Exception):
+    pass
+
+
+# start, end, first day and number of days of a search request (raises SearchError on invalid arguments)
+def parse_args(args):
+    start, end = args.get('start', ''), args.get('end', '')
+    if not airportpattern.match(start) or not airportpattern.match(end):
+        raise SearchError('Please provide start and end (3-character airport codes) !')
+    try:
+        date = datetime.strptime(args.get('date', ''), '%Y-%m-%d')
+    except ValueError:
+        raise SearchError('Please provide date as YYYY-MM-DD !')
+    try:
+        days = int(args.get('days', 1))
+    except ValueError:
+        raise SearchError('Please provide days between 1 and ' + str(MAX_DAYS) + ' !')
+    if not 1 <= days <= MAX_DAYS:
+        raise SearchError('Please provide days between 1 and ' + str(MAX_DAYS) + ' !')
+    return start, end, date, days
+
+# flights of a route departing in [departure, until) with their seats left
+def search_query(start, end, departure, until):
+    return db.session.query(Flight.flightnumber, Flight.start, Flight.end, Flight.date, Flight.aircraft,
+                            (FlightCounter.capacity - FlightCounter.sold).label('seatsleft')) \
+        .join(FlightCounter, FlightCounter.flightnumber == Flight.flightnumber) \
+        .filter(Flight.start == start, Flight.end == end, Flight.date >= departure, Flight.date < until) \
+        .filter(Flight.status == 'valid').order_by(Flight.date, Flight.flightnumber).limit(MAX_RESULTS)
+
+# the dumped result of a search, cached by "start|end|date|days"
+def load_search(key):
+    start, end, date, days = key.split('|')
+    departure = datetime.strptime(date, '%Y-%m-%d')
+    return search_schema.dump(search_query(start, end, departure, departure + timedelta(days=int(days))).all()).data
+
+results = ReadThroughCache('search', load_search, from_primary=False)
+
+def init_app(app):
+    ttl = app.config.get('SEARCH_CACHE_TTL', 10)
+    if app.config.get('CACHE_BACKEND', 'local') == 'uwsgi':
+        results.backend = UWSGICache(app.config.get('CACHE_UWSGI_NAME', 'airlinews'), ttl)
+    else:
+        results.backend = LocalCache(app.config.get('SEARCH_CACHE_SIZE', 256), ttl)
+
+# the flights found for a search (a list of dumped flights)
+def search(start, end, date, days=1):
+    return results.get('|'.join((start, end, date.strftime('%Y-%m-%d'), str(days))))
@@ -0,0 +1,166 @@
+# Seat layouts of the aircrafts, compiled once into immutable seat maps.
+#
+# A seat layout template is stored as JSON on the aircraft, e.g.:
+#
+#   {
+#     "cabins": [
+#       {"name": "business", "rows": [1, 3], "labels": "AC DF"},
+#       {"name": "economy", "rows": [4, 30], "labels": "ABC DEF"}
+#     ],
+#     "blocked": ["A4", "F4"]
+#   }
+#
+# Every cabin spans a range of rows (first and last row included) and has the same seatlabels in every row.
+# A space in the labels marks an aisle. Blocked seats are not part of the seat map (and never created).
+# Aircrafts without a template use the default layout: seatlabels A-G with rows 1-19, filled up to the seatcount.
+
+import threading
+from types import MappingProxyType
+
+from webapp.cache import get_aircraft
+
+# seatlabels allowed by the seatlabelenum of the seats table
+SEATLABELS = 'ABCDEFGH'
+
+
+class LayoutError(Exception):
+    pass
+
+
+# the immutable seat map of an aircraft: seats are numbered by their index (ordered by row, then label)
+# blocks are the groups of adjacent seats in a row (between aisles or blocked seats)
+class SeatMap(object):
+    __slots__ = ('codes', 'positions', 'cabins', 'cabin_of', 'blocks', 'window', 'aisle', '_index')
+
+    def __init__(self, cabins, seats):
+        # seats: (cabin index, row, label, block, kind) ordered by row and label, seats of the same block
+        # sit next to each other and kind is 'window', 'aisle' or None
+        blocks, window, aisle = {}, set(), set()
+        for index, (cabin, row, label, block, kind) in enumerate(seats):
+            blocks.setdefault(block, []).append(index)
+            if kind == 'window':
+                window.add(index)
+            elif kind == 'aisle':
+                aisle.add(index)
+
+        self.codes = tuple(seatcode(label, row) for cabin, row, label, block, kind in seats)
+        self.positions = tuple((label, row) for cabin, row, label, block, kind in seats)
+        self.cabins = tuple(cabins)
+        self.cabin_of = tuple(seat[0] for seat in seats)
+        self.blocks = tuple(tuple(indexes) for block, indexes in sorted(blocks.items()))
+        self.window = frozenset(window)
+        self.aisle = frozenset(aisle)
+        self._index = MappingProxyType(dict((code, index) for index, code in enumerate(self.codes)))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __contains__(self, code):
+        return code in self._index
+
+    # index of a seatcode like 'B8' (None if the seat does not exist)
+    def index(self, code):
+        return self._index.get(code)
+
+    def code(self, index):
+        return self.codes[index]
+
+    def cabin(self, index):
+        return self.cabins[self.cabin_of[index]]
+
+
+def seatcode(seatlabel, seatrow):
+    return str(seatlabel) + str(seatrow)
+
+# layout template reproducing the seats that were always created for an aircraft without a template:
+# all combinations of [A-G][1-19] in label order, limited by the aircraft seatcount
+def default_layout(seatcount):
+    positions = [(chr(label), row) for label in range(ord('A'), ord('H')) for row in range(1,20)]
+    return {
+        'cabins': [{'name': 'economy', 'rows': [1, 19], 'labels': 'ABCDEFG'}],
+        'blocked': [seatcode(label, row) for label, row in positions[max(seatcount, 0):]],
+    }
+
+# validate a layout template and compile it into a seat map
+def compile_layout(layout):
+    if not isinstance(layout, dict) or not isinstance(layout.get('cabins'), list) or not layout['cabins']:
+        raise LayoutError('A seat layout needs a list of cabins')
+
+    blocked = layout.get('blocked') or []
+    if not isinstance(blocked, list):
+        raise LayoutError('Blocked seats must be a list of seatcodes')
+    blocked = set(str(code) for code in blocked)
+
+    cabins, seats, usedrows, blockcount = [], [], set(), 0
+    for cabin in layout['cabins']:
+        try:
+            name = str(cabin['name'])
+            first, last = int(cabin['rows'][0]), int(cabin['rows'][1])
+            labels = str(cabin['labels'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise LayoutError('Every cabin needs a name, rows [first, last] and labels')
+
+        if first < 1 or last < first:
+            raise LayoutError('Invalid rows for cabin ' + name)
+        if not labels.strip() or any(label not in SEATLABELS + ' ' for label in labels):
+            raise LayoutError('Invalid labels for cabin ' + name + ' (only ' + SEATLABELS + ' and spaces allowed)')
+        if len(set(labels.replace(' ', ''))) != len(labels.replace(' ', '')):
+            raise LayoutError('Duplicate labels for cabin ' + name)
+        if usedrows.intersection(range(first, last + 1)):
+            raise LayoutError('Rows of cabin ' + name + ' overlap with another cabin')
+        usedrows.update(range(first, last + 1))
+
+        cabins.append(name)
+        groups = labels.split()
+        for row in range(first, last + 1):
+            for number, group in enumerate(groups):
+                for label in group:
+                    # blocked seats split a block of adjacent seats
+                    if seatcode(label, row) in blocked:
+                        blockcount += 1
+                        continue
+                    kind = None
+                    if label in (group[0], group[-1]):
+                        outermost = (label == group[0] and number == 0) or (label == group[-1] and number == len(groups) - 1)
+                        kind = 'window' if outermost else 'aisle'
+                    seats.append((len(cabins) - 1, row, label, blockcount, kind))
+                blockcount += 1
+
+    # seats are ordered by row, then by label (cabins may be listed in any order)
+    seats.sort(key=lambda seat: seat[1])
+    return SeatMap(cabins, seats)
+
+
+# compiled seat maps, keyed by aircraft type
+_seatmaps = {}
+_lock = threading.Lock()
+
+# the (cached) seat map of an aircraft
+def seatmap(aircraft):
+    compiled = _seatmaps.get(aircraft.aircraft)
+    if compiled is None:
+        compiled = compile_layout(aircraft.layout or default_layout(aircraft.seatcount))
+        with _lock:
+            compiled = _seatmaps.setdefault(aircraft.aircraft, compiled)
+    return compiled
+
+# the (cached) seat map of an aircraft type, the aircraft is only loaded on a cache miss
+def seatmap_for(aircraftname):
+    compiled = _seatmaps.get(aircraftname)
+    if compiled is None:
+        aircraft = get_aircraft(aircraftname)
+        if aircraft is None:
+            return None
+        compiled = seatmap(aircraft)
+    return compiled
+
+# drop the compiled seat map of an aircraft type (or all of them)
+def invalidate(aircraftname=None):
+    with _lock:
+        if aircraftname is None:
+            _seatmaps.clear()
+        else:
+            _seatmaps.pop(aircraftname, None)
@@ -0,0 +1,242 @@
+# Precompiled (de)serialization of the marshmallow schemas
+#
+# marshmallow walks the fields of a schema for every object it dumps: per field a Marshaller call, a lookup of the
+# value (obj[key] first, an exception, then getattr), error bookkeeping and the hooks of the schema. compile_schema()
+# compiles a schema once into functions specialized for its fields, with the attributes, the output keys (dump_to)
+# and the formatting of each field fixed in generated code, e.g. for FlightsSchema
+#
+#   def dump(obj):
+#       d = dict_class()
+#       v = getattr(obj, 'flightnumber', missing)
+#       if v is not missing:
+#           if callable(v):
+#               v = v()
+#           try:
+#               d['flight-number'] = None if v is None else v if v.__class__ is str else text(v)
+#           except invalid:
+#               raise Fallback()
+#       ...
+#       return d
+#
+# and a loader with the json key renames of the schema (json_keys, see JsonKeysSchema) applied to a copy of the
+# input instead of the pre_load hook.
+#
+# A compiled schema is a drop-in for the schema: dump() and load() return the same (data, errors) as the schema.
+# Whenever an object would not dump cleanly or an input would not load without errors, the compiled functions hand
+# it to the schema itself, so errors and their handling (handle_error) stay marshmallow's. Any other exception of the
+# compiled functions is a bug: it is logged before the schema handles the object. Schemas using features
+# that are not compiled (other hooks, prefix, extra, defaults, ...) are always handled by the schema.
+#
+#   flight_schema = compile_schema(FlightSchema())
+#   flight_schema.dump(flight).data
+
+import logging
+from datetime import datetime
+from marshmallow import fields, utils, ValidationError
+from marshmallow.schema import BaseSchema, MarshalResult, UnmarshalResult, PRE_LOAD
+from webapp.model import JsonKeysSchema
+
+missing = utils.missing
+
+
+# the value of a field is read with getattr from objects that do not support obj[key]
+# (marshmallow tries obj[key] first and falls back to getattr on the TypeError)
+def reads_attributes(kind):
+    getitem = getattr(kind, '__getitem__', None)
+    return getitem is None or (issubclass(kind, tuple) and getitem is tuple.__getitem__)
+
+# python expression formatting the value v of a field like field._serialize, names used go to namespace
+def format_expression(field, name, namespace):
+    kind = type(field)
+    if kind is fields.String:
+        return 'None if v is None else v if v.__class__ is str else text(v)'
+    if kind is fields.Integer and not field.as_string:
+        return 'None if v is None else int(v)'
+    if kind in (fields.Raw, fields.Dict):
+        return 'v'
+    if kind is fields.DateTime and field.dateformat in (None, 'iso', 'iso8601') and not field.localtime:
+        # a naive datetime is UTC, marshmallow's isoformat of it is the naive one with +00:00
+        return "None if v is None else v.isoformat() + '+00:00' if v.__class__ is datetime and v.tzinfo is None " \
+               "else isoformat(v)"
+    serialize = 'serialize_' + str(len(namespace))
+    namespace[serialize] = field._serialize
+    return '%s(v, %r, obj)' % (serialize, name)
+
+# source of a dump function for the fields of a schema
+def dump_source(plan, attributes):
+    lines = ['def dump(obj):', '    d = dict_class()']
+    for attribute, key, expression in plan:
+        if attributes:
+            lines += ['    v = getattr(obj, %r, missing)' % attribute,
+                      '    if v is not missing:',
+                      '        if callable(v):',
+                      '            v = v()']
+        else:
+            lines += ['    v = get_value(%r, obj, missing)' % attribute,
+                      '    if v is not missing:']
+        # a value the field would not format (marshmallow reports an error for it)
+        lines += ['        try:',
+                  '            d[%r] = %s' % (key, expression),
+                  '        except invalid:',
+                  '            raise Fallback()']
+    lines.append('    return d')
+    return '\n'.join(lines)
+
+def is_plain(schema):
+    return not (schema.prefix or schema.extra or schema.only or schema.exclude or schema.opts.fields
+                or schema.opts.additional or schema.__accessor__ or schema.__error_handler__
+                or type(schema).get_attribute is not BaseSchema.get_attribute)
+
+# processors (hooks and validators) of a schema, except the json key renames
+def processors(schema):
+    names = dict((tag, list(attrs)) for tag, attrs in schema.__processors__.items() if attrs)
+    if isinstance(schema, JsonKeysSchema) and names.get((PRE_LOAD, False)) == ['rename_json_keys'] \
+            and type(schema).rename_json_keys is JsonKeysSchema.rename_json_keys:
+        del names[(PRE_LOAD, False)]
+    return names
+
+# (dump for objects read with getattr, dump for other objects), None if the schema is not compiled for dumping
+def compile_dump(schema):
+    if not is_plain(schema) or schema._has_processors and any(tag[0].endswith('dump') for tag in processors(schema)):
+        return None
+    namespace = {'dict_class': schema.dict_class, 'missing': missing, 'text': utils.ensure_text_type,
+                 'isoformat': utils.isoformat, 'datetime': datetime, 'get_value': utils._get_value_for_key,
+                 'invalid': INVALID_VALUE, 'Fallback': Fallback}
+    plan = []
+    for name, field in schema.fields.items():
+        if field.load_only:
+            continue
+        attribute = field.attribute or name
+        if not field._CHECK_ATTRIBUTE or field.default is not missing or '.' in attribute:
+            return None
+        plan.append((attribute, field.dump_to or name, format_expression(field, name, namespace)))
+    dumps = []
+    for attributes in (True, False):
+        code = {}
+        exec(dump_source(plan, attributes), dict(namespace), code)
+        dumps.append(code['dump'])
+    return tuple(dumps)
+
+# (fields to load, json key renames), None if the schema is not compiled for loading
+def compile_load(schema):
+    if not is_plain(schema) or processors(schema):
+        return None
+    plan = []
+    for name, field in schema.fields.items():
+        if field.dump_only:
+            continue
+        key = field.attribute or name
+        if field.missing is not missing or '.' in key:
+            return None
+        kind = type(field)
+        simple = str if kind is fields.String else int if kind is fields.Integer else None
+        plan.append((name, field.load_from, key, field, simple, field.validators, field.required))
+    renames = tuple(schema.json_keys) if isinstance(schema, JsonKeysSchema) else ()
+    return tuple(plan), renames
+
+
+# the compiled functions hand an object or input to the schema
+class Fallback(Exception):
+    pass
+
+# errors of formatting a value that marshmallow's fields turn into validation errors
+INVALID_VALUE = (ValidationError, ValueError, TypeError, AttributeError)
+
+
+class CompiledSchema(object):
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.dumps = compile_dump(schema)
+        self.loads = compile_load(schema)
+        # dump function per type of the dumped objects
+        self.dumpers = {}
+
+    # everything else is the schema's
+    def __getattr__(self, name):
+        return getattr(self.schema, name)
+
+    def dumper(self, kind):
+        dump = self.dumpers.get(kind)
+        if dump is None:
+            dump = self.dumpers[kind] = self.dumps[0] if reads_attributes(kind) else self.dumps[1]
+        return dump
+
+    # same as schema.dump(obj, many)
+    def dump(self, obj, many=None):
+        many = self.schema.many if many is None else bool(many)
+        if self.dumps is not None:
+            if many and utils.is_iterable_but_not_string(obj):
+                obj = list(obj)
+            try:
+                if many:
+                    if not isinstance(obj, list):
+                        raise Fallback()
+                    dumpers, data = self.dumpers, []
+                    for item in obj:
+                        dump = dumpers.get(type(item)) or self.dumper(type(item))
+                        data.append(dump(item))
+                else:
+                    data = self.dumper(type(obj))(obj)
+                return MarshalResult(data, {})
+            except Fallback:
+                pass
+            except Exception:
+                logging.exception('Compiled dump of ' + type(self.schema).__name__ + ' failed')
+        return self.schema.dump(obj, many=many)
+
+    def load_one(self, data, partial):
+        if type(data) is not dict:
+            raise Fallback()
+        plan, renames = self.loads
+        if renames:
+            data = dict(data)
+            for key, name in renames:
+                if data.get(key):
+                    data[name] = data.pop(key)
+        result = self.schema.dict_class()
+        for name, load_from, key, field, simple, validators, required in plan:
+            raw = data.get(name, missing)
+            if raw is missing and load_from:
+                raw = data.get(load_from, missing)
+            if raw is missing:
+                if partial is True or (utils.is_collection(partial) and name in partial):
+                    continue
+                if required:
+                    raise Fallback()
+                continue
+            try:
+                if raw.__class__ is simple:
+                    for validator in validators:
+                        if validator(raw) is False:
+                            raise Fallback()
+                    result[key] = raw
+                else:
+                    result[key] = field.deserialize(raw, load_from or name, data)
+            except ValidationError:
+                # the schema reports the errors
+                raise Fallback()
+        return result
+
+    # same as schema.load(data, many, partial)
+    def load(self, data, many=None, partial=None):
+        many = self.schema.many if many is None else bool(many)
+        partial = self.schema.partial if partial is None else partial
+        if self.loads is not None:
+            try:
+                if many:
+                    if not isinstance(data, list):
+                        raise Fallback()
+                    result = [self.load_one(item, partial) for item in data]
+                else:
+                    result = self.load_one(data, partial)
+                return UnmarshalResult(result, {})
+            except Fallback:
+                pass
+            except Exception:
+                logging.exception('Compiled load of ' + type(self.schema).__name__ + ' failed')
+        return self.schema.load(data, many=many, partial=partial)
+
+
+def compile_schema(schema):
+    return CompiledSchema(schema)
@@ -0,0 +1,31 @@
+# Streaming NDJSON export of the collection resources
+#
+# Requests with "Accept: application/x-ndjson" get the whole collection as newline delimited JSON
+# (one object per line) instead of a page. The rows are read through a server-side cursor in batches
+# and serialized one by one while the response is sent, so memory stays constant for any number of rows.
+#
+#   curl -H 'Accept: application/x-ndjson' https://.../v1/ticket > tickets.ndjson
+
+import json
+
+from flask import request, Response, stream_with_context
+
+NDJSON = 'application/x-ndjson'
+
+# rows fetched per round trip of the server-side cursor
+BATCH_SIZE = 1000
+
+
+# does the client want the NDJSON export instead of a page?
+def wants_ndjson():
+    return request.accept_mimetypes[NDJSON] > request.accept_mimetypes['application/json']
+
+# stream all rows of a query ordered by the key column, each row dumped with the schema
+def ndjson_response(query, key, schema):
+    rows = query.order_by(key).execution_options(stream_results=True).yield_per(BATCH_SIZE)
+
+    def generate():
+        for row in rows:
+            yield json.dumps(schema.dump(row).data) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
@@ -1,10 +1,35 @@
 import unittest
-import os, logging
-import json
-import app
-from flask import Flask
-from app import create_app, db
+from unittest import mock
+import os, re, logging, threading, time
+import json, queue, sqlite3, asyncio, importlib.util
+import sqlalchemy
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+from flask import Flask, Blueprint, request, g
+from sqlalchemy import func
+from sqlalchemy.util import lightweight_named_tuple
+from webapp.app import create_app
+from webapp.model import db, Aircraft, Flight, FlightCounter, Ticket, Seat, Notification, NotificationOutbox, User, Role, roles_users
+from webapp.model import FlightSchema, FlightsSchema, FlightSearchSchema, TicketSchema, BulkTicketSchema, SeatSchema, NotificationSchema
+from webapp.seatmap import compile_layout, default_layout, seatmap, LayoutError
+from webapp.resources.Flight import precreate_seats
+from webapp import booking, bulk, counters, search, projection, conditional, streaming, notifications
+from webapp.notifications import NotificationRelay, relay
+from webapp.pagination import encode_cursor, decode_cursor, CursorError
+from webapp.cache import LocalCache, ReadThroughCache, MISSING, invalidate_aircraft
+from webapp.availability import SeatAvailability
+from webapp.allocator import SeatAllocator, SeatPolicy, POLICIES
+from webapp.pool import MeteredQueuePool
+from webapp.routing import ReplicaRouter, RoutingSQLAlchemy, primary
+from webapp.asyncdb import Statement
+from webapp.principal import Principal, PrincipalCache, load as load_principal
+from webapp.tokens import KeySet, parse_keys
+from webapp import tokens
+from webapp.numbering import NumberCodec, NumberAllocator, NumberSpaceExhausted
+from webapp.serializers import compile_schema
 from base64 import b64encode
+from werkzeug.datastructures import MultiDict
+from flask_login import LoginManager
 
 class AirlinewsTestCase(unittest.TestCase):
     
@@ -39,6 +64,1270 @@ class AirlinewsTestCase(unittest.TestCase):
     def tearDown(self):
         pass  
 
+class SeatMapTestCase(unittest.TestCase):
+
+    layout = {
+        "cabins": [
+            {"name": "business", "rows": [1, 2], "labels": "AC DF"},
+            {"name": "economy", "rows": [3, 4], "labels": "ABC DEF"}
+        ],
+        "blocked": ["B3"]
+    }
+
+    def test_default_layout(self):
+        # without a template the seats [A-G][1-19] are created in label order up to the seatcount
+        seats = compile_layout(default_layout(21))
+        self.assertEqual(len(seats), 21)
+        self.assertIn("A19", seats)
+        self.assertIn("B2", seats)
+        self.assertNotIn("B3", seats)
+        self.assertEqual(len(compile_layout(default_layout(500))), 133)
+
+    def test_layout(self):
+        seats = compile_layout(self.layout)
+        self.assertEqual(len(seats), 19)
+        self.assertEqual(seats.codes[:4], ("A1", "C1", "D1", "F1"))
+        self.assertNotIn("B3", seats)
+        self.assertEqual(seats.cabin(seats.index("E4")), "economy")
+        # blocked seats and aisles split the blocks of adjacent seats
+        self.assertIn(tuple(seats.index(code) for code in ("D3", "E3", "F3")), seats.blocks)
+        self.assertIn((seats.index("A3"),), seats.blocks)
+        self.assertIn(seats.index("F2"), seats.window)
+        self.assertIn(seats.index("C4"), seats.aisle)
+
+    def test_invalid_layout(self):
+        with self.assertRaises(LayoutError):
+            compile_layout({"cabins": [{"name": "economy", "rows": [1, 10], "labels": "ABCX"}]})
+        with self.assertRaises(LayoutError):
+            compile_layout({"cabins": [{"name": "a", "rows": [1, 10], "labels": "AB"}, {"name": "b", "rows": [10, 12], "labels": "AB"}]})
+
+class PaginationTestCase(unittest.TestCase):
+
+    def test_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor(4711)), 4711)
+        self.assertNotIn("=", encode_cursor(1))
+
+    def test_invalid_cursor(self):
+        for cursor in ("", "not a cursor", encode_cursor(1)[:-1] + "!"):
+            with self.assertRaises(CursorError):
+                decode_cursor(cursor)
+
+class NdjsonStreamingTestCase(unittest.TestCase):
+
+    def wants_ndjson(self, accept):
+        with Flask(__name__).test_request_context(headers={'Accept': accept}):
+            return streaming.wants_ndjson()
+
+    def test_accept(self):
+        self.assertTrue(self.wants_ndjson('application/x-ndjson'))
+        self.assertTrue(self.wants_ndjson('application/json;q=0.5, application/x-ndjson'))
+        # wildcards, an explicit q=0 and a preferred application/json keep the page
+        for accept in ('', '*/*', 'application/*', 'application/json', 'application/x-ndjson;q=0, */*',
+                       'application/x-ndjson;q=0.5, application/json'):
+            with self.subTest(accept=accept):
+                self.assertFalse(self.wants_ndjson(accept))
+
+    def test_response(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        Notification.__table__.create(engine)
+        timestamp = datetime(2018, 10, 10, 8, 30)
+        engine.execute(Notification.__table__.insert(), [dict(id=i, ticketnumber='T123456', title='Title ' + str(i),
+                                                              message='Message', timestamp=timestamp) for i in (3, 1, 2)])
+        session = sqlalchemy.orm.Session(bind=engine)
+        schema = compile_schema(NotificationSchema())
+
+        with Flask(__name__).test_request_context():
+            query = session.query(*projection.columns(Notification, schema, Notification.id))
+            response = streaming.ndjson_response(query, Notification.id, schema)
+            self.assertEqual(response.mimetype, streaming.NDJSON)
+            self.assertTrue(response.is_streamed)
+            lines = response.get_data(as_text=True).splitlines()
+        session.close()
+        # one object per line, ordered by the key
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'title': 'Title ' + str(i), 'message': 'Message', 'timestamp': '2018-10-10T08:30:00+00:00'} for i in (1, 2, 3)])
+
+class LocalCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        cache = LocalCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        # "b" was the least recently used entry
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = LocalCache(maxsize=2, ttl=0)
+        cache.set("a", 1)
+        time.sleep(0.01)
+        self.assertIs(cache.get("a"), MISSING)
+
+class SeatAvailabilityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.seats = compile_layout({'cabins': [{'name': 'economy', 'rows': [1, 3], 'labels': 'AB CD'}]})
+        # all seats free except A1, B1 and C2
+        free = (1 << len(self.seats)) - 1
+        for code in ('A1', 'B1', 'C2'):
+            free &= ~(1 << self.seats.index(code))
+        self.availability = SeatAvailability(self.seats, free)
+
+    def test_lookups(self):
+        self.assertEqual(self.availability.left(), 9)
+        self.assertFalse(self.availability.is_free('A1'))
+        self.assertTrue(self.availability.is_free('D2'))
+        self.assertFalse(self.availability.is_free('Z9'))
+        self.assertEqual(self.seats.code(self.availability.next_free()), 'C1')
+        self.assertEqual(self.seats.code(self.availability.next_free(near=self.seats.index('C2'))), 'D2')
+
+    def test_book_release(self):
+        self.availability.book('C1')
+        self.availability.book('C1')
+        self.assertEqual(self.availability.left(), 8)
+        self.assertEqual(self.seats.code(self.availability.next_free()), 'D1')
+        self.availability.release('A1')
+        self.assertEqual(self.availability.left(), 9)
+        self.assertEqual(self.seats.code(self.availability.next_free()), 'A1')
+
+    def test_find_group(self):
+        # row 1: A1 B1 taken, C1 D1 free (one block), row 2: C2 taken
+        self.assertEqual([self.seats.code(i) for i in self.availability.find_group(2)], ['C1', 'D1'])
+        # three adjacent seats do not fit into a block of two: closest free seats in seat map order
+        self.assertEqual([self.seats.code(i) for i in self.availability.find_group(3)], ['C1', 'D1', 'A2'])
+        self.assertIsNone(self.availability.find_group(10))
+
+    def test_first_free(self):
+        self.assertEqual([self.seats.code(i) for i in self.availability.first_free(3)], ['C1', 'D1', 'A2'])
+        exclude = 1 << self.seats.index('D1')
+        self.assertEqual([self.seats.code(i) for i in self.availability.first_free(2, exclude)], ['C1', 'A2'])
+
+class SeatPolicyTestCase(unittest.TestCase):
+
+    # same flight as SeatAvailabilityTestCase
+    setUp = SeatAvailabilityTestCase.setUp
+
+    def codes(self, indexes):
+        return [self.seats.code(i) for i in indexes]
+
+    def test_front_to_back(self):
+        self.assertEqual(self.codes(POLICIES['front-to-back'].candidates(self.availability, 3)), ['C1', 'D1', 'A2'])
+        # the default of a policy
+        self.assertEqual(self.codes(SeatPolicy().candidates(self.availability, 3, 1 << self.seats.index('D1'))), ['C1', 'A2', 'B2'])
+
+    def test_window_and_aisle(self):
+        # window seats are A and D, aisle seats B and C
+        self.assertEqual(self.codes(POLICIES['window'].candidates(self.availability, 4)), ['D1', 'A2', 'D2', 'A3'])
+        self.assertEqual(self.codes(POLICIES['aisle'].candidates(self.availability, 3)), ['C1', 'B2', 'B3'])
+        self.assertEqual(self.codes(POLICIES['aisle'].candidates(self.availability, 5)), ['C1', 'B2', 'B3', 'C3', 'D1'])
+
+    def test_spread(self):
+        for _ in range(20):
+            indexes = POLICIES['spread'].candidates(self.availability, 4)
+            self.assertEqual(len(set(indexes)), 4)
+            self.assertTrue(all(self.availability.is_free(code) for code in self.codes(indexes)))
+        exclude = self.availability.free & ~(1 << self.seats.index('D3'))
+        self.assertEqual(self.codes(POLICIES['spread'].candidates(self.availability, 4, exclude)), ['D3'])
+
+class MeteredPoolTestCase(unittest.TestCase):
+
+    def test_metrics(self):
+        pool = MeteredQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=1, timeout=0.05)
+        first, second = pool.connect(), pool.connect()
+        self.assertRaises(sqlalchemy.exc.TimeoutError, pool.connect)
+        stats = pool.stats()
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow_events'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_max_ms'], 50)
+        first.close()
+        second.close()
+        self.assertEqual(pool.stats()['checked_out'], 0)
+
+class ReplicaRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.router.replicas = ['replica0', 'replica1']
+        self.router.max_lag = 5
+        # lags checked just now
+        self.router.checked = {'replica0': time.monotonic(), 'replica1': time.monotonic()}
+
+    def test_round_robin(self):
+        self.router.lags = {'replica0': 0, 'replica1': 1}
+        self.assertEqual(sorted(self.router.choose() for _ in range(4)), ['replica0', 'replica0', 'replica1', 'replica1'])
+
+    def test_lagging_replica(self):
+        self.router.lags = {'replica0': 0, 'replica1': 60}
+        self.assertEqual([self.router.choose() for _ in range(3)], ['replica0'] * 3)
+        self.router.lags = {'replica0': float('inf'), 'replica1': 60}
+        self.assertIsNone(self.router.choose())
+        self.assertEqual(self.router.stats()['primary_fallbacks'], 1)
+        self.assertEqual(self.router.stats()['unavailable'], ['replica0'])
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_BINDS={'replica0': 'sqlite://'},
+                               SQLALCHEMY_TRACK_MODIFICATIONS=False, SECRET_KEY='test')
+        self.db = RoutingSQLAlchemy(self.app)
+        self.router = ReplicaRouter()
+        self.router.init_app(self.app)
+        self.router.lags, self.router.checked = {'replica0': 0}, {'replica0': time.monotonic()}
+        # the primary and the replica tell apart by their content
+        self.metadata = sqlalchemy.MetaData()
+        self.source = sqlalchemy.Table('source', self.metadata, sqlalchemy.Column('name', sqlalchemy.String(10)))
+        with self.app.app_context():
+            for bind in (None, 'replica0'):
+                engine = self.db.get_engine(self.app, bind=bind)
+                self.metadata.create_all(engine)
+                engine.execute(self.source.insert().values(name=bind or 'primary'))
+
+        def source():
+            if request.method == 'POST':
+                self.db.session.execute(self.source.insert().values(name='written'))
+                self.db.session.commit()
+            return self.read()
+        self.app.add_url_rule('/source', 'source', source, methods=['GET', 'POST'])
+        api = Blueprint('api', __name__)
+        api.add_url_rule('/source', 'source', source, methods=['GET', 'POST'])
+        self.app.register_blueprint(api, url_prefix='/v1')
+        self.app.extensions['jwt'] = KeySet([('k1', 'secret')])
+
+    def read(self):
+        return self.db.session.execute(sqlalchemy.select([self.source.c.name]).limit(1)).scalar()
+
+    def test_get_bind(self):
+        with self.app.test_request_context(method='GET'):
+            self.router.before_request()
+            self.assertEqual(self.read(), 'replica0')
+            # in a primary() block and during a flush
+            with primary():
+                self.assertEqual(self.read(), 'primary')
+            self.assertEqual(self.read(), 'replica0')
+            # a flush writes to the primary
+            class Source(object):
+                pass
+            sqlalchemy.orm.mapper(Source, self.source, primary_key=[self.source.c.name])
+            source = Source()
+            source.name = 'flushed'
+            self.db.session.add(source)
+            self.db.session.flush()
+            flushed = sqlalchemy.select([sqlalchemy.func.count()]).where(self.source.c.name == 'flushed')
+            self.assertEqual(self.db.session.execute(flushed).scalar(), 0)
+            with primary():
+                self.assertEqual(self.db.session.execute(flushed).scalar(), 1)
+            self.db.session.remove()
+        with self.app.test_request_context(method='POST'):
+            self.router.before_request()
+            self.assertEqual(self.read(), 'primary')
+            self.db.session.remove()
+
+    def test_read_through_cache(self):
+        cached = ReadThroughCache('routing', lambda key: self.read(), LocalCache())
+        with self.app.test_request_context(method='GET'):
+            self.router.before_request()
+            self.assertEqual(cached.get('source'), 'primary')
+            # caches without invalidations (the search results) load their misses from the replica
+            expiring = ReadThroughCache('expiring', lambda key: self.read(), LocalCache(), from_primary=False)
+            self.assertEqual(expiring.get('source'), 'replica0')
+            self.assertFalse(search.results.from_primary)
+            self.db.session.remove()
+
+    def test_read_your_writes(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/source').get_data(as_text=True), 'replica0')
+        self.assertEqual(client.post('/source').get_data(as_text=True), 'primary')
+        # the client reads its own writes from the primary until DB_STICKY_SECONDS are over
+        self.assertEqual(client.get('/source').get_data(as_text=True), 'primary')
+        self.assertEqual(self.app.test_client().get('/source').get_data(as_text=True), 'replica0')
+        with client.session_transaction() as session:
+            session['db_primary_until'] = time.time() - 1
+        self.assertEqual(client.get('/source').get_data(as_text=True), 'replica0')
+
+    # bearer clients send no cookie back: their writes are remembered by the subject of the token
+    def test_bearer_read_your_writes(self):
+        def headers(sub):
+            return {'Authorization': 'Bearer ' + self.app.extensions['jwt'].encode({'sub': sub})}
+        self.assertEqual(self.app.test_client().get('/v1/source', headers=headers('1')).get_data(as_text=True), 'replica0')
+        response = self.app.test_client().post('/v1/source', headers=headers('1'))
+        self.assertEqual(response.get_data(as_text=True), 'primary')
+        self.assertNotIn('Set-Cookie', response.headers)
+        # a new client without cookies, with a new token of the same subject
+        self.assertEqual(self.app.test_client().get('/v1/source', headers=headers('1')).get_data(as_text=True), 'primary')
+        self.assertEqual(self.app.test_client().get('/v1/source', headers=headers('2')).get_data(as_text=True), 'replica0')
+        self.router.writers.clear()
+        self.assertEqual(self.app.test_client().get('/v1/source', headers=headers('1')).get_data(as_text=True), 'replica0')
+
+class PrincipalCacheTestCase(unittest.TestCase):
+
+    def test_roles(self):
+        principal = Principal(1, 'admin@airlinews.com', True, 'hash', ['admin'])
+        self.assertTrue(principal.has_role('admin'))
+        self.assertTrue(principal.has_role(Role(name='admin')))
+        self.assertFalse(principal.has_role('customer'))
+        self.assertEqual(principal.get_id(), '1')
+
+    def test_invalidate(self):
+        principals = PrincipalCache()
+        principals.store(1, Principal(1, 'customer@airlinews.com', True, 'hash', ['customer']))
+        self.assertEqual(principals.lookup('1').email, 'customer@airlinews.com')
+        principals.invalidate(1)
+        self.assertIs(principals.lookup(1), MISSING)
+        self.assertEqual(principals.stats(), {'hits': 1, 'misses': 1})
+
+    # with CACHE_BACKEND=uwsgi an invalidation in one worker reaches the others
+    def test_shared_invalidate(self):
+        entries = {}
+        uwsgi = SimpleNamespace(
+            cache_get=lambda key, name: entries.get((name, key)),
+            cache_update=lambda key, value, ttl, name: entries.__setitem__((name, key), value),
+            cache_del=lambda key, name: entries.pop((name, key), None),
+            cache_clear=lambda name: entries.clear())
+        workers = [PrincipalCache(), PrincipalCache()]
+        with mock.patch.dict('sys.modules', uwsgi=uwsgi):
+            for principals in workers:
+                app = Flask(__name__)
+                app.config['CACHE_BACKEND'] = 'uwsgi'
+                LoginManager(app)
+                principals.init_app(app)
+        workers[0].store(1, Principal(1, 'admin@airlinews.com', True, 'hash', ['admin']))
+        self.assertTrue(workers[1].lookup(1).has_role('admin'))
+        workers[0].invalidate(1)
+        self.assertIs(workers[1].lookup(1), MISSING)
+
+    # in a request reading from a replica the principal is loaded from the primary (the admin role is revoked
+    # on the primary, the replica has not replayed it yet)
+    def test_load_from_primary(self):
+        app = Flask(__name__)
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_BINDS={'replica0': 'sqlite://'},
+                          SQLALCHEMY_TRACK_MODIFICATIONS=False)
+        db.init_app(app)
+        router = ReplicaRouter()
+        router.init_app(app)
+        router.lags, router.checked = {'replica0': 0}, {'replica0': time.monotonic()}
+        tables = [User.__table__, Role.__table__, roles_users]
+        with app.app_context():
+            for bind, roles in ((None, []), ('replica0', [dict(user_id=1, role_id=1)])):
+                engine = db.get_engine(app, bind=bind)
+                db.metadata.create_all(engine, tables=tables)
+                engine.execute(User.__table__.insert().values(id=1, email='admin@airlinews.com', password='hash', active=True))
+                engine.execute(Role.__table__.insert().values(id=1, name='admin'))
+                if roles:
+                    engine.execute(roles_users.insert(), roles)
+
+        with app.test_request_context(method='GET'):
+            router.before_request()
+            self.assertEqual(g.db_replica, 'replica0')
+            self.assertFalse(load_principal(1).has_role('admin'))
+            db.session.remove()
+
+class BearerTokenTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        keys = KeySet([('k1', 'secret')])
+        claims = keys.decode(keys.encode({'sub': '1', 'roles': ['admin']}))
+        self.assertEqual((claims['sub'], claims['roles']), ('1', ['admin']))
+        self.assertIsNone(keys.decode('invalid'))
+        expired = KeySet([('k1', 'secret')], expires=-60)
+        self.assertIsNone(expired.decode(expired.encode({'sub': '1'})))
+
+    def test_rotation(self):
+        old = KeySet(parse_keys('k1:secret'))
+        token = old.encode({'sub': '1'})
+        # the new key signs, tokens of the old key stay valid until it is removed
+        rotated = KeySet(parse_keys('k2:other,k1:secret'))
+        self.assertEqual(rotated.decode(token)['sub'], '1')
+        self.assertEqual(rotated.decode(rotated.encode({'sub': '2'}))['sub'], '2')
+        self.assertIsNone(KeySet(parse_keys('k2:other')).decode(token))
+        self.assertRaises(ValueError, parse_keys, 'secret')
+
+    def test_keys_required(self):
+        app = Flask(__name__)
+        app.config.update(SECRET_KEY='not a secret', JWT_KEYS=None)
+        LoginManager(app)
+        with self.assertLogs(level='WARNING'):
+            tokens.init_app(app)
+        # no fallback to the SECRET_KEY of the app
+        forged = KeySet([('default', 'not a secret')]).encode({'sub': '1', 'roles': ['admin']})
+        with app.app_context():
+            self.assertIsNone(tokens.keyset())
+            self.assertIsNone(tokens.decode(forged))
+        app.config['JWT_KEYS'] = 'k1:secret'
+        tokens.init_app(app)
+        with app.app_context():
+            self.assertEqual(tokens.decode(tokens.keyset().encode({'sub': '1'}))['sub'], '1')
+
+class AsyncStatementTestCase(unittest.TestCase):
+
+    def test_placeholders(self):
+        statement = Statement(booking.claim_statement(
+            sqlalchemy.bindparam('flight'), sqlalchemy.bindparam('ticket'), sqlalchemy.bindparam('label'), sqlalchemy.bindparam('row')))
+        self.assertIn('seats.seatlabel = $3', statement.sql)
+        self.assertNotIn('%(', statement.sql)
+        # parameters in order of their placeholders, the literal values are kept
+        self.assertEqual(statement.args(dict(flight='F1', ticket='T1', label='A', row=1)),
+                         ['T1', 'F1', 'A', 1, 'T1', 'T1', 'F1', 'valid'])
+
+class FlightSearchArgsTestCase(unittest.TestCase):
+
+    def test_valid(self):
+        args = MultiDict({'start': 'STR', 'end': 'FRA', 'date': '2018-10-10', 'days': '3'})
+        self.assertEqual(search.parse_args(args), ('STR', 'FRA', datetime(2018, 10, 10), 3))
+        self.assertEqual(search.parse_args(MultiDict({'start': 'STR', 'end': 'FRA', 'date': '2018-10-10'}))[3], 1)
+
+    def test_invalid(self):
+        for args in ({'start': 'STR', 'date': '2018-10-10'}, {'start': 'STR|X', 'end': 'FRA', 'date': '2018-10-10'},
+                     {'start': 'STR', 'end': 'FRA', 'date': '10.10.2018'},
+                     {'start': 'STR', 'end': 'FRA', 'date': '2018-10-10', 'days': str(search.MAX_DAYS + 1)},
+                     {'start': 'STR', 'end': 'FRA', 'date': '2018-10-10', 'days': 'abc'},
+                     {'start': 'STR', 'end': 'FRA', 'date': '2018-10-10', 'days': ''}):
+            with self.assertRaises(search.SearchError):
+                search.parse_args(MultiDict(args))
+
+class CompiledSchemaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        departure = datetime(2018, 10, 10, 8, 30, 0, 250)
+        self.flight = SimpleNamespace(flightnumber='F12345', start='STR', end='FRA', date=departure, aircraft='A320')
+        self.ticket = SimpleNamespace(id=1, number='T123456', flightnumber='F12345', passengername='Jane Doe',
+                                      passportnumber='P123456', status='valid', seat_id=7, bookingnumber=None)
+        self.seat = Seat('T123456', 'F12345', 'A', '12', None)
+        self.notification = Notification('Booking', 'Ticket booked', 'T123456')
+        self.notification.timestamp = departure
+
+    # same JSON as the schema (or the same exception)
+    def assertSameDump(self, schema, obj):
+        compiled = compile_schema(schema)
+        self.assertIsNotNone(compiled.dumps)
+        try:
+            expected = json.dumps(schema.dump(obj))
+        except Exception as e:
+            with self.assertRaises(type(e)):
+                compiled.dump(obj)
+            return
+        self.assertEqual(json.dumps(compiled.dump(obj)), expected)
+
+    def assertSameLoad(self, schema, data):
+        compiled = compile_schema(schema)
+        self.assertIsNotNone(compiled.loads)
+        try:
+            expected = json.dumps(schema.load(json.loads(json.dumps(data))), default=str)
+        except Exception as e:
+            with self.assertRaises(type(e)):
+                compiled.load(data)
+            return
+        self.assertEqual(json.dumps(compiled.load(data), default=str), expected)
+
+    def test_dump(self):
+        row = lightweight_named_tuple('row', ['flightnumber', 'start', 'end', 'date', 'aircraft', 'seatsleft'])
+        aware = datetime(2018, 10, 10, 10, 30, tzinfo=timezone(timedelta(hours=2)))
+        for schema, obj in ((FlightSchema(), self.flight), (FlightsSchema(), self.flight),
+                            (FlightSchema(), SimpleNamespace(flightnumber=1, start=None, end=b'FRA', date=aware)),
+                            (FlightSchema(), {'flightnumber': 'F1', 'date': None, 'items': 'x'}),
+                            (FlightSchema(), SimpleNamespace(date='2018-10-10')),
+                            (FlightSearchSchema(), row(('F1', 'STR', 'FRA', aware, 'A320', 12))),
+                            (TicketSchema(), self.ticket), (TicketSchema(), SimpleNamespace(id='x')),
+                            (SeatSchema(), self.seat), (NotificationSchema(), self.notification)):
+            self.assertSameDump(schema, obj)
+            schema.many = True
+            self.assertSameDump(schema, [obj, obj])
+
+    def test_load(self):
+        ticket = {'flight-number': 'F12345', 'name': 'Jane Doe', 'pass-number': 'P123456', 'seat_number': '1A'}
+        seat = {'ticket-number': 'T123456', 'Flight-number': 'F12345', 'Seat-label': 'A', 'Seat-row': '12'}
+        for schema, data in ((TicketSchema(partial=True), ticket),
+                             (TicketSchema(partial=True), {'flight-number': '', 'flightnumber': 'F1', 'id': '7'}),
+                             (TicketSchema(partial=True), {'flightnumber': ''}),
+                             (TicketSchema(partial=True), ['F1']),
+                             (BulkTicketSchema(many=True, partial=True), [ticket, {'name': ''}, {'id': True}]),
+                             (SeatSchema(), seat), (SeatSchema(), {'Seat-label': 'A'}),
+                             (FlightSchema(), {'start': 'STR', 'end': 'FRA', 'departure': '2018-10-10T08:30:00', 'aircraft': 'A320'}),
+                             (FlightSchema(), {'start': 'STR', 'end': 'FRA', 'departure': 'soon', 'aircraft': 'A320'}),
+                             (NotificationSchema(), {'title': 'Booking', 'message': 'Ticket booked', 'timestamp': 1})):
+            self.assertSameLoad(schema, data)
+
+    def test_input_unchanged(self):
+        data = {'ticket-number': 'T123456', 'Flight-number': 'F12345', 'Seat-label': 'A', 'Seat-row': '12'}
+        result = compile_schema(SeatSchema()).load(data)
+        self.assertEqual(result.data['seatlabel'], 'A')
+        self.assertIn('Seat-label', data)
+
+class ProjectionTestCase(unittest.TestCase):
+
+    def test_columns(self):
+        # the columns behind the dumped fields, fields without a column (SeatSchema.number) are left out
+        keys = [column.key for column in projection.columns(Seat, SeatSchema(), Seat.id)]
+        self.assertEqual(set(keys[:-1]), {'ticketnumber', 'seatlabel', 'seatrow', 'flightnumber'})
+        self.assertEqual(keys[-1], 'id')
+        self.assertEqual([column.key for column in projection.columns(Flight, FlightsSchema(), Flight.id)],
+                         ['flightnumber', 'start', 'end', 'date', 'aircraft', 'id'])
+        # the key column is not selected twice
+        self.assertEqual(len(projection.columns(Ticket, TicketSchema(), Ticket.id)), 8)
+
+class ConditionalRequestTestCase(unittest.TestCase):
+
+    def test_matches(self):
+        tag = conditional.etag('T123456', 3)
+        self.assertTrue(conditional.matches('"T123456-3"', tag))
+        self.assertTrue(conditional.matches('W/"T123456-3", "T123456-2"', tag))
+        self.assertTrue(conditional.matches('*', tag))
+        self.assertFalse(conditional.matches('"T123456-2"', tag))
+        self.assertFalse(conditional.matches('', tag))
+
+    def test_not_modified(self):
+        app = Flask(__name__)
+        with app.test_request_context(headers={'If-None-Match': '"F12345-2"'}):
+            self.assertTrue(conditional.revalidating())
+            self.assertFalse(conditional.requested(conditional.etag('F12345', 3)))
+            response = conditional.not_modified('flight', conditional.etag('F12345', 2))
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], '"F12345-2"')
+            self.assertEqual(response.headers['Cache-Control'], conditional.cache_control['flight'])
+            self.assertEqual(response.get_data(), b'')
+
+class NotificationRelayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.relay = NotificationRelay()
+        # a queue without the thread
+        self.relay.start = lambda: None
+        self.relay.queue = queue.Queue(notifications.BATCH_SIZE + 1)
+
+    def test_batches(self):
+        self.relay.enqueue(range(notifications.BATCH_SIZE + 1))
+        # a full batch right away, the rest after the flush interval
+        self.assertEqual(self.relay.collect(), list(range(notifications.BATCH_SIZE)))
+        start = time.time()
+        self.assertEqual(self.relay.collect(), [notifications.BATCH_SIZE])
+        self.assertGreaterEqual(time.time() - start, notifications.FLUSH_INTERVAL * 0.9)
+
+    def test_backpressure(self):
+        self.relay.queue = queue.Queue(2)
+        with self.assertLogs(level='WARNING') as logs:
+            self.relay.enqueue([1, 2, 3, 4])
+        self.assertIn('2 notifications left for the sweep', logs.output[0])
+        self.assertEqual(self.relay.collect(), [1, 2])
+
+class NumberAllocationTestCase(unittest.TestCase):
+
+    def test_codec_bijective(self):
+        codec = NumberCodec(2, offset=7)
+        numbers = set(codec.encode(value) for value in range(codec.modulus))
+        self.assertEqual(len(numbers), codec.modulus)
+        for value in (0, 1, 500, codec.modulus - 1):
+            self.assertEqual(codec.decode(codec.encode(value)), value)
+        self.assertRaises(NumberSpaceExhausted, codec.encode, codec.modulus)
+
+    def test_ticketnumber_format(self):
+        codec = NumberCodec(7)
+        pattern = re.compile("^([A-Z0-9]{7})$")
+        for value in (1, 2, 10 ** 6, codec.modulus - 1):
+            self.assertTrue(pattern.match(codec.encode(value)))
+
+    def test_allocator_blocks(self):
+        blocks = iter(range(1, 10000, 10))
+        fetches = []
+        def fetch():
+            fetches.append(1)
+            return next(blocks)
+        allocator = NumberAllocator(NumberCodec(7), fetch, block=10)
+
+        numbers = []
+        def allocate():
+            for _ in range(50):
+                numbers.append(allocator.allocate())
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(numbers)), 200)
+        self.assertEqual(len(fetches), 20)
+
+# a flight of a test aircraft (created on first use) with its seats, returns the flightnumber and the seat map
+def create_test_flight(aircraftname, seatcount, start='STR', end='FRA'):
+    aircraft = Aircraft.query.filter_by(aircraft=aircraftname).first()
+    if not aircraft:
+        aircraft = Aircraft(aircraftname, seatcount)
+        db.session.add(aircraft)
+        # no relationship orders the inserts, the flight refers to the aircraft by name
+        db.session.flush()
+    flight = Flight(start, end, datetime.utcnow(), aircraft.aircraft)
+    db.session.add(flight)
+    db.session.flush()
+    seats = seatmap(aircraft)
+    precreate_seats(flight, seats)
+    flightnumber = flight.flightnumber
+    db.session.commit()
+    return flightnumber, seats
+
+# delete test flights with their seats, tickets and notifications, and their test aircrafts once no flight uses them
+def delete_test_flights(flightnumbers):
+    aircraftnames = [row[0] for row in db.session.query(Flight.aircraft).filter(Flight.flightnumber.in_(flightnumbers)).distinct()]
+    ticketnumbers = db.session.query(Ticket.number).filter(Ticket.flightnumber.in_(flightnumbers))
+    NotificationOutbox.query.filter(NotificationOutbox.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+    Notification.query.filter(Notification.ticketnumber.in_(ticketnumbers)).delete(synchronize_session=False)
+    Ticket.query.filter(Ticket.flightnumber.in_(flightnumbers)).update({'seat_id': None}, synchronize_session=False)
+    Seat.query.filter(Seat.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    Ticket.query.filter(Ticket.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    Flight.query.filter(Flight.flightnumber.in_(flightnumbers)).delete(synchronize_session=False)
+    for aircraftname in aircraftnames:
+        if aircraftname.startswith('TEST-') and not Flight.query.filter_by(aircraft=aircraftname).first():
+            Aircraft.query.filter_by(aircraft=aircraftname).delete(synchronize_session=False)
+            invalidate_aircraft(aircraftname)
+    db.session.commit()
+
+# concurrent seat bookings against a (local) PostgreSQL database configured like the webservice
+@unittest.skipUnless(os.environ.get('DBHOST'), 'needs a PostgreSQL database (DBUSER, DBPASS, DBHOST, DBNAME)')
+class SeatBookingConcurrencyTestCase(unittest.TestCase):
+
+    clients = 20
+
+    def setUp(self):
+        self.app = create_app()
+        with self.app.app_context():
+            db.create_all()
+            self.flightnumber, seats = create_test_flight('TEST-BOOKING', self.clients)
+            tickets = [Ticket(self.flightnumber, 'Passenger ' + str(i), 'P' + str(i).zfill(6)) for i in range(self.clients)]
+            db.session.add_all(tickets)
+            db.session.commit()
+            self.ticketnumbers = [ticket.number for ticket in tickets]
+            self.seats = list(seats)
+
+    # every client claims seats (in the same order) until it got one or none is left
+    def client(self, ticketnumber, seats, barrier, results):
+        with self.app.app_context():
+            barrier.wait()
+            for seatlabel, seatrow in seats:
+                result, seat_id = booking.claim_seat(self.flightnumber, ticketnumber, seatlabel, seatrow)
+                db.session.commit()
+                results.append(result)
+                if result == booking.BOOKED:
+                    break
+
+    def run_clients(self, seats):
+        barrier = threading.Barrier(self.clients)
+        results = []
+        threads = [threading.Thread(target=self.client, args=(number, seats, barrier, results)) for number in self.ticketnumbers]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.time() - start
+
+    # number of seats booked more than once and tickets booked for more than one seat
+    def double_bookings(self):
+        with self.app.app_context():
+            seats = db.session.query(Ticket.seat_id).filter(Ticket.flightnumber == self.flightnumber, Ticket.seat_id != None) \
+                .group_by(Ticket.seat_id).having(func.count() > 1).count()
+            tickets = db.session.query(Seat.ticketnumber).filter(Seat.flightnumber == self.flightnumber, Seat.ticketnumber != None) \
+                .group_by(Seat.ticketnumber).having(func.count() > 1).count()
+            return seats + tickets
+
+    def test_same_seat(self):
+        results, elapsed = self.run_clients(self.seats[:1])
+        self.assertEqual(results.count(booking.BOOKED), 1)
+        self.assertEqual(results.count(booking.TAKEN), self.clients - 1)
+        self.assertEqual(self.double_bookings(), 0)
+
+    def test_all_seats(self):
+        results, elapsed = self.run_clients(self.seats)
+        self.assertEqual(results.count(booking.BOOKED), self.clients)
+        self.assertEqual(self.double_bookings(), 0)
+
+    # concurrent check-ins with the seat allocator: every ticket gets a seat without waiting for locked seats
+    def test_allocator(self):
+        allocator = SeatAllocator(POLICIES['front-to-back'])
+        barrier = threading.Barrier(self.clients)
+        claimed = []
+        def client(ticketnumber):
+            with self.app.app_context():
+                barrier.wait()
+                seat = allocator.claim(self.flightnumber, ticketnumber)
+                db.session.commit()
+                claimed.append(seat)
+        threads = [threading.Thread(target=client, args=(number,)) for number in self.ticketnumbers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertNotIn(None, claimed)
+        self.assertEqual(len(set(claimed)), self.clients)
+        self.assertEqual(self.double_bookings(), 0)
+        with self.app.app_context():
+            counter = FlightCounter.query.get(self.flightnumber)
+            self.assertEqual((counter.assigned, counter.checkedin), (self.clients, self.clients))
+
+    # the same ticket checked in concurrently: one seat, every check-in returns it
+    def test_double_checkin(self):
+        ticketnumber = self.ticketnumbers[0]
+        barrier = threading.Barrier(self.clients)
+        claimed = []
+        def client(policy):
+            with self.app.app_context():
+                barrier.wait()
+                seat = SeatAllocator(POLICIES[policy]).claim(self.flightnumber, ticketnumber)
+                db.session.commit()
+                claimed.append(seat)
+        threads = [threading.Thread(target=client, args=(sorted(POLICIES)[i % len(POLICIES)],)) for i in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(claimed), self.clients)
+        self.assertEqual(len(set(claimed)), 1)
+        self.assertNotIn(None, claimed)
+        self.assertEqual(self.double_bookings(), 0)
+        with self.app.app_context():
+            seat = Seat.query.filter_by(ticketnumber=ticketnumber).one()
+            self.assertEqual((seat.seatlabel, seat.seatrow), claimed[0])
+            self.assertTrue(seat.checkinstatus)
+            counter = FlightCounter.query.get(self.flightnumber)
+            self.assertEqual((counter.assigned, counter.checkedin), (1, 1))
+
+    # concurrent reservations of the seats left on the flight: no seat is sold twice, rebuild() finds no drift
+    def test_reservations(self):
+        with self.app.app_context():
+            # half of the tickets are cancelled, counting all tickets would find the flight sold out
+            cancelled = self.ticketnumbers[:self.clients // 2]
+            Ticket.query.filter(Ticket.number.in_(cancelled)).update({'status': 'cancelled'}, synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(counters.rebuild([self.flightnumber]), [self.flightnumber])
+
+        barrier = threading.Barrier(self.clients)
+        reserved = []
+        def client():
+            with self.app.app_context():
+                barrier.wait()
+                left = counters.reserve(self.flightnumber)
+                if left is not None:
+                    # sell the seat to a cancelled ticket again, so the counters match the tickets
+                    Ticket.query.filter_by(number=cancelled[left]).update({'status': 'valid'}, synchronize_session=False)
+                db.session.commit()
+                reserved.append(left)
+        threads = [threading.Thread(target=client) for _ in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(left for left in reserved if left is not None), list(range(len(cancelled))))
+        with self.app.app_context():
+            self.assertEqual(FlightCounter.query.get(self.flightnumber).sold, self.clients)
+            self.assertEqual(counters.rebuild([self.flightnumber]), [])
+
+    def test_versions(self):
+        ticketnumber = self.ticketnumbers[0]
+        version = lambda: db.session.query(Ticket.version).filter_by(number=ticketnumber).scalar()
+        with self.app.app_context():
+            self.assertEqual(version(), 1)
+            # a Core statement (the seat claim) and an ORM flush both count up
+            seatlabel, seatrow = self.seats[0]
+            self.assertEqual(booking.claim_seat(self.flightnumber, ticketnumber, seatlabel, seatrow)[0], booking.BOOKED)
+            db.session.commit()
+            self.assertEqual(version(), 2)
+            Ticket.query.filter_by(number=ticketnumber).first().passengername = 'Renamed'
+            db.session.commit()
+            self.assertEqual(version(), 3)
+
+    def tearDown(self):
+        with self.app.app_context():
+            delete_test_flights([self.flightnumber])
+
+# group bookings, group seating and batch check-in (bulk.py) through the API against a (local) PostgreSQL database
+@unittest.skipUnless(os.environ.get('DBHOST'), 'needs a PostgreSQL database (DBUSER, DBPASS, DBHOST, DBNAME)')
+class GroupBookingTestCase(unittest.TestCase):
+
+    seatcount = 3
+
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        with self.app.app_context():
+            db.create_all()
+            self.flightnumber, seats = create_test_flight('TEST-GROUP', self.seatcount)
+            self.otherflight, seats = create_test_flight('TEST-GROUP', self.seatcount, end='MUC')
+            self.codes, self.positions = seats.codes, seats.positions
+        self.client = self.app.test_client()
+        result = self.client.post('/login', json={'email': 'admin@airlinews.com', 'password': 'p@ssw0rd'})
+        self.assertEqual(result.status_code, 200)
+
+    def passenger(self, i, flightnumber=None):
+        return {'flight-number': flightnumber or self.flightnumber, 'name': 'Passenger ' + str(i), 'pass-number': 'G' + str(i).zfill(6)}
+
+    def book(self, passengers):
+        result = self.client.post('/v1/ticket/bulk', json={'tickets': passengers})
+        self.assertEqual(result.status_code, 200)
+        return result.get_json()
+
+    def sold(self):
+        with self.app.app_context():
+            return FlightCounter.query.get(self.flightnumber).sold
+
+    def test_group(self):
+        result = self.book([self.passenger(i) for i in range(2)])
+        self.assertEqual((result['booked'], result['failed']), (2, 0))
+        self.assertEqual([item['index'] for item in result['tickets']], [0, 1])
+        with self.app.app_context():
+            tickets = Ticket.query.filter_by(flightnumber=self.flightnumber).all()
+            self.assertEqual(sorted(ticket.number for ticket in tickets), sorted(item['ticket-number'] for item in result['tickets']))
+            self.assertEqual(set(ticket.bookingnumber for ticket in tickets), {result['booking-number']})
+        self.assertEqual(self.sold(), 2)
+
+    def test_duplicate_passport(self):
+        result = self.book([self.passenger(1), self.passenger(1)])
+        self.assertEqual([item['status'] for item in result['tickets']], ['booked', 'error'])
+        self.assertEqual(result['tickets'][1]['message'], 'Passport-number already booked a ticket for this flight')
+        # and again in a later request
+        result = self.book([self.passenger(1)])
+        self.assertEqual((result['booking-number'], result['booked']), (None, 0))
+        self.assertEqual(self.sold(), 1)
+
+    def test_sold_out(self):
+        result = self.book([self.passenger(i) for i in range(self.seatcount + 1)])
+        self.assertEqual(result['booked'], self.seatcount)
+        self.assertEqual(result['tickets'][-1], {'index': self.seatcount, 'status': 'error', 'message': 'No more seats left for this flight'})
+        self.assertEqual(self.sold(), self.seatcount)
+
+    def test_item_errors(self):
+        invalid = dict(self.passenger(3), **{'pass-number': 'G12'})
+        result = self.book(['not a passenger', {'name': 'Passenger'}, invalid, self.passenger(4, 'XXXXXX'), self.passenger(5)])
+        self.assertEqual((result['booked'], result['failed']), (1, 4))
+        self.assertEqual([item['index'] for item in result['tickets']], list(range(5)))
+        self.assertEqual([item.get('message') for item in result['tickets']], [
+            'Please provide flightnumber, passengername and passportnumber !',
+            'Please provide flightnumber, passengername and passportnumber !',
+            'Please provide valid passportnumber (7-digit numbers and uppercase characters) !',
+            'Flight does not exist',
+            None])
+        self.assertEqual(self.sold(), 1)
+
+    # valid tickets of a flight (without a seat)
+    def tickets(self, count, flightnumber=None):
+        with self.app.app_context():
+            tickets = [Ticket(flightnumber or self.flightnumber, 'Passenger', 'H' + str(i).zfill(6)) for i in range(count)]
+            db.session.add_all(tickets)
+            db.session.commit()
+            return [ticket.number for ticket in tickets]
+
+    def counter(self):
+        with self.app.app_context():
+            counter = FlightCounter.query.get(self.flightnumber)
+            return counter.assigned, counter.checkedin
+
+    def seated(self, ticketnumbers):
+        with self.app.app_context():
+            return Seat.query.filter(Seat.ticketnumber.in_(ticketnumbers)).count()
+
+    def test_assign_seats(self):
+        ticketnumbers = self.tickets(2)
+        result = self.client.post('/v1/seat/bulk', json={'flight-number': self.flightnumber, 'seats': [
+            {'ticket-number': number, 'seat': code} for number, code in zip(ticketnumbers, self.codes)]})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([item['seat'] for item in result.get_json()['tickets']], list(self.codes[:2]))
+        self.assertEqual(self.seated(ticketnumbers), 2)
+        self.assertEqual(self.counter(), (2, 0))
+
+    def test_assign_seats_other_flight(self):
+        ticketnumbers = self.tickets(1) + self.tickets(1, self.otherflight)
+        with self.app.app_context():
+            assignments = [(number,) + position for number, position in zip(ticketnumbers, self.positions)]
+            self.assertEqual(booking.claim_group(self.flightnumber, assignments), [None, booking.OTHER_FLIGHT])
+        result = self.client.post('/v1/seat/bulk', json={'flight-number': self.flightnumber, 'seats': [
+            {'ticket-number': number, 'seat': code} for number, code in zip(ticketnumbers, self.codes)]})
+        self.assertEqual(result.status_code, 409)
+        self.assertEqual([item['status'] for item in result.get_json()['tickets']], ['not seated', 'error'])
+        self.assertEqual(result.get_json()['tickets'][1]['message'], bulk.SEAT_MESSAGES[booking.OTHER_FLIGHT])
+        # all or nothing
+        self.assertEqual(self.seated(ticketnumbers), 0)
+        self.assertEqual(self.counter(), (0, 0))
+
+    def test_book_seat_other_flight(self):
+        ticketnumber = self.tickets(1, self.otherflight)[0]
+        seatlabel, seatrow = self.positions[0]
+        with self.app.app_context():
+            self.assertEqual(booking.claim_seat(self.flightnumber, ticketnumber, seatlabel, seatrow), (booking.OTHER_FLIGHT, None))
+            db.session.rollback()
+        result = self.client.post('/v1/seat', json={
+            'ticket-number': ticketnumber, 'Flight-number': self.flightnumber, 'Seat-label': seatlabel, 'Seat-row': str(seatrow)})
+        self.assertEqual(result.status_code, 422)
+        self.assertEqual(result.get_json()['message'], bulk.SEAT_MESSAGES[booking.OTHER_FLIGHT])
+        self.assertEqual(self.seated([ticketnumber]), 0)
+        self.assertEqual(self.counter(), (0, 0))
+
+    def test_cancel_seat(self):
+        ticketnumber = self.tickets(1)[0]
+        seatlabel, seatrow = self.positions[0]
+        with self.app.app_context():
+            self.assertEqual(booking.claim_seat(self.flightnumber, ticketnumber, seatlabel, seatrow, checkin=True)[0], booking.BOOKED)
+            db.session.commit()
+        self.assertEqual(self.counter(), (1, 1))
+        result = self.client.delete('/v1/seat/' + ticketnumber + '-' + self.codes[1])
+        self.assertEqual(result.status_code, 422)
+        result = self.client.delete('/v1/seat/' + ticketnumber + '-' + self.codes[0])
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(self.seated([ticketnumber]), 0)
+        self.assertEqual(self.counter(), (0, 0))
+        result = self.client.delete('/v1/seat/' + ticketnumber + '-' + self.codes[0])
+        self.assertEqual(result.status_code, 422)
+
+    def test_seat_group(self):
+        ticketnumbers = self.tickets(self.seatcount)
+        result = self.client.post('/v1/seat/bulk', json={'flight-number': self.flightnumber, 'tickets': ticketnumbers})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.get_json()['seated'], self.seatcount)
+        self.assertEqual(self.seated(ticketnumbers), self.seatcount)
+        self.assertEqual(self.counter(), (self.seatcount, 0))
+
+    def test_seat_group_other_flight(self):
+        ticketnumbers = self.tickets(1, self.otherflight) + self.tickets(1)
+        with self.app.app_context():
+            self.assertEqual(bulk.seat_group(self.flightnumber, ticketnumbers)[0], None)
+            db.session.rollback()
+        result = self.client.post('/v1/seat/bulk', json={'flight-number': self.flightnumber, 'tickets': ticketnumbers})
+        self.assertEqual(result.status_code, 409)
+        self.assertEqual(result.get_json()['tickets'][0]['message'], bulk.SEAT_MESSAGES[booking.OTHER_FLIGHT])
+        self.assertEqual(self.seated(ticketnumbers), 0)
+        self.assertEqual(self.counter(), (0, 0))
+
+    def check_in(self, request):
+        result = self.client.post('/v1/checkin', json=request)
+        self.assertEqual(result.status_code, 200)
+        return [(item['status'], item.get('message')) for item in result.get_json()['tickets']]
+
+    def test_checkin_tickets(self):
+        ticketnumbers = self.tickets(2) + self.tickets(1, self.otherflight)
+        with self.app.app_context():
+            # the first ticket has a seat already
+            seatlabel, seatrow = self.positions[0]
+            self.assertEqual(booking.claim_seat(self.flightnumber, ticketnumbers[0], seatlabel, seatrow)[0], booking.BOOKED)
+            db.session.commit()
+        request = {'tickets': ticketnumbers + ['XXXXXXX'], 'flight-number': self.flightnumber}
+        self.assertEqual(self.check_in(request), [
+            ('checked in', None), ('checked in', None),
+            ('error', 'Ticket is not booked for this flight'), ('error', 'Ticket does not exist !')])
+        self.assertEqual(self.seated(ticketnumbers), 2)
+        self.assertEqual(self.counter(), (2, 2))
+        # checking in again keeps the seats and the counters
+        self.assertEqual(self.check_in({'tickets': ticketnumbers[:2]}), [('checked in', None)] * 2)
+        self.assertEqual(self.counter(), (2, 2))
+
+    def test_checkin_other_flight(self):
+        ticketnumber = self.tickets(1, self.otherflight)[0]
+        with self.app.app_context():
+            self.assertIsNone(SeatAllocator(POLICIES['front-to-back']).claim(self.flightnumber, ticketnumber))
+            db.session.rollback()
+        result = self.client.post('/v1/checkin', json={'ticket-number': ticketnumber, 'flight-number': self.flightnumber})
+        self.assertEqual((result.status_code, result.get_json()['message']), (400, 'Ticket is not booked for this flight'))
+        self.assertEqual(self.seated([ticketnumber]), 0)
+        self.assertEqual(self.counter(), (0, 0))
+        # not a JSON object
+        for body in ([1], ['tickets']):
+            result = self.client.post('/v1/checkin', json=body)
+            self.assertEqual((result.status_code, result.get_json()['message']), (400, 'No input data provided'))
+
+    def test_checkin_booking(self):
+        result = self.client.post('/v1/ticket/bulk', json={'tickets': [
+            self.passenger(1), self.passenger(2, self.otherflight), self.passenger(3)]}).get_json()
+        self.assertEqual(result['booked'], 3)
+        request = {'booking-number': result['booking-number'], 'flight-number': self.flightnumber}
+        self.assertEqual(self.check_in(request), [
+            ('checked in', None), ('error', 'Ticket is not booked for this flight'), ('checked in', None)])
+        self.assertEqual(self.counter(), (2, 2))
+        # the whole booking, the tickets of this flight are checked in already
+        self.assertEqual(self.check_in({'booking-number': result['booking-number']}), [('checked in', None)] * 3)
+        self.assertEqual(self.counter(), (2, 2))
+        with self.app.app_context():
+            self.assertEqual(Seat.query.filter_by(flightnumber=self.otherflight, checkinstatus=True).count(), 1)
+        result = self.client.post('/v1/checkin', json={'booking-number': 'XXXXXXX'})
+        self.assertEqual(result.status_code, 400)
+
+    def test_delete_ticket(self):
+        ticketnumbers = [item['ticket-number'] for item in self.book([self.passenger(i) for i in range(2)])['tickets']]
+        with self.app.app_context():
+            for ticketnumber, (seatlabel, seatrow) in zip(ticketnumbers, self.positions):
+                self.assertEqual(booking.claim_seat(self.flightnumber, ticketnumber, seatlabel, seatrow, checkin=True)[0], booking.BOOKED)
+            db.session.commit()
+        self.assertEqual((self.sold(), self.counter()), (2, (2, 2)))
+
+        result = self.client.delete('/v1/ticket/' + ticketnumbers[0])
+        self.assertEqual(result.status_code, 200)
+        # the seat is free again and the counters match the tickets and seats
+        self.assertEqual((self.sold(), self.counter()), (1, (1, 1)))
+        self.assertEqual(self.seated(ticketnumbers), 1)
+        with self.app.app_context():
+            seatlabel, seatrow = self.positions[0]
+            seat = Seat.query.filter_by(flightnumber=self.flightnumber, seatlabel=seatlabel, seatrow=seatrow).one()
+            self.assertEqual((seat.ticketnumber, seat.checkinstatus), (None, False))
+            self.assertEqual(counters.rebuild([self.flightnumber]), [])
+            # the notifications of the deleted ticket (tearDown only finds those of the remaining tickets)
+            NotificationOutbox.query.filter_by(ticketnumber=ticketnumbers[0]).delete()
+            Notification.query.filter_by(ticketnumber=ticketnumbers[0]).delete()
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            delete_test_flights([self.flightnumber, self.otherflight])
+
+# the handlers of the ASGI app (asgi.py) against a (local) PostgreSQL database
+@unittest.skipUnless(os.environ.get('DBHOST') and importlib.util.find_spec('asyncpg'),
+                     'needs asyncpg and a PostgreSQL database (DBUSER, DBPASS, DBHOST, DBNAME)')
+class AsgiHandlerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from webapp import asgi
+        cls.asgi = asgi
+        # the connection pool of the app belongs to the loop that created it
+        cls.loop = asyncio.new_event_loop()
+
+        app = asgi.flask_app
+        app.config['WTF_CSRF_ENABLED'] = False
+        client = app.test_client()
+        result = client.post('/login', json={'email': 'admin@airlinews.com', 'password': 'p@ssw0rd'})
+        assert result.status_code == 200
+        cls.cookie = [cookie for cookie in client.cookie_jar if cookie.name == app.session_cookie_name][0]
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.asgi.pool is not None:
+            cls.loop.run_until_complete(cls.asgi.pool.close())
+            cls.asgi.pool = None
+        cls.loop.close()
+
+    def setUp(self):
+        with self.asgi.flask_app.app_context():
+            self.flightnumber, seats = create_test_flight('TEST-ASGI', 4)
+            ticket = Ticket(self.flightnumber, 'Passenger', 'A000001')
+            db.session.add(ticket)
+            db.session.commit()
+            self.ticketnumber, self.codes = ticket.number, seats.codes
+
+    def headers(self, login):
+        return [(b'cookie', (self.cookie.name + '=' + self.cookie.value).encode('latin-1'))] if login else []
+
+    # (status, headers, JSON body) of a request served by the ASGI app
+    def request(self, method, path, payload=None, headers=(), login=True):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        headers = list(headers) + self.headers(login)
+        # as sent by an ASGI server (the Flask app reads the body by its length)
+        if body:
+            headers += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))]
+        sent = []
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+        async def send(message):
+            sent.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': headers}
+        self.loop.run_until_complete(self.asgi.app(scope, receive, send))
+        return sent[0]['status'], dict(sent[0]['headers']), json.loads(sent[1]['body'].decode('utf-8')) if sent[1]['body'] else None
+
+    # the response of the ASGI routes (FLASK: passed on to the Flask app)
+    def serve(self, method, path, login=True):
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': self.headers(login)}
+        return self.loop.run_until_complete(self.asgi.serve(scope, b''))
+
+    def counter(self):
+        with self.asgi.flask_app.app_context():
+            counter = FlightCounter.query.get(self.flightnumber)
+            return counter.sold, counter.assigned, counter.checkedin
+
+    def test_reads(self):
+        for path in ('/v1/flight/' + self.flightnumber, '/v1/ticket/' + self.ticketnumber, '/v1/ticket/' + self.ticketnumber + '/notifications'):
+            with self.subTest(path=path):
+                status, headers, body = self.request('GET', path)
+                self.assertEqual(status, 200)
+                # a poll with the etag is not modified (notifications only once there are any)
+                if 'notifications' not in path:
+                    status, headers, body = self.request('GET', path, headers=[(b'if-none-match', headers[b'etag'])])
+                    self.assertEqual((status, body), (304, None))
+        status, headers, body = self.request('GET', '/v1/flight/' + self.flightnumber)
+        self.assertEqual(body['flight-number'], self.flightnumber)
+
+    def test_book_ticket(self):
+        status, headers, body = self.request('POST', '/v1/ticket', {'flight-number': self.flightnumber, 'name': 'Passenger', 'pass-number': 'A000002'})
+        self.assertEqual(status, 200)
+        ticketnumber = body['Location'].rsplit('/', 1)[1]
+        with self.asgi.flask_app.app_context():
+            self.assertEqual(Ticket.query.filter_by(number=ticketnumber).one().passportnumber, 'A000002')
+        self.assertEqual(self.counter(), (1, 0, 0))
+        status, headers, body = self.request('POST', '/v1/ticket', {'flight-number': self.flightnumber, 'name': 'Passenger', 'pass-number': 'A000002'})
+        self.assertEqual((status, body['message']), (404, 'Passport-number already booked a ticket for this flight'))
+
+    def test_book_seat(self):
+        code = self.codes[0]
+        seat = {'ticket-number': self.ticketnumber, 'Flight-number': self.flightnumber, 'Seat-label': code[0], 'Seat-row': code[1:]}
+        status, headers, body = self.request('POST', '/v1/seat', seat)
+        self.assertEqual((status, body['Location']), (200, '/v1/seat/' + self.ticketnumber + '-' + code))
+        status, headers, body = self.request('POST', '/v1/seat', seat)
+        self.assertEqual((status, body['message']), (422, bulk.SEAT_MESSAGES[booking.ALREADY_BOOKED_SEAT]))
+        self.assertEqual(self.counter(), (0, 1, 0))
+
+    def test_checkin(self):
+        checkin = {'ticket-number': self.ticketnumber, 'flight-number': self.flightnumber, 'seat-preference': 'front-to-back'}
+        for _ in range(2):
+            status, headers, body = self.request('POST', '/v1/checkin', checkin)
+            self.assertEqual((status, body['Location']), (200, '/v1/ticket/' + self.ticketnumber))
+        with self.asgi.flask_app.app_context():
+            seat = Seat.query.filter_by(ticketnumber=self.ticketnumber).one()
+            self.assertEqual((seat.seatlabel + str(seat.seatrow), seat.checkinstatus), (self.codes[0], True))
+        self.assertEqual(self.counter(), (0, 1, 1))
+        status, headers, body = self.request('POST', '/v1/checkin', [1])
+        self.assertEqual((status, body['message']), (400, 'No input data provided'))
+
+    def test_passed_on(self):
+        # without a session, other endpoints and batch check-ins go to the Flask app
+        self.assertIs(self.serve('GET', '/v1/flight/' + self.flightnumber, login=False), self.asgi.FLASK)
+        self.assertIs(self.serve('GET', '/v1/flights'), self.asgi.FLASK)
+        status, headers, body = self.request('POST', '/v1/checkin', {'tickets': [self.ticketnumber]})
+        self.assertEqual((status, body['checked-in']), (200, 1))
+
+    def tearDown(self):
+        with self.asgi.flask_app.app_context():
+            delete_test_flights([self.flightnumber])
+
+# the notification outbox and its relay against a (local) PostgreSQL database
+@unittest.skipUnless(os.environ.get('DBHOST'), 'needs a PostgreSQL database (DBUSER, DBPASS, DBHOST, DBNAME)')
+class NotificationOutboxTestCase(unittest.TestCase):
+
+    ticketnumber = 'TOUTBOX'
+
+    def setUp(self):
+        self.app = create_app()
+        with self.app.app_context():
+            db.create_all()
+        self.tearDown()
+
+    # (events in the outbox, notifications) of the test ticket
+    def counts(self):
+        with self.app.app_context():
+            return (NotificationOutbox.query.filter_by(ticketnumber=self.ticketnumber).count(),
+                    Notification.query.filter_by(ticketnumber=self.ticketnumber).count())
+
+    def test_committed(self):
+        # the relay of the app (create_app) runs in this process
+        relay.start()
+        with self.app.app_context():
+            notifications.notify(self.ticketnumber, 'Booking Successful', 'Committed')
+            db.session.commit()
+        # stop flushes the queued events
+        relay.stop()
+        self.assertEqual(self.counts(), (0, 1))
+
+    def test_rolled_back(self):
+        with self.app.app_context():
+            notifications.notify(self.ticketnumber, 'Booking Successful', 'Rolled back')
+            db.session.rollback()
+            self.assertNotIn('notifications', db.session().info)
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_sweep(self):
+        with self.app.app_context():
+            # events that were never queued, one of them too recent for the sweep
+            old = datetime.utcnow() - timedelta(seconds=notifications.SWEEP_AGE + 5)
+            db.session.execute(NotificationOutbox.__table__.insert().values([
+                dict(ticketnumber=self.ticketnumber, title='Old', message='Left behind', timestamp=old),
+                dict(ticketnumber=self.ticketnumber, title='New', message='Still queued', timestamp=datetime.utcnow())]))
+            db.session.commit()
+            self.assertGreaterEqual(notifications.sweep(), 1)
+            db.session.commit()
+            self.assertEqual(Notification.query.filter_by(ticketnumber=self.ticketnumber).one().title, 'Old')
+        self.assertEqual(self.counts(), (1, 1))
+
+    def tearDown(self):
+        with self.app.app_context():
+            NotificationOutbox.query.filter_by(ticketnumber=self.ticketnumber).delete()
+            Notification.query.filter_by(ticketnumber=self.ticketnumber).delete()
+            db.session.commit()
+
+# the hot queries of the resources must not fall back to sequential scans on a seeded (local) PostgreSQL database
+@unittest.skipUnless(os.environ.get('DBHOST'), 'needs a PostgreSQL database (DBUSER, DBPASS, DBHOST, DBNAME)')
+class QueryPlanTestCase(unittest.TestCase):
+
+    flights = 300
+    tickets = 20
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+            flightnumbers = [create_test_flight('TEST-PLANS', 133)[0] for _ in range(cls.flights)]
+            tickets = [Ticket(flightnumber, 'Passenger', 'P' + str(i).zfill(6)) for flightnumber in flightnumbers for i in range(cls.tickets)]
+            db.session.add_all(tickets)
+            db.session.flush()
+            db.session.execute(Notification.__table__.insert().values([
+                dict(ticketnumber=ticket.number, title='Booking Successful', message='Seeded', timestamp=datetime.utcnow())
+                for ticket in tickets]))
+            db.session.commit()
+
+            for table in ('flights', 'seats', 'tickets', 'notifications', 'flightcounters'):
+                db.session.execute('ANALYZE ' + table)
+            db.session.commit()
+
+            cls.flightnumber = flightnumbers[0]
+            cls.ticketnumber = tickets[0].number
+            cls.passportnumber = tickets[0].passportnumber
+
+    def hot_queries(self):
+        flightnumber, ticketnumber, passportnumber = self.flightnumber, self.ticketnumber, self.passportnumber
+        return {
+            'flight by number': Flight.query.filter_by(flightnumber=flightnumber),
+            'ticket by number': Ticket.query.filter_by(number=ticketnumber),
+            'seats of a flight': Seat.query.filter_by(flightnumber=flightnumber),
+            'seat of a flight': Seat.query.filter_by(flightnumber=flightnumber, seatlabel='A', seatrow=1),
+            'seat of a ticket': Seat.query.filter_by(ticketnumber=ticketnumber),
+            'ticket of a passport': Ticket.query.filter_by(passportnumber=passportnumber).filter_by(flightnumber=flightnumber).filter(Ticket.status != "cancelled"),
+            'tickets of a flight': Ticket.query.filter_by(flightnumber=flightnumber),
+            'notifications of a ticket': Notification.query.filter_by(ticketnumber=ticketnumber).order_by(Notification.timestamp),
+            'version of a ticket': db.session.query(Ticket.version).filter_by(number=ticketnumber),
+            'etag of notifications': db.session.query(func.count(), func.max(Notification.timestamp)).filter(Notification.ticketnumber == ticketnumber),
+            'seat claim': booking.claim_statement(flightnumber, ticketnumber, 'A', 1),
+            'seat claim reason': booking.reason_query(flightnumber, ticketnumber, 'A', 1),
+            'passports of a group booking': bulk.booked_passports_query([(passportnumber, flightnumber), ('X000000', flightnumber)]),
+            'seat reservation': counters.reserve_statement(flightnumber),
+            'flight search': search.search_query('STR', 'MUC', datetime(2018, 10, 10), datetime(2018, 10, 13)),
+            'seat counters of a group booking': counters.lock_query([flightnumber]),
+            'group seat claim': booking.claim_group_statement(flightnumber, [(ticketnumber, 'A', 1), ('X000000', 'B', 1)]),
+            'tickets of a group': booking.ticket_states_query([ticketnumber, 'X000000']),
+            'seats of a group': booking.seat_holders_query(flightnumber, [('A', 1), ('B', 1)]),
+            'check-in of tickets': booking.checkin_statement([ticketnumber, 'X000000']),
+            'seat claim skipping locked seats': booking.claim_any_statement(flightnumber, ticketnumber, [('A', 1), ('B', 1)]),
+        }
+
+    # EXPLAIN a query and return the tables it scans sequentially
+    def seqscans(self, query):
+        statement = getattr(query, 'statement', query)
+        compiled = statement.compile(dialect=db.engine.dialect)
+        plan = db.session.connection().execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+        nodes, scans = [plan[0]['Plan']], []
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return scans
+
+    def test_no_seqscans(self):
+        with self.app.app_context():
+            for name, query in self.hot_queries().items():
+                with self.subTest(query=name):
+                    self.assertEqual(self.seqscans(query), [])
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            delete_test_flights([row[0] for row in db.session.query(Flight.flightnumber).filter_by(aircraft='TEST-PLANS')])
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+# Stateless bearer tokens (JWT) for the API
+#
+# Machine-to-machine partners authenticate calls to /v1 with "Authorization: Bearer <token>" instead of a session
+# cookie. A token is a JWT (HS256) with the user id, email and role names, signed with a key of the key set and
+# naming that key in its header (kid). Verifying a token is one HMAC with the key of its kid: the key set is
+# read from the config once per worker process, so a call needs no session and no user lookup (see principal.py).
+#
+# Tokens are issued by POST /auth/token with {"email": ..., "password": ...} and expire after JWT_EXPIRES seconds.
+# Changed roles apply to tokens issued afterwards, a token cannot be revoked before it expires.
+#
+#   JWT_KEYS     key set as kid:secret,kid:secret,... - the first key signs new tokens. There is no default key
+#                (the SECRET_KEY of the app is no secret), without JWT_KEYS bearer tokens are disabled: /auth/token
+#                answers 404 and calls with a bearer token get a 401
+#   JWT_EXPIRES  lifetime of a token in seconds (default 900)
+#
+# Key rotation: put a new key in front of JWT_KEYS, keep the old key until its tokens have expired, then remove it
+# (tokens naming a kid that is not in the key set are rejected).
+
+import time, jwt, logging
+
+from collections import OrderedDict
+from flask import current_app, request, make_response, jsonify
+
+ALGORITHM = 'HS256'
+
+
+class KeySet(object):
+
+    def __init__(self, keys, expires=900):
+        # keys: (kid, secret) pairs, the first one signs
+        self.keys = OrderedDict(keys)
+        self.kid = next(iter(self.keys))
+        self.expires = expires
+
+    def encode(self, claims):
+        now = int(time.time())
+        payload = dict(claims, iat=now, exp=now + self.expires)
+        return jwt.encode(payload, self.keys[self.kid], algorithm=ALGORITHM, headers={'kid': self.kid}).decode('ascii')
+
+    # the claims of a valid token (None if the token is invalid, expired or signed with an unknown key)
+    def decode(self, token):
+        try:
+            key = self.keys.get(jwt.get_unverified_header(token).get('kid'))
+            if key is None:
+                return None
+            return jwt.decode(token, key, algorithms=[ALGORITHM])
+        except jwt.InvalidTokenError:
+            return None
+
+
+# key set from "kid:secret,kid:secret,..."
+def parse_keys(value):
+    keys = []
+    for item in filter(None, (item.strip() for item in value.split(','))):
+        kid, separator, secret = item.partition(':')
+        if not separator or not kid or not secret:
+            raise ValueError('JWT_KEYS expects kid:secret pairs separated by commas')
+        keys.append((kid, secret))
+    return keys
+
+def init_app(app):
+    keys = parse_keys(app.config.get('JWT_KEYS') or '')
+    if keys:
+        app.extensions['jwt'] = KeySet(keys, app.config.get('JWT_EXPIRES', 900))
+    else:
+        logging.warning('JWT_KEYS is not set, bearer tokens are disabled')
+        app.extensions['jwt'] = None
+
+    # calls with a bearer token get a 401 instead of the redirect to the login form
+    manager = app.login_manager
+    redirect = manager.unauthorized
+    def unauthorized():
+        if bearer(request.headers.get('Authorization')):
+            response = make_response(jsonify({'message': 'Invalid or expired token'}), 401)
+            response.headers['WWW-Authenticate'] = 'Bearer error="invalid_token"'
+            return response
+        return redirect()
+    manager.unauthorized = unauthorized
+
+# the key set of the app (None if bearer tokens are disabled)
+def keyset():
+    return current_app.extensions.get('jwt')
+
+# the claims of a valid bearer token (None if the token is invalid or bearer tokens are disabled)
+def decode(token):
+    keys = keyset()
+    return keys.decode(token) if keys is not None else None
+
+# a token for a user with its roles
+def issue(user):
+    return keyset().encode({'sub': str(user.id), 'email': user.email, 'roles': [role.name for role in user.roles]})
+
+# the bearer token of an Authorization header value (None if there is none)
+def bearer(authorization):
+    if authorization and authorization[:7].lower() == 'bearer ':
+        return authorization[7:].strip()
+    return None